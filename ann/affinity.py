@@ -0,0 +1,335 @@
+# affinity.py
+#
+# Chromosome-affinity annotation of large jobs
+#
+# An annotator started with a chromosome set ([ann] chromosomes) keeps
+# only those chromosomes' partitions of the reference tables in memory
+# (see intervals.set_chromosomes()), so a few small instances can share a
+# reference that would not fit in any one of them. Records on other
+# chromosomes still annotate correctly, from the database.
+#
+# A job at least [ann] affinity_min_bytes large is not annotated where it
+# is received. The split command sorts its lines into one piece per group
+# of [ann] chromosome_groups, keeping the layout (which piece each run of
+# lines went to) to restore the input order with. It uploads the pieces
+# and the layout to the inputs bucket and publishes one message per piece
+# to the job requests topic. The message carries the group as its
+# "chromosomes" attribute, and each annotator's queue is subscribed with a
+# filter policy on it, so a piece reaches the workers holding its
+# chromosomes while whole jobs reach them all:
+#
+#   {"chromosomes": [{"exists": false}, "1,2,3,4,5"]}
+#
+# The annotate command annotates a piece and uploads its result and
+# counters to the results bucket. The job item counts the pieces done,
+# and the worker completing the last one interleaves the results back in
+# input order (annotation keeps one output line per input line), merges
+# the counters into one count log and completes the job like run.py does.
+#
+#   python affinity.py split <local input> <path> <user> <job> <file> \
+#       [<regions>] [<tracks>]
+#   python affinity.py annotate <message file>
+#
+##
+
+import os
+import sys
+import json
+import shutil
+import functools
+import tempfile
+import boto3
+from botocore.exceptions import ClientError
+import run
+import driver
+import engine
+import bgzf
+import regions
+import intervals
+
+config = run.config
+
+
+"""Chromosome groups from a setting like "1,2,3;4,5;X,Y,M", as lists of
+chromosome names without the chr prefix
+"""
+def parse_groups(text):
+    groups = []
+    seen = set()
+    for group in text.split(';'):
+        names = [intervals.chrom_name(c) for c in group.split(',')
+            if c.strip()]
+        if (len(names) == 0):
+            continue
+        for name in names:
+            if name in seen:
+                raise ValueError(f"Chromosome {name} is in two groups")
+            seen.add(name)
+        groups.append(names)
+    if (len(groups) == 0):
+        raise ValueError("No chromosome groups")
+    return groups
+
+
+"""Index of the group holding chrom; chromosomes in no group go to the
+first
+"""
+def group_of(groups, chrom):
+    name = intervals.chrom_name(chrom)
+    for n, group in enumerate(groups):
+        if name in group:
+            return n
+    return 0
+
+
+"""Sorts the lines of infile into one piece per chromosome group in
+directory, header lines going with the record after them (the record
+before them, past the first record)
+
+Returns the pieces as a {group index: path} dictionary and the layout as
+[group index, line count] runs in input order.
+"""
+def split_pieces(infile, directory, groups, sep='\t'):
+    files = {}
+    layout = []
+    found = {}
+    pending = []
+    group = None
+    try:
+        with bgzf.open_input(infile) as fh:
+            for batch in engine.read_batches(fh):
+                for line in batch:
+                    if not line.startswith('#'):
+                        chrom = line.split(sep, 1)[0]
+                        if chrom not in found:
+                            found[chrom] = group_of(groups, chrom)
+                        if (group is not None) and (found[chrom] != group):
+                            write_lines(files, layout, directory, group,
+                                pending)
+                            pending = []
+                        group = found[chrom]
+                    pending.append(line)
+                if (group is not None) and (len(pending) > 0):
+                    write_lines(files, layout, directory, group, pending)
+                    pending = []
+        if (len(pending) > 0):
+            write_lines(files, layout, directory, group or 0, pending)
+    finally:
+        for fh_piece in files.values():
+            fh_piece.close()
+
+    return dict([(n, fh_piece.name) for n, fh_piece in files.items()]), \
+        layout
+
+
+def write_lines(files, layout, directory, group, lines):
+    if group not in files:
+        files[group] = open(os.path.join(directory, f"piece{group:05d}"),
+            'w')
+    files[group].write(''.join([line + '\n' for line in lines]))
+    if (len(layout) > 0) and (layout[-1][0] == group):
+        layout[-1][1] = layout[-1][1] + len(lines)
+    else:
+        layout.append([group, len(lines)])
+
+
+"""Writes the lines of the annotated pieces to outfile in the order of
+the layout, as BGZF with compress
+"""
+def interleave(outputs, layout, outfile, compress=False, compress_threads=1):
+    tmpfile = outfile + '.part'
+    files = {}
+    try:
+        for n, output in outputs.items():
+            files[n] = open(output)
+        with bgzf.open_output(tmpfile, compress, compress_threads) as fh_out:
+            for n, count in layout:
+                for i in range(count):
+                    fh_out.write(files[n].readline())
+    finally:
+        for fh in files.values():
+            fh.close()
+    os.replace(tmpfile, outfile)
+
+
+def piece_name(job_id, input_file_name, n):
+    return f"{job_id}~{input_file_name}.piece{n:05d}"
+
+
+def s3_key(user_id, name):
+    return config.get("prefix", "cnetid") + user_id + "/" + name
+
+
+"""Splits a job and sends its pieces to the workers of their chromosome
+groups
+"""
+def split_job(local_path, root_path, user_id, job_id, input_file_name,
+    regions_file=None, tracks=None):
+    groups = parse_groups(config.get("ann", "chromosome_groups"))
+    region = config.get("aws", "AwsRegionName")
+    inputs_bucket = config.get("s3", "bucket_name")
+
+    source = local_path
+    if regions_file:
+        source = local_path + '.regions'
+        regions.extract(local_path, regions_file, source)
+    directory = tempfile.mkdtemp(prefix=f"{job_id}.", dir=root_path)
+    try:
+        pieces, layout = split_pieces(source, directory, groups)
+
+        s3_client = boto3.client('s3')
+        for n, piece in pieces.items():
+            s3_client.upload_file(piece, inputs_bucket,
+                s3_key(user_id, piece_name(job_id, input_file_name, n)))
+        s3_client.put_object(Bucket=inputs_bucket,
+            Key=s3_key(user_id, f"{job_id}~{input_file_name}.layout"),
+            Body=json.dumps(layout).encode('utf-8'))
+    finally:
+        shutil.rmtree(directory, ignore_errors=True)
+        if (source != local_path):
+            os.remove(source)
+
+    table = boto3.resource("dynamodb", region_name=region).Table(
+        config.get("dynamodb", "db"))
+    table.update_item(Key={"job_id": job_id},
+        UpdateExpression="set pieces_total = :t, pieces_done = :d",
+        ExpressionAttributeValues={":t": len(pieces), ":d": 0})
+
+    topic = boto3.resource('sns', region_name=region).Topic(
+        config.get("sns", "sns_topic"))
+    for n in sorted(pieces):
+        message = {"job_id": job_id, "user_id": user_id,
+            "input_file_name": input_file_name,
+            "s3_inputs_bucket": inputs_bucket, "tracks": tracks,
+            "piece": n, "pieces": sorted(pieces)}
+        topic.publish(Message=json.dumps(message),
+            MessageAttributes={"chromosomes": {"DataType": "String",
+                "StringValue": ",".join(groups[n])}})
+
+
+"""Annotates the piece a message names, and completes the job when it was
+the last one
+"""
+def annotate_job(message, root_path):
+    job_id = message["job_id"]
+    user_id = message["user_id"]
+    input_file_name = message["input_file_name"]
+    results_bucket = config.get("s3", "bucket_results")
+    region = config.get("aws", "AwsRegionName")
+    options = run.driver_options()
+    options['bgzf_output'] = False
+
+    name = piece_name(job_id, input_file_name, message["piece"])
+    local_piece = f"{root_path}/{name}"
+    s3_client = boto3.client('s3')
+    s3_client.download_file(message["s3_inputs_bucket"],
+        s3_key(user_id, name), local_piece)
+    result = driver.run(local_piece, 'vcf', tracks=message["tracks"],
+        countsfile=local_piece + '.counts.json', **options)
+    s3_client.upload_file(result, results_bucket,
+        s3_key(user_id, name + '.annot'))
+    s3_client.upload_file(local_piece + '.counts.json', results_bucket,
+        s3_key(user_id, name + '.counts.json'))
+    for path in (local_piece, result, local_piece + '.counts.json',
+        local_piece + '.count.log', local_piece + '.metrics.json'):
+        os.remove(path)
+
+    # Only the worker adding the last piece sees them all done
+    table = boto3.resource("dynamodb", region_name=region).Table(
+        config.get("dynamodb", "db"))
+    response = table.update_item(Key={"job_id": job_id},
+        UpdateExpression="add pieces_done :n",
+        ExpressionAttributeValues={":n": 1}, ReturnValues="UPDATED_NEW")
+    if (int(response["Attributes"]["pieces_done"]) == len(message["pieces"])):
+        merge_job(message, root_path)
+
+
+"""Puts the annotated pieces of a job back together and completes it
+"""
+def merge_job(message, root_path):
+    job_id = message["job_id"]
+    user_id = message["user_id"]
+    input_file_name = message["input_file_name"]
+    inputs_bucket = message["s3_inputs_bucket"]
+    results_bucket = config.get("s3", "bucket_results")
+    options = run.driver_options()
+    layout_key = s3_key(user_id, f"{job_id}~{input_file_name}.layout")
+
+    names = dict([(n, piece_name(job_id, input_file_name, n))
+        for n in message["pieces"]])
+    directory = tempfile.mkdtemp(prefix=f"{job_id}.", dir=root_path)
+    s3_client = boto3.client('s3')
+    try:
+        outputs = {}
+        parts = []
+        for n, name in names.items():
+            outputs[n] = os.path.join(directory, name + '.annot')
+            s3_client.download_file(results_bucket,
+                s3_key(user_id, name + '.annot'), outputs[n])
+            body = s3_client.get_object(Bucket=results_bucket,
+                Key=s3_key(user_id, name + '.counts.json'))['Body'].read()
+            parts.append(json.loads(body))
+        layout = json.loads(s3_client.get_object(Bucket=inputs_bucket,
+            Key=layout_key)['Body'].read())
+
+        results_ext = ".annot.vcf.gz" if options['bgzf_output'] \
+            else ".annot.vcf"
+        local_results_file = f"{root_path}/{job_id}~" + \
+            input_file_name.split(".")[0] + results_ext
+        interleave(outputs, layout, local_results_file,
+            options['bgzf_output'],
+            options['bgzf_threads'] or os.cpu_count())
+    finally:
+        shutil.rmtree(directory, ignore_errors=True)
+
+    local_path = f"{root_path}/{job_id}~{input_file_name}"
+    stages = engine.merge_counts(functools.partial(driver.stages,
+        tracks=message["tracks"]), [part['counts'] for part in parts])
+    engine.write_log(stages, local_path + '.count.log')
+    engine.write_summary(stages, local_path + '.count.log')
+    engine.write_memory(local_path + '.count.log', options['batch_size'],
+        options['queue_depth'],
+        peak=max([part['peak_memory'] for part in parts]))
+    engine.write_metrics(stages, local_path + '.metrics.json',
+        max([part['wall_time'] for part in parts]))
+
+    run.complete_job(user_id, job_id, input_file_name, local_results_file,
+        local_path + '.count.log', local_path + '.metrics.json')
+
+    try:
+        s3_client.delete_objects(Bucket=inputs_bucket, Delete={'Objects':
+            [{'Key': s3_key(user_id, name)} for name in names.values()] + \
+            [{'Key': layout_key}]})
+        s3_client.delete_objects(Bucket=results_bucket, Delete={'Objects':
+            [{'Key': s3_key(user_id, name + suffix)}
+            for name in names.values()
+            for suffix in ('.annot', '.counts.json')]})
+    except ClientError as e:
+        print(e)
+
+
+if __name__ == '__main__':
+    if (len(sys.argv) > 2) and (sys.argv[1] == 'split'):
+        with run.Timer():
+            split_job(sys.argv[2], sys.argv[3], sys.argv[4], sys.argv[5],
+                sys.argv[6],
+                regions_file=sys.argv[7] if (len(sys.argv) > 7) and \
+                    sys.argv[7] else None,
+                tracks=sys.argv[8].split(",") if (len(sys.argv) > 8) \
+                    else None)
+            os.remove(sys.argv[2])
+            if os.path.exists(sys.argv[2] + regions.INDEX_EXT):
+                os.remove(sys.argv[2] + regions.INDEX_EXT)
+            if (len(sys.argv) > 7) and sys.argv[7]:
+                os.remove(sys.argv[7])
+    elif (len(sys.argv) > 2) and (sys.argv[1] == 'annotate'):
+        with run.Timer():
+            with open(sys.argv[2]) as fh:
+                message = json.load(fh)
+            os.remove(sys.argv[2])
+            annotate_job(message, config.get("ann", "path"))
+    else:
+        print("Usage: affinity.py split <input> <path> <user> <job> " + \
+            "<file> [<regions>] [<tracks>] | affinity.py annotate <message>")
+
+### EOF
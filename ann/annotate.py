@@ -10,11 +10,28 @@
 ##
 __author__ = 'Vas Vasiliadis <vas@uchicago.edu>'
 
+import sys
+import functools
+import time
+from bisect import bisect_left, bisect_right
 import file_utils as fu
 import utils as u
+import engine
+import intervals
+import backends
+from record import Record
 
 indicesKnownGenes=[12, 1, 3] #12 for gene
 
+# Number of variants resolved by a single dbSNP query
+DBSNP_BATCH_SIZE = 1000
+
+# Number of parsed refGene transcripts kept by transcriptModel()
+TRANSCRIPT_CACHE_SIZE = 8192
+
+# cpgIslandExt columns returned for a putative promoter region
+ISLAND_COLUMNS = ['chrom', 'chromStart', 'chromEnd', 'name']
+
 def collapseGeneNames(row, indices, region, cnt):
     names = ['bin', 'name', 'chrom', 'transcriptStrand', 'txStart', 'txEnd', 
         'cdsStart', 'cdsEnd', 'exonCount', 'exonStarts', 'exonEnds', 'score',
@@ -80,6 +97,28 @@ def clean_mysql_chars(entry):
     return str(entry)
 
 
+"""Normalizes a string the way MySQL's default collation, and so every
+backend, compares it (see backends.fold())
+"""
+def foldSqlString(entry):
+    return str(backends.fold(entry))
+
+
+"""True if the text is a plain integer, as VCF positions are
+"""
+def isNumeric(entry):
+    entry = str(entry)
+    return entry.isascii() and entry.isdigit()
+
+
+"""A position as the backends take it: an integer when it is one
+"""
+def coordinate(pos):
+    if isNumeric(pos):
+        return int(pos)
+    return pos
+
+
 def getFormatSpecificIndices(format='vcf'):
     chr_ind = 0
     pos_ind = 1
@@ -93,103 +132,591 @@ def getFormatSpecificIndices(format='vcf'):
     return [chr_ind, pos_ind, ref_ind, alt_ind]
 
 
-def getComplementary(nuc):
-    compNuc = ''
-    if (str(nuc) == 'A'):
-        return 'T'
-    elif (str(nuc) == 'T'):
-        return 'A'
-    elif (str(nuc) == 'G'):
-        return 'C'
-    elif (str(nuc) == 'C'):
-        return 'G'
-    else:
-        return compNuc
+COMPLEMENTS = {'A': 'T', 'T': 'A', 'G': 'C', 'C': 'G'}
 
 
-""""Format must be pileup or vcf
-    Types of variants in dbSNP135: DIV, SNV, MNV, MIXED
-""" 
-def getSnpsFromDbSnp(vcf, format='vcf', tmpextin='', tmpextout='.1',
-    varclass='SNV', sep='\t'):
-    
-    outfile = vcf + tmpextout
-    fh_out = open(outfile, "w")
-    logcountfile = vcf + '.count.log'
-    fh_log = open(logcountfile, 'w')
-    var_count = 0
+def getComplementary(nuc):
+    return COMPLEMENTS.get(str(nuc), '')
 
-    inds = getFormatSpecificIndices(format=format)
 
-    fh = open(vcf)
-    conn = u.db_connect()
-    cursor = conn.cursor()
-    linenum = 1
+# Chromosome names seen in this process, each with its interned forms
+# without and with the chr prefix
+_chromosomes = {}
 
-    for line in fh:
-        line = line.strip()
-        if not line.startswith("#"):
-            fields = line.split(sep)
-            chr = fields[inds[0]].strip()
-            if chr.startswith("chr"):
-                chr = chr.replace('chr', '')
+# Column indices of each format, shared by the stages so a Variant can
+# tell by identity which columns it was taken from
+_indices = {}
 
-            pos = fields[inds[1]].strip()
-            ref = clean_mysql_chars(fields[inds[2]]).strip()
-            alt = clean_mysql_chars(fields[inds[3]]).strip()
 
-            compRef = getComplementary(ref)
-            compAlt = getComplementary(alt)
+"""Interned forms of a chromosome name without and with the chr prefix,
+as dbSNP and the gene tables and as the UCSC tables name it
+"""
+def chromosome(name):
+    forms = _chromosomes.get(name)
+    if forms is None:
+        bare = name.replace('chr', '') if name.startswith('chr') else name
+        prefixed = name if name.startswith('chr') else 'chr' + name
+        forms = (sys.intern(bare), sys.intern(prefixed))
+        _chromosomes[name] = forms
+    return forms
+
+
+"""An allele as the stages look it up: stripped and cleaned with
+clean_mysql_chars(), which most alleles need not go through
+"""
+def clean_allele(allele):
+    if ('"' in allele) or ("'" in allele):
+        allele = clean_mysql_chars(allele)
+    return allele.strip()
 
-            sql = 'select * from dbSNP where CHR="' + str(chr) + \
-                '" AND POS=' + str(pos) + ' AND ( REF="' + str(ref) + \
-                '" OR REF ="' + str(compRef) + '" )  AND INFO = "' + \
-                varclass + '" ;'
-            cursor.execute(sql)
-            rows = cursor.fetchall()
 
-            fields[2] = '.'
-            rsids = []
-            mafs = []
-            if (len(rows) > 0):
-                for row in rows:
-                    rsids.append(str(row[3]))
-                    if (str(row[7]) != '.'):
-                        mafs.append('GMAF=' + str(row[7]))
+"""A record's variant, normalized once for all the stages
+
+chrom is the chromosome without the chr prefix and chr with it, both
+interned (see chromosome()). pos is the position, an integer when it is
+one; site and bare_site pair it with chr and chrom, as the overlap stages
+key their lookups. ref and alt are the alleles cleaned of the characters
+MySQL does not accept, and comp_ref and comp_alt their complements; all
+four are None when the line stops before the allele columns.
+"""
+class Variant(object):
+    __slots__ = ('inds', 'chrom', 'chr', 'pos', 'site', 'bare_site', 'ref',
+        'alt', 'comp_ref', 'comp_alt')
+
+    def __init__(self, fields, inds):
+        self.inds = inds
+        name = fields[inds[0]].strip()
+        self.chrom, self.chr = _chromosomes.get(name) or chromosome(name)
+        pos = fields[inds[1]].strip()
+        if pos.isascii() and pos.isdigit():
+            pos = int(pos)
+        self.pos = pos
+        self.site = (self.chr, pos)
+        self.bare_site = (self.chrom, pos)
+        self.ref = None
+        self.alt = None
+        self.comp_ref = None
+        self.comp_alt = None
+        if (len(fields) > max(inds[2], inds[3])):
+            self.ref = clean_allele(fields[inds[2]])
+            self.alt = clean_allele(fields[inds[3]])
+            self.comp_ref = COMPLEMENTS.get(self.ref, '')
+            self.comp_alt = COMPLEMENTS.get(self.alt, '')
+
+    """Raises IndexError, as taking the alleles from the fields did, when
+    the line has no allele columns
+    """
+    def alleles(self):
+        if self.ref is None:
+            raise IndexError("No allele columns")
+        return (self.ref, self.alt, self.comp_ref, self.comp_alt)
+
+
+"""Cursor counting the queries a stage runs and the rows it fetches
+"""
+class MeteredCursor(object):
+
+    def __init__(self, cursor, stage):
+        self._cursor = cursor
+        self.stage = stage
+
+    def execute(self, *args):
+        self.stage.queries = self.stage.queries + 1
+        return self._cursor.execute(*args)
+
+    def fetchone(self):
+        row = self._cursor.fetchone()
+        if row is not None:
+            self.stage.rows_fetched = self.stage.rows_fetched + 1
+        return row
+
+    def fetchall(self):
+        rows = self._cursor.fetchall()
+        self.stage.rows_fetched = self.stage.rows_fetched + len(rows)
+        return rows
+
+    def __getattr__(self, name):
+        return getattr(self._cursor, name)
+
+
+"""Base class for a streaming annotation stage
+
+A stage annotates a batch of VCF records (see record.py): key() picks
+what the stage looks up from the record's Variant, lookup() resolves that key
+against the reference data through backend (see backends.py) and apply()
+writes the result into the record. Stages that can resolve many keys at once
+override lookup_many(). Counters collected along the way are written to
+the count log by report() once the whole file has been processed; the
+attributes named in counters can be merged across stages that annotated
+different parts of a file.
+
+reads names the columns key() depends on and writes the columns apply()
+changes; VARIANT stands for the variant NormalizeStage takes from CHROM,
+POS, REF and ALT. A stage's lookups only have to wait for earlier stages that
+write a column it reads; apply() always runs in stage order, so it may
+use anything an earlier stage wrote.
+
+Keys repeated within a batch are looked up once. With a variant cache
+(see variant_cache.py) set as cache, lookup results are also kept across
+jobs under cache_id() and the key. The lookup counters kept by every
+stage are listed in lookup_counters, and metric_counters holds what the
+stage cost: records annotated, queries run, rows fetched, and the wall
+clock and CPU time spent opening the stage, looking up and applying.
+"""
+class Stage(object):
+    label = ''
+    log_mode = 'a'
+    echo = False
+    counters = ()
+    lookup_counters = ('lookups', 'distinct_lookups', 'cache_hits',
+        'cache_misses')
+    metric_counters = ('variants', 'queries', 'rows_fetched', 'wall_time',
+        'cpu_time')
+    reads = ('VARIANT',)
+    writes = ('INFO',)
+    cache = None
+
+    def __init__(self, format='vcf', sep='\t'):
+        if format not in _indices:
+            _indices[format] = tuple(getFormatSpecificIndices(format=format))
+        self.inds = _indices[format]
+        self.sep = sep
+        self.conn = None
+        self._cursor = None
+        self._backend = None
+        self.lookups = 0
+        self.distinct_lookups = 0
+        self.cache_hits = 0
+        self.cache_misses = 0
+        self.variants = 0
+        self.queries = 0
+        self.rows_fetched = 0
+        self.wall_time = 0.0
+        self.cpu_time = 0.0
+
+    def open(self):
+        pass
+
+    """Cursor on the reference database, connected on first use
+    """
+    def connect(self):
+        if self._cursor is None:
+            self.conn = u.db_connect()
+            self._cursor = MeteredCursor(self.conn.cursor(), self)
+        return self._cursor
+
+    @property
+    def cursor(self):
+        return self.connect()
+
+    """Reference data backend, running its queries on the stage's cursor
+    """
+    @property
+    def backend(self):
+        if self._backend is None:
+            self._backend = backends.make(self.connect)
+        return self._backend
+
+    """Hands the connection back to the pool between batches
+    """
+    def release(self):
+        if self.conn is not None:
+            self.conn.close()
+        self.conn = None
+        self._cursor = None
+
+    def close(self):
+        self.release()
+
+    def is_header(self, line):
+        return line.startswith('##') or line.startswith('#CHROM') or \
+            line.startswith('CHROM')
+
+    def lookup_many(self, keys):
+        return [self.lookup(key) for key in keys]
+
+    """The record's Variant, normalized on first use and kept with the
+    record for the stages after
+    """
+    def variant(self, record):
+        variant = record.variant
+        if (variant is None) or (variant.inds is not self.inds):
+            variant = Variant(record.fields, self.inds)
+            record.variant = variant
+        return variant
+
+    """Keys of the records, taken from their variants
+    """
+    def keys(self, records):
+        inds = self.inds
+        key = self.key
+        keys = []
+        for record in records:
+            variant = record.variant
+            if (variant is None) or (variant.inds is not inds):
+                variant = self.variant(record)
+            keys.append(key(variant))
+        return keys
+
+    """Wall clock and CPU time of the calling thread, to charge() later
+    """
+    def timer(self):
+        return (time.perf_counter(), time.thread_time())
+
+    """Adds the time since timer() returned started to the stage
+    """
+    def charge(self, started):
+        self.wall_time = self.wall_time + time.perf_counter() - started[0]
+        self.cpu_time = self.cpu_time + time.thread_time() - started[1]
+
+    """Data records of a batch
+    """
+    def parse(self, records):
+        return [record for record in records if not self.is_header(record)]
+
+    """Identifies the stage's lookups in the variant cache
+    """
+    def cache_id(self):
+        return (type(self).__name__, getattr(self, 'table', None))
+
+    def uses_cache(self):
+        return self.cache is not None
+
+    """Results for the keys of a batch, each distinct key resolved once
+    """
+    def resolve(self, keys):
+        started = self.timer()
+        distinct = list(dict.fromkeys(keys))
+        self.lookups = self.lookups + len(keys)
+        self.distinct_lookups = self.distinct_lookups + len(distinct)
+
+        found = {}
+        missing = distinct
+        if self.uses_cache():
+            found = self.cache.get_many(self.cache_id(), distinct)
+            missing = [key for key in distinct if key not in found]
+            self.cache_hits = self.cache_hits + len(distinct) - len(missing)
+            self.cache_misses = self.cache_misses + len(missing)
+
+        if (len(missing) > 0):
+            try:
+                fresh = dict(zip(missing, self.lookup_many(missing)))
+            finally:
+                self.release()
+            if self.uses_cache():
+                self.cache.put_many(self.cache_id(), fresh)
+            found.update(fresh)
+
+        self.charge(started)
+        return [found[key] for key in keys]
+
+    """Resolves the keys of a batch ahead of process(), typically on a
+    worker thread while earlier stages are still applied
+    Returns a dict from key to result. Records whose key cannot be taken
+    are left for process() to deal with.
+    """
+    def prefetch(self, records):
+        keys = []
+        for record in self.parse(records):
+            try:
+                keys.append(self.key(self.variant(record)))
+            except IndexError:
+                pass
+        return dict(zip(keys, self.resolve(keys)))
+
+    """Annotates a batch of records in place; keys found in prefetched are
+    not looked up again
+    Records split on another separator are split again on the stage's.
+    """
+    def process(self, records, prefetched=None):
+        started = self.timer()
+        if any([record.sep != self.sep for record in records]):
+            records = [Record(record.line(), self.sep) for record in records]
+        data = self.parse(records)
+        keys = self.keys(data)
+        self.charge(started)
+
+        if prefetched is None:
+            results = self.resolve(keys)
+        else:
+            missing = [key for key in keys if key not in prefetched]
+            if (len(missing) > 0):
+                prefetched = dict(prefetched)
+                prefetched.update(zip(missing, self.resolve(missing)))
+            results = [prefetched[key] for key in keys]
+
+        started = self.timer()
+        for record, result in zip(data, results):
+            self.apply(record, result)
+        self.variants = self.variants + len(data)
+        self.charge(started)
+        return records
+
+    def counts(self):
+        return dict([(name, getattr(self, name)) for name in
+            self.counters + self.lookup_counters + self.metric_counters])
+
+    """Adds the counts() of a stage that annotated another part of the file
+    """
+    def merge(self, counts):
+        for name in self.counters + self.lookup_counters + \
+            self.metric_counters:
+            setattr(self, name, getattr(self, name) + counts[name])
+
+    def report(self):
+        return None
+
+    """Names the progress output reports done, one line each
+    """
+    def progress(self):
+        return [self.label]
+
+
+"""Front stage normalizing the variant of every record once (see
+Variant), for the stages after it to take their keys from
+A line too short to normalize is left for the stages to fail on, as they
+did before; stages reading other lines as records normalize them on first
+use.
+"""
+class NormalizeStage(Stage):
+    label = 'Normalize'
+    reads = ('CHROM', 'POS', 'REF', 'ALT')
+    writes = ('VARIANT',)
+
+    """Annotates nothing, so reports no progress
+    """
+    def progress(self):
+        return []
+
+    def is_header(self, line):
+        return line.startswith("#")
+
+    def prefetch(self, records):
+        return {}
+
+    def process(self, records, prefetched=None):
+        started = self.timer()
+        if any([record.sep != self.sep for record in records]):
+            records = [Record(record.line(), self.sep) for record in records]
+        data = self.parse(records)
+        for record in data:
+            try:
+                self.variant(record)
+            except IndexError:
+                pass
+        self.variants = self.variants + len(data)
+        self.charge(started)
+        return records
+
+
+"""Base class for stages that overlap the variant position with a table
+"""
+class OverlapStage(Stage):
+    chrom_column = 'chrom'
+    start_column = 'chromStart'
+    end_column = 'chromEnd'
+    counters = ('var_count', 'line_count')
+
+    def __init__(self, format='vcf', table='', sep='\t', use_index=False,
+        sweep=False):
+        Stage.__init__(self, format=format, sep=sep)
+        self.table = table
+        if not self.label:
+            self.label = table
+        self.use_index = use_index
+        self.sweep = sweep
+        self.index = None
+        self.var_count = 0
+        self.line_count = 0
+
+    def open(self):
+        Stage.open(self)
+        if self.use_index:
+            try:
+                self.index = intervals.get_index(self.connect, self.table,
+                    self.chrom_column, self.start_column, self.end_column)
+            finally:
+                self.release()
+            if self.sweep:
+                self.index = intervals.Sweep(self.index)
+
+    """Lookups answered from an in-memory index are cheaper than the cache
+    """
+    def uses_cache(self):
+        return Stage.uses_cache(self) and (self.index is None)
+
+    """Rows covering the position, from the in-memory interval index (or
+    the sweep over it, for sorted input)
+    Returns None when the stage has no index, the index does not hold the
+    chromosome (see intervals.set_chromosomes()) or pos is not an integer.
+    """
+    def indexed(self, chr, pos):
+        if (self.index is None) or not isNumeric(pos) or \
+            not intervals.held(chr):
+            return None
+        return self.index.stab(chr, int(pos))
+
+    """Rows covering the position, from the index when the stage has one
+    and from the backend otherwise
+    """
+    def overlapping(self, chr, pos):
+        rows = self.indexed(chr, pos)
+        if rows is not None:
+            return rows
+        return self.backend.stabbing_query(self.table, str(chr),
+            coordinate(pos), chrom_column=self.chrom_column,
+            start_column=self.start_column, end_column=self.end_column)
+
+    def key(self, variant):
+        return variant.site
+
+    def report(self):
+        return [f"In {str(self.table)}: {str(self.var_count)} in " + \
+            f"{str(self.line_count)} variants\n"]
+
+
+"""First row of a result, as cursor.fetchone() would return it
+"""
+def first(rows):
+    if (len(rows) > 0):
+        return rows[0]
+    return None
 
-                maf_str=''
-                if (len(mafs) > 0):
-                    maf_str = ';' + ';'.join([str(x) for x in mafs])
 
-                var_count = var_count + 1
-                if (str(fields[7]) == '.'):
-                    fields[7] = 'DB' + maf_str
-                else:
-                    fields[7] = fields[7] + ';DB;VC=' + varclass + maf_str
+"""Runs a single stage over a file, as the stage functions below always did
+"""
+def runStage(stage, infile, outfile, logfile):
+    engine.annotate_file(infile, outfile, [stage], logfile=logfile)
 
-                fields[2] = str(';'.join(rsids))
-                l = '\t'.join([str(x) for x in fields])
-                fh_out.write(l + '\n')
 
+""""Format must be pileup or vcf
+    Types of variants in dbSNP135: DIV, SNV, MNV, MIXED
+""" 
+class DbSnpStage(Stage):
+    label = 'dbSNP'
+    log_mode = 'w'
+    counters = ('var_count', 'linenum')
+    writes = ('ID', 'INFO')
+
+    def __init__(self, format='vcf', varclass='SNV', sep='\t', batch_size=1):
+        Stage.__init__(self, format=format, sep=sep)
+        self.varclass = varclass
+        self.batch_size = batch_size
+        self.var_count = 0
+        self.linenum = 1
+
+    def is_header(self, line):
+        return line.startswith("#")
+
+    def cache_id(self):
+        return (type(self).__name__, self.varclass)
+
+    """linenum starts at 1 in every stage, so only one of the merged stages
+    contributes the extra line
+    """
+    def merge(self, counts):
+        counts = dict(counts)
+        counts['linenum'] = counts['linenum'] - 1
+        Stage.merge(self, counts)
+
+    def key(self, variant):
+        ref, alt, compRef, compAlt = variant.alleles()
+        return (variant.chrom, variant.pos, ref, compRef)
+
+    def lookup(self, key):
+        chr, pos, ref, compRef = key
+        return self.backend.point_lookup('dbSNP', [('CHR', str(chr)),
+            ('POS', coordinate(pos)), ('REF', [str(ref), str(compRef)]),
+            ('INFO', self.varclass)])
+
+    def lookup_many(self, keys):
+        if (self.batch_size <= 1):
+            return Stage.lookup_many(self, keys)
+
+        results = []
+        for i in range(0, len(keys), self.batch_size):
+            results.extend(self.lookup_batch(keys[i:i + self.batch_size]))
+        return results
+
+    """Resolves a batch of keys with one query
+
+    The query selects every varclass row at the batch's (CHR, POS) sites
+    whose REF is one of the batch's alleles or their complements. Rows are
+    then handed back to each key using the same CHR/POS/REF rules as the
+    single-variant query, compared the way every backend compares them
+    (case and trailing blanks are ignored). Keys with a non-numeric
+    position are looked up one at a time.
+    """
+    def lookup_batch(self, keys):
+        sites = []
+        refs = []
+        for chr, pos, ref, compRef in keys:
+            if isNumeric(pos):
+                sites.append((chr, int(pos)))
+                refs.extend([ref, compRef])
+
+        found = {}
+        if (len(sites) > 0):
+            sites = list(dict.fromkeys(sites))
+            refs = list(dict.fromkeys(refs))
+            rows = self.backend.point_lookup('dbSNP', [(('CHR', 'POS'), sites),
+                ('REF', refs), ('INFO', self.varclass)],
+                columns=['CHR', 'POS', 'REF', '*'])
+
+            for row in rows:
+                site = (foldSqlString(row[0]), int(row[1]))
+                found.setdefault(site, []).append(row)
+
+        results = []
+        for chr, pos, ref, compRef in keys:
+            if not isNumeric(pos):
+                results.append(self.lookup((chr, pos, ref, compRef)))
+                continue
+
+            alleles = [foldSqlString(ref), foldSqlString(compRef)]
+            rows = found.get((foldSqlString(chr), int(pos)), [])
+            results.append(tuple([row[3:] for row in rows
+                if foldSqlString(row[2]) in alleles]))
+        return results
+
+    def apply(self, record, rows):
+        record.set_field(2, '.')
+        self.linenum = self.linenum + 1
+        if (len(rows) > 0):
+            rsids = []
+            mafs = []
+            for row in rows:
+                rsids.append(str(row[3]))
+                if (str(row[7]) != '.'):
+                    mafs.append('GMAF=' + str(row[7]))
+
+            maf_str=''
+            if (len(mafs) > 0):
+                maf_str = ';' + ';'.join([str(x) for x in mafs])
+
+            self.var_count = self.var_count + 1
+            if (str(record.get_info()) == '.'):
+                record.set_info('DB' + maf_str)
             else:
-                ## reset rsid to "." - in case there was annotation from old release of dbSNP
-                fh_out.write('\t'.join([str(x) for x in fields]) + '\n')
+                record.add_info(';DB;VC=' + self.varclass + maf_str)
 
-            linenum = linenum + 1
+            record.set_field(2, str(';'.join(rsids)))
 
-        else:
-            fh_out.write(line + '\n')
+        ## rsid is reset to "." otherwise - in case there was annotation from old release of dbSNP
 
-    ratioInDbSnp = (var_count / float(linenum)) * 100
-    fh_log.write("## Please notice that all Isoforms were counted\n")
-    fh_log.write("## Numbers may exceed number of variants in the annotated file\n")
-    fh_log.write(f"Total: {str(linenum)}\n")
-    fh_log.write(f"In dbSNP: {str(var_count)} ({str(ratioInDbSnp)}%)\n")
-    fh_log.close()
+    def report(self):
+        ratioInDbSnp = (self.var_count / float(self.linenum)) * 100
+        return ["## Please notice that all Isoforms were counted\n",
+            "## Numbers may exceed number of variants in the annotated file\n",
+            f"Total: {str(self.linenum)}\n",
+            f"In dbSNP: {str(self.var_count)} ({str(ratioInDbSnp)}%)\n"]
 
-    conn.close()
-    fh.close()
-    fh_out.close()
+
+def getSnpsFromDbSnp(vcf, format='vcf', tmpextin='', tmpextout='.1',
+    varclass='SNV', sep='\t', batch_size=1):
+    
+    runStage(DbSnpStage(format=format, varclass=varclass, sep=sep,
+        batch_size=batch_size), vcf, vcf + tmpextout, vcf + '.count.log')
 
 
 """NOTE: all isoforms are collapsed in one record
@@ -197,116 +724,329 @@ def getSnpsFromDbSnp(vcf, format='vcf', tmpextin='', tmpextout='.1',
     2. chrom_pos_equal_nobase
     3. chrom_pos_unequal
 """
-def getBigRefGene(vcf, format='vcf', tmpextin='.1', tmpextout='.2', sep='\t'):
-    basefile = vcf
-    vcf = basefile + tmpextin
-    outfile = basefile + tmpextout
-    fh_out = open(outfile, "w")
-    inds = getFormatSpecificIndices(format=format)
-    fh = open(vcf)
-
-    conn = u.db_connect()
-    cursor = conn.cursor()
-    vcf_linenum = 1
-
-    for line in fh:
-        line = line.strip()
-        if not line.startswith("#"):
-            fields = line.split(sep)
-            chr = fields[inds[0]].strip()
-            if chr.startswith("chr"):
-                chr = chr.replace('chr', '')
-
-            pos = fields[inds[1]].strip()
-            ref = clean_mysql_chars(fields[inds[2]]).strip()
-            alt = clean_mysql_chars(fields[inds[3]]).strip()
-
-            compRef = getComplementary(ref)
-            compAlt = getComplementary(alt)
-
-            sql1 = 'select * from chrom_pos_equal_base where CHR="' + \
-                str(chr) + '" AND start = ' + str(pos) + \
-                ' AND ((haplotypeReference="' + str(ref) + \
-                '" AND haplotypeAlternate ="' + str(alt) + \
-                '") OR (haplotypeReference="' + str(compRef) + \
-                '" AND haplotypeAlternate ="' + str(compAlt) + '"));'
-
-            sql2 = 'select * from chrom_pos_equal_nobase where CHR="' + \
-                str(chr) + '" AND start = ' + str(pos) + ';'
-
-            sql3 = 'select * from chrom_pos_unequal where CHR="' + \
-                str(chr) + '" AND start <= ' + str(pos) + ' AND ' + \
-                str(pos) + ' <= end ;'
-
-            keep_going = True
-            cursor.execute(sql1)
-            rows = cursor.fetchall()
-
-            if (len(rows) > 0):
-                keep_going = False
-                m = set([])
-                for row in rows:
-                    m.add(collapseRefSeq('\t'.join([str(x) for x in row[1:len(row)] ])))
+class BigRefGeneStage(Stage):
+    label = 'BigRefGene'
+
+    def is_header(self, line):
+        return line.startswith("#")
+
+    def key(self, variant):
+        return (variant.chrom, variant.pos) + variant.alleles()
+
+    """The three tables are asked in one first_match(), which a database
+    backend answers with a single query; the rows of the first table with
+    a match win
+    """
+    def lookup(self, key):
+        chr, pos, ref, alt, compRef, compAlt = key
+        site = [('CHR', str(chr)), ('start', coordinate(pos))]
+
+        return self.backend.first_match([
+            ('point_lookup', {'table': 'chrom_pos_equal_base',
+                'match': site + [(('haplotypeReference', 'haplotypeAlternate'),
+                [(str(ref), str(alt)), (str(compRef), str(compAlt))])]}),
+            ('point_lookup', {'table': 'chrom_pos_equal_nobase',
+                'match': site}),
+            ('stabbing_query', {'table': 'chrom_pos_unequal',
+                'chrom': str(chr), 'pos': coordinate(pos),
+                'chrom_column': 'CHR', 'start_column': 'start',
+                'end_column': 'end'})])
+
+    def apply(self, record, rows):
+        if (len(rows) > 0):
+            m = set([])
+            for row in rows:
+                m.add(collapseRefSeq('\t'.join([str(x) for x in row[1:len(row)] ])))
+
+            record.add_info(';' + ';'.join(m))
+            if record.info_startswith(".;"):
+                record.set_info(record.get_info()[2:])
 
-                fields[7] = fields[7] + ';' + ';'.join(m)
-                if (str(fields[7]).startswith(".;")):
-                    fields[7] = str(fields[7]).replace('.;', '', 1)
 
-                l = '\t'.join([str(x) for x in fields])
-                fh_out.write(l + '\n')
+def getBigRefGene(vcf, format='vcf', tmpextin='.1', tmpextout='.2', sep='\t'):
+    runStage(BigRefGeneStage(format=format, sep=sep),
+        vcf + tmpextin, vcf + tmpextout, None)
 
-            if (keep_going):
-                cursor.execute(sql2)
-                rows = cursor.fetchall()
 
-                if (len(rows) > 0):
-                    keep_going = False
-                    m = set([])
-                    for row in rows:
-                        m.add(collapseRefSeq('\t'.join([str(x) for x in row[1:len(row)]])))
+"""True if the refGene row sends the position on to the cpgIslandExt lookup
+"""
+def isPromoterCandidate(row, pos, promoter_offset):
+    txtStart = int(row[4])
+    txtEnd = int(row[5])
+    cdsStart = int(row[6])
+    cdsEnd = int(row[7])
+    strand = str(row[3])
+
+    if (cdsStart == cdsEnd) or u.isBetween(pos, cdsStart, cdsEnd):
+        return False
+    if (u.isBetween(pos, txtStart - int(promoter_offset), txtStart) and
+        (strand == "+")):
+        return True
+    return (u.isBetween(pos, txtEnd, txtEnd + int(promoter_offset)) and
+        (strand == "-"))
+
+
+"""Exons of a refGene transcript, with their starts and ends parsed to int
+
+The strings are kept as well: when the exon lists do not parse, exons()
+falls back to converting them one exon at a time, failing on the same
+exon the per-row parsing used to fail on.
+"""
+class TranscriptModel(object):
+
+    def __init__(self, exonCount, exonStarts, exonEnds):
+        self.exonCount = exonCount
+        self.exonsSt = exonStarts.split(',')
+        self.exonsEn = exonEnds.split(',')
+        self.starts = None
+        self.ends = None
+        self.sorted = False
+        try:
+            starts = [int(x) for x in self.exonsSt[:exonCount]]
+            ends = [int(x) for x in self.exonsEn[:exonCount]]
+        except ValueError:
+            return
+        if (len(starts) == exonCount) and (len(ends) == exonCount):
+            self.starts = starts
+            self.ends = ends
+            self.sorted = \
+                all([starts[e] <= starts[e + 1] for e in range(exonCount - 1)]) \
+                and all([ends[e] <= ends[e + 1] for e in range(exonCount - 1)])
+
+    """Numbers (0-based, in transcript order) of the exons containing pos
+
+    With starts and ends both sorted, the exons with start <= pos form a
+    prefix and the exons with end >= pos a suffix of the list, so the
+    matching exons are found with two bisections.
+    """
+    def exons(self, pos):
+        if self.starts is None:
+            return [e for e in range(0, self.exonCount)
+                if u.isBetween(pos, int(self.exonsSt[e]), int(self.exonsEn[e]))]
+        if self.sorted:
+            return range(bisect_left(self.ends, pos),
+                bisect_right(self.starts, pos))
+        return [e for e in range(0, self.exonCount)
+            if u.isBetween(pos, self.starts[e], self.ends[e])]
+
+
+"""Parsed exons of a refGene row, shared by every variant that hits the
+same transcript
+"""
+@functools.lru_cache(maxsize=TRANSCRIPT_CACHE_SIZE)
+def transcriptModel(name, chrom, exonCount, exonStarts, exonEnds):
+    return TranscriptModel(exonCount, str(exonStarts.decode("utf-8")),
+        str(exonEnds.decode("utf-8")))
 
-                    fields[7] = fields[7] + ';' + ';'.join(m)
-                    if (str(fields[7]).startswith(".;")):
-                        fields[7] = str(fields[7]).replace('.;', '', 1)
-                    
-                    l = '\t'.join([str(x) for x in fields])
-                    fh_out.write(l + '\n')
 
-            if (keep_going):
-                cursor.execute(sql3)
-                rows = cursor.fetchall()
+"""Get information about location in gene structures
 
-                if (len(rows) > 0):
-                    keep_going = False
-                    m = set([])
-                    for row in rows:
-                        m.add(collapseRefSeq('\t'.join([str(x) for x in row[1:len(row)]])))
+With use_index, cpgIslandExt is kept in memory and the putative promoter
+lookups are answered from it instead of the database. When no transcript
+region matches, the stage adds a bare ';' for the cytoband stage to fill
+in (left as it is past the last band); separator=False, for runs without
+the cytoband track, adds nothing instead.
+"""
+class GenesStage(Stage):
+    label = 'Genes'
+    echo = True
+    counters = ('interGenic_count', 'cds_count', 'utr3_count', 'utr5_count',
+        'intronic_count', 'non_coding_intronic_count', 'exonic_count',
+        'non_coding_exonic_count', 'promoter_count')
+
+    def __init__(self, format='vcf', table='refGene', promoter_offset=500,
+        sep='\t', use_index=False, separator=True):
+        Stage.__init__(self, format=format, sep=sep)
+        self.table = table
+        self.promoter_offset = promoter_offset
+        self.use_index = use_index
+        self.separator = separator
+        self.islands = None
+
+        self.interGenic_count = 0
+        self.cds_count = 0
+        self.utr3_count = 0
+        self.utr5_count = 0
+        self.intronic_count = 0
+        self.non_coding_intronic_count = 0
+        self.exonic_count = 0
+        self.non_coding_exonic_count = 0
+        self.promoter_count = 0
+
+    """Reported as the driver always reported the refGene step done,
+    under the name of the BigRefGene step before it
+    """
+    def progress(self):
+        return ['BigRefGene']
+
+    def open(self):
+        Stage.open(self)
+        if self.use_index:
+            try:
+                self.islands = intervals.get_index(self.connect,
+                    'cpgIslandExt')
+            finally:
+                self.release()
+
+    def is_header(self, line):
+        return line.startswith("#")
+
+    def cache_id(self):
+        return (type(self).__name__, self.table, self.promoter_offset)
+
+    def key(self, variant):
+        return variant.site
+
+    """First cpgIslandExt island containing the position, as ISLAND_COLUMNS
+    """
+    def island(self, chr, pos):
+        if (self.islands is not None) and intervals.held(chr):
+            row = first(self.islands.stab(chr, pos))
+            if row is None:
+                return None
+            columns = self.islands.columns
+            return tuple([row[columns.index(c)] for c in ISLAND_COLUMNS])
+
+        return first(self.backend.stabbing_query('cpgIslandExt', str(chr),
+            pos, columns=ISLAND_COLUMNS))
+
+    """The cpgIslandExt lookup depends on the position only, so it is run
+    once per variant rather than once per overlapping transcript
+    """
+    def lookup(self, key):
+        chr, pos = key
+        promoter_offset = self.promoter_offset
+
+        # txStart - offset <= pos <= txEnd + offset
+        rows = self.backend.range_query(self.table, str(chr),
+            int(pos) - int(promoter_offset), int(pos) + int(promoter_offset),
+            start_column='txStart', end_column='txEnd')
+        island = None
+
+        if (len(rows) > 0):
+            pos = int(pos)
+            if any([isPromoterCandidate(row, pos, promoter_offset)
+                for row in rows]):
+                island = self.island(chr, pos)
+
+        return (rows, island)
+
+    def apply(self, record, result):
+        rows, island = result
+        info = []
+
+        if (len(rows) > 0):
+            info_field = clean_mysql_chars(record.get_info()).strip()
+            positionType = str(u.parse_field(info_field, 
+                'positionType', ';', '='))
+            pos = int(self.variant(record).pos)
+            promoter_offset = self.promoter_offset
+            cnt = 1
+            for row in rows:
+                #count location
+                if (positionType == 'intron'):
+                    self.intronic_count = self.intronic_count + 1
+                elif (positionType == 'non_coding_intron'):
+                    self.non_coding_intronic_count = self.non_coding_intronic_count + 1
+                elif (positionType == 'CDS'):
+                    self.cds_count = self.cds_count + 1
+                elif (positionType == 'non_coding_exon'):
+                    self.non_coding_exonic_count = self.non_coding_exonic_count + 1
+                elif (positionType == 'utr5'):
+                    self.utr5_count = self.utr5_count + 1
+                elif (positionType == 'utr3'):
+                    self.utr3_count = self.utr3_count + 1
+
+                txtStart = int(row[4])
+                txtEnd = int(row[5])
+                cdsStart = int(row[6])
+                cdsEnd = int(row[7])
+                exonCount = int(row[8])
+                model = transcriptModel(row[1], row[2], exonCount, row[9],
+                    row[10])
+                strand = str(row[3])
+
+                promoter_plus = txtStart - int(promoter_offset)
+                promoter_minus = txtEnd + int(promoter_offset)
+                region = ""
+                exons = []
+
+                if (cdsStart == cdsEnd):
+                    for e in model.exons(pos):
+                        exnum = e + 1
+                        if (strand == '-'):
+                            exnum = exonCount - e
+                        exons.append("non_coding_exon=" + "ex" + \
+                            str(exnum) + '/' + str(exonCount))
+                    if (len(exons) > 0):
+                        region = ";".join(exons)
+                elif (u.isBetween(pos, cdsStart, cdsEnd)):
+                    for e in model.exons(pos):
+                        exnum = e + 1
+                        if (strand == '-'):
+                            exnum = exonCount - e
+                        exons.append("exon=" +  "ex" + \
+                            str(exnum) + '/' + str(exonCount))
+                        self.exonic_count = self.exonic_count + 1
+                    if (len(exons) > 0):
+                        region = ";".join(exons)
+
+                elif (u.isBetween(pos, promoter_plus, txtStart) and 
+                    (strand == "+")):
+                    if (island is not None):
+                        region = 'putativePromoterRegion=' + \
+                            "".join(str(island[3]).split())
+                        self.promoter_count = self.promoter_count + 1
+
+                elif (u.isBetween(pos, txtEnd, promoter_minus) and (strand == "-")):
+                    if (island is not None):
+                        region = 'putativePromoterRegion=' +  \
+                            "".join(str(island[3]).split())
+                        self.promoter_count = self.promoter_count + 1
 
-                    fields[7] = fields[7] + ';' + ';'.join(m)
-                    if (str(fields[7]).startswith(".;")):
-                        fields[7] = str(fields[7]).replace('.;', '', 1)
+                else:
+                    region = ''
 
-                    l = '\t'.join([str(x) for x in fields])
-                    fh_out.write(l + '\n')
+                if (region != ''):
+                    info.append(collapseGeneNames(row=row, 
+                        indices=indicesKnownGenes, region=region, cnt=cnt))
 
-            if (keep_going):
-                fh_out.write(line + '\n')
+                cnt = cnt + 1
 
-            vcf_linenum = vcf_linenum + 1
+            str_info = ";".join(info)
+            if (str_info != '') or self.separator:
+                record.add_info(';' + str_info)
 
         else:
-            fh_out.write(line + '\n')
-
-    conn.close()
-    fh.close()
-    fh_out.close()
+            record.add_info(";positionType=interGenic")
+            self.interGenic_count = self.interGenic_count + 1
+
+    def report(self):
+        return ["Variants located:\n",
+            f"In interGenic {str(self.interGenic_count)}\n",
+            f"In CDS {str(self.cds_count)}\n",
+            f"In \'3 UTR {str(self.utr3_count)}\n",
+            f"In \'5 UTR {str(self.utr5_count)}\n",
+            f"In Intronic {str(self.intronic_count)}\n",
+            f"In Non_coding_intronic {str(self.non_coding_intronic_count)}\n",
+            f"In Exonic {str(self.exonic_count)}\n",
+            f"In Non_coding_exonic {str(self.non_coding_exonic_count)}\n",
+            f"In Putative Promoter Region {str(self.promoter_count)}\n"]
 
 
-"""Get information about location in gene structures
-"""
 def getGenes(vcf, format='vcf', table='refGene', promoter_offset=500, 
     tmpextin='.2', tmpextout='.3', sep='\t'):
     
+    runStage(GenesStage(format=format, table=table,
+        promoter_offset=promoter_offset, sep=sep),
+        vcf + tmpextin, vcf + tmpextout, vcf + '.count.log')
+
+
+"""Method used in INDELS, where bigRefGeneTable is not applicable
+"""
+def getExonsEtAl(vcf, format='vcf', table='refGene', promoter_offset=500, 
+    tmpextin='.2', tmpextout='.3', sep='\t'):
+
     basefile = vcf
     vcf = basefile + tmpextin
     outfile = basefile + tmpextout
@@ -336,10 +1076,10 @@ def getGenes(vcf, format='vcf', table='refGene', promoter_offset=500,
         if not line.startswith("#"):
             fields = line.split(sep)
             chr = fields[inds[0]].strip()
-
+            
             if not chr.startswith("chr"):
                 chr = "chr" + chr
-
+            
             pos = fields[inds[1]].strip()
             ref = clean_mysql_chars(fields[inds[2]]).strip()
             alt = clean_mysql_chars(fields[inds[3]]).strip()
@@ -347,41 +1087,22 @@ def getGenes(vcf, format='vcf', table='refGene', promoter_offset=500,
             this_gene_name = str(u.parse_field(info_field, 'name', ';', '='))
 
             sql = 'select * from ' + table + ' where chrom="' + str(chr) + \
-                '" AND (txStart - ' + str(promoter_offset) +') <= ' + \
+                '"   AND (txStart - ' + str(promoter_offset) + ') <= ' + \
                 str(pos) + ' AND ' + str(pos) + ' <= (txEnd + ' + \
                 str(promoter_offset) +');'
-
             cursor.execute(sql)
             rows = cursor.fetchall()
             info = []
-
             if (len(rows) > 0):
                 cnt = 1
                 for row in rows:
-                    #count location
-                    positionType = str(u.parse_field(info_field, 
-                        'positionType', ';', '='))
-                    
-                    if (positionType == 'intron'):
-                        intronic_count = intronic_count + 1
-                    elif (positionType == 'non_coding_intron'):
-                        non_coding_intronic_count = non_coding_intronic_count + 1
-                    elif (positionType == 'CDS'):
-                        cds_count = cds_count + 1
-                    elif (positionType == 'non_coding_exon'):
-                        non_coding_exonic_count = non_coding_exonic_count + 1
-                    elif (positionType == 'utr5'):
-                        utr5_count = utr5_count + 1
-                    elif (positionType == 'utr3'):
-                        utr3_count = utr3_count + 1
-
                     txtStart = int(row[4])
                     txtEnd = int(row[5])
                     cdsStart = int(row[6])
                     cdsEnd = int(row[7])
                     exonCount = int(row[8])
-                    exonStarts =str(row[9].decode("utf-8"))
-                    exonEnds = str(row[10].decode("utf-8"))
+                    exonStarts =str(row[9].decode('utf-8'))
+                    exonEnds = str(row[10].decode('utf-8'))
                     geneSymbol = str(row[12])
                     strand = str(row[3])
 
@@ -398,29 +1119,58 @@ def getGenes(vcf, format='vcf', table='refGene', promoter_offset=500,
                             if (u.isBetween(pos, int(exonsSt[e]), int(exonsEn[e]))):
                                 exnum = e + 1
                                 if (strand == '-'):
-                                    exnum = exonCount - e
+                                    exnum =  exonCount - e
                                 exons.append("non_coding_exon=" + "ex" + \
                                     str(exnum) + '/' + str(exonCount))
+                                non_coding_exonic_count = non_coding_exonic_count + 1
                         if (len(exons) > 0):
-                            region = ";".join(exons)
-                    elif (u.isBetween(pos, cdsStart, cdsEnd)):
+                            region='positionType=non_coding_exon;' + ";".join(exons)
+                        else:
+                            non_coding_intronic_count = non_coding_intronic_count + 1
+                            region = 'positionType=non_coding_intron'
+
+                    elif (u.isBetween(pos, cdsStart, cdsEnd) and (cdsStart < cdsEnd)):
+                        cds_count = cds_count + 1
                         for e in range(0, exonCount):
-                            if u.isBetween(pos, int(exonsSt[e]), int(exonsEn[e])):
+                            if (u.isBetween(pos, int(exonsSt[e]), int(exonsEn[e]))):
                                 exnum = e + 1
                                 if (strand == '-'):
-                                    exnum = exonCount - e
-                                exons.append("exon=" +  "ex" + \
+                                    exnum =  exonCount - e
+                                exons.append("exon=" + "ex" + \
                                     str(exnum) + '/' + str(exonCount))
-                                exonic_count = exonic_count + 1
+                                exonic_count=exonic_count+1
                         if (len(exons) > 0):
-                            region = ";".join(exons)
+                            region = 'positionType=CDS;' + ";".join(exons)
+                        else:
+                            intronic_count = intronic_count + 1
+                            region = 'positionType=CDS;' + 'intron'
+
+                    elif (u.isBetween(pos, txtStart, cdsStart) and \
+                        (cdsStart < cdsEnd) and (strand == "+")):
+                        utr5_count = utr5_count + 1
+                        region = 'positionType=utr5'
+
+                    elif (u.isBetween(pos, cdsEnd, txtEnd) and \
+                        (cdsStart < cdsEnd) (strand == "+")):
+                        utr3_count = utr3_count + 1
+                        region = 'positionType=utr3'
+
+                    elif (u.isBetween(pos, cdsEnd, txtEnd) and 
+                        (cdsStart < cdsEnd) (strand == "-")):
+                        utr5_count = utr5_count + 1
+                        region = 'positionType=utr5'
+
+                    elif (u.isBetween(pos, txtStart, cdsStart) and \
+                        (cdsStart < cdsEnd) and (strand == "-")):
+                        utr3_count = utr3_count + 1
+                        region = 'positionType=utr3'
 
-                    elif (u.isBetween(pos, promoter_plus, txtStart) and 
+                    elif (u.isBetween(pos, promoter_plus, txtStart) and \
                         (strand == "+")):
-                        sql = 'select chrom, chromStart, chromEnd, name from ' + \
-                            'cpgIslandExt where chrom="' + str(chr) + \
-                            '" AND (chromStart <= ' + str(pos) + \
-                            ' AND ' + str(pos) + ' <= chromEnd);'
+                        sql = 'select chrom, chromStart, chromEnd, name ' + \
+                            'from cpgIslandExt where chrom="' + str(chr) +  \
+                            '" AND (chromStart <= ' + str(pos) + ' AND ' + \
+                            str(pos) + ' <= chromEnd);'
                         cursor.execute(sql)
                         rows = cursor.fetchone()
 
@@ -429,25 +1179,27 @@ def getGenes(vcf, format='vcf', table='refGene', promoter_offset=500,
                                 "".join(str(rows[3]).split())
                             promoter_count = promoter_count + 1
 
-                    elif (u.isBetween(pos, txtEnd, promoter_minus) and (strand == "-")):
-                        sql = 'select chrom, chromStart, chromEnd, name from ' + \
-                            'cpgIslandExt where chrom="' + str(chr) + \
-                            '" AND (chromStart <= ' + str(pos) + \
-                            ' AND ' + str(pos) + ' <= chromEnd);'
+                    elif (u.isBetween(pos, txtEnd, promoter_minus) and \
+                        (strand == "-")):
+                        sql = 'select chrom, chromStart, chromEnd, name ' + \
+                            'from cpgIslandExt where chrom="' + str(chr) + \
+                            '" AND (chromStart <= ' + str(pos) + ' AND ' + \
+                            str(pos) + ' <= chromEnd);'
                         cursor.execute(sql)
-
                         rows = cursor.fetchone()
+
                         if (rows is not None):
-                            region = 'putativePromoterRegion=' +  \
-                                "".join(str(rows[3]).split())
+                            region = 'putativePromoterRegion=' + \
+                            "".join(str(rows[3]).split())
                             promoter_count = promoter_count + 1
 
                     else:
                         region = ''
 
                     if (region != ''):
-                        info.append(collapseGeneNames(row=row, 
-                            indices=indicesKnownGenes, region=region, cnt=cnt))
+                        info.append(collapseGeneNames(
+                            row=row, indices=indicesKnownGenes, 
+                            region=region, cnt=cnt))
 
                     cnt = cnt + 1
 
@@ -481,7 +1233,7 @@ def getGenes(vcf, format='vcf', table='refGene', promoter_offset=500,
     fh_log.write(f"In \'5 UTR {str(utr5_count)}\n")
 
     print(f"In Intronic {str(intronic_count)}")
-    fh_log.write(f"In Intronic {str(intronic_count)}\n")
+    fh_log.write(f"In Intronic "+str(intronic_count) +'\n')
 
     print(f"In Non_coding_intronic {str(non_coding_intronic_count)}")
     fh_log.write(f"In Non_coding_intronic {str(non_coding_intronic_count)}\n")
@@ -501,611 +1253,190 @@ def getGenes(vcf, format='vcf', table='refGene', promoter_offset=500,
     conn.close()
 
 
-"""Method used in INDELS, where bigRefGeneTable is not applicable
+"""Overlap with tfbsConsSites
 """
-def getExonsEtAl(vcf, format='vcf', table='refGene', promoter_offset=500, 
-    tmpextin='.2', tmpextout='.3', sep='\t'):
+class TfbsConsSitesStage(OverlapStage):
+    label = 'addOverlapWithTfbsConsSites'
 
-    basefile = vcf
-    vcf = basefile + tmpextin
-    outfile = basefile + tmpextout
-    fh_out = open(outfile, "w")
+    allowed_chrom=['1','2','3','4','5','6','7','8','9','10','11','12','13',
+        '14','15','16','17','18','19','20','21','22','X','Y']
 
-    logcountfile = basefile + '.count.log'
-    fh_log = open(logcountfile, 'a')
+    def __init__(self, format='vcf', table='tfbsConsSites', sep='\t'):
+        OverlapStage.__init__(self, format=format, table=table, sep=sep)
 
-    interGenic_count = 0
-    cds_count = 0
-    utr3_count = 0
-    utr5_count = 0
-    intronic_count = 0
-    non_coding_intronic_count = 0
-    exonic_count = 0
-    non_coding_exonic_count = 0
-    promoter_count = 0
+    def lookup(self, key):
+        chr, pos = key
+        # For some reason this table has no "chr" preceeding number
+        chrIndex = chr.replace('chr', '')
 
-    inds = getFormatSpecificIndices(format=format)
-    fh = open(vcf)
-    conn = u.db_connect()
-    cursor = conn.cursor()
-    linenum = 1
+        if (chrIndex not in self.allowed_chrom):
+            return []
 
-    for line in fh:
-        line = line.strip()
-        if not line.startswith("#"):
-            fields = line.split(sep)
-            chr = fields[inds[0]].strip()
-            
-            if not chr.startswith("chr"):
-                chr = "chr" + chr
-            
-            pos = fields[inds[1]].strip()
-            ref = clean_mysql_chars(fields[inds[2]]).strip()
-            alt = clean_mysql_chars(fields[inds[3]]).strip()
-            info_field = clean_mysql_chars(fields[7]).strip()
-            this_gene_name = str(u.parse_field(info_field, 'name', ';', '='))
+        return self.backend.stabbing_query('tfbsConsSites' + chrIndex, None,
+            coordinate(pos), columns=['chrom', 'chromStart', 'chromEnd', 'name'])
 
-            sql = 'select * from ' + table + ' where chrom="' + str(chr) + \
-                '"   AND (txStart - ' + str(promoter_offset) + ') <= ' + \
-                str(pos) + ' AND ' + str(pos) + ' <= (txEnd + ' + \
-                str(promoter_offset) +');'
-            cursor.execute(sql)
-            rows = cursor.fetchall()
-            info = []
-            if (len(rows) > 0):
-                cnt = 1
-                for row in rows:
-                    txtStart = int(row[4])
-                    txtEnd = int(row[5])
-                    cdsStart = int(row[6])
-                    cdsEnd = int(row[7])
-                    exonCount = int(row[8])
-                    exonStarts =str(row[9].decode('utf-8'))
-                    exonEnds = str(row[10].decode('utf-8'))
-                    geneSymbol = str(row[12])
-                    strand = str(row[3])
+    def apply(self, record, rows):
+        if (len(rows) == 0):
+            return
 
-                    promoter_plus = txtStart - int(promoter_offset)
-                    promoter_minus = txtEnd + int(promoter_offset)
-                    region = ""
-                    pos = int(pos)
-                    exons = []
-                    exonsSt = exonStarts.split(',')
-                    exonsEn = exonEnds.split(',')
-
-                    if (cdsStart == cdsEnd):
-                        for e in range(0, exonCount):
-                            if (u.isBetween(pos, int(exonsSt[e]), int(exonsEn[e]))):
-                                exnum = e + 1
-                                if (strand == '-'):
-                                    exnum =  exonCount - e
-                                exons.append("non_coding_exon=" + "ex" + \
-                                    str(exnum) + '/' + str(exonCount))
-                                non_coding_exonic_count = non_coding_exonic_count + 1
-                        if (len(exons) > 0):
-                            region='positionType=non_coding_exon;' + ";".join(exons)
-                        else:
-                            non_coding_intronic_count = non_coding_intronic_count + 1
-                            region = 'positionType=non_coding_intron'
-
-                    elif (u.isBetween(pos, cdsStart, cdsEnd) and (cdsStart < cdsEnd)):
-                        cds_count = cds_count + 1
-                        for e in range(0, exonCount):
-                            if (u.isBetween(pos, int(exonsSt[e]), int(exonsEn[e]))):
-                                exnum = e + 1
-                                if (strand == '-'):
-                                    exnum =  exonCount - e
-                                exons.append("exon=" + "ex" + \
-                                    str(exnum) + '/' + str(exonCount))
-                                exonic_count=exonic_count+1
-                        if (len(exons) > 0):
-                            region = 'positionType=CDS;' + ";".join(exons)
-                        else:
-                            intronic_count = intronic_count + 1
-                            region = 'positionType=CDS;' + 'intron'
-
-                    elif (u.isBetween(pos, txtStart, cdsStart) and \
-                        (cdsStart < cdsEnd) and (strand == "+")):
-                        utr5_count = utr5_count + 1
-                        region = 'positionType=utr5'
-
-                    elif (u.isBetween(pos, cdsEnd, txtEnd) and \
-                        (cdsStart < cdsEnd) (strand == "+")):
-                        utr3_count = utr3_count + 1
-                        region = 'positionType=utr3'
-
-                    elif (u.isBetween(pos, cdsEnd, txtEnd) and 
-                        (cdsStart < cdsEnd) (strand == "-")):
-                        utr5_count = utr5_count + 1
-                        region = 'positionType=utr5'
-
-                    elif (u.isBetween(pos, txtStart, cdsStart) and \
-                        (cdsStart < cdsEnd) and (strand == "-")):
-                        utr3_count = utr3_count + 1
-                        region = 'positionType=utr3'
-
-                    elif (u.isBetween(pos, promoter_plus, txtStart) and \
-                        (strand == "+")):
-                        sql = 'select chrom, chromStart, chromEnd, name ' + \
-                            'from cpgIslandExt where chrom="' + str(chr) +  \
-                            '" AND (chromStart <= ' + str(pos) + ' AND ' + \
-                            str(pos) + ' <= chromEnd);'
-                        cursor.execute(sql)
-                        rows = cursor.fetchone()
-
-                        if (rows is not None):
-                            region = 'putativePromoterRegion=' + \
-                                "".join(str(rows[3]).split())
-                            promoter_count = promoter_count + 1
-
-                    elif (u.isBetween(pos, txtEnd, promoter_minus) and \
-                        (strand == "-")):
-                        sql = 'select chrom, chromStart, chromEnd, name ' + \
-                            'from cpgIslandExt where chrom="' + str(chr) + \
-                            '" AND (chromStart <= ' + str(pos) + ' AND ' + \
-                            str(pos) + ' <= chromEnd);'
-                        cursor.execute(sql)
-                        rows = cursor.fetchone()
-
-                        if (rows is not None):
-                            region = 'putativePromoterRegion=' + \
-                            "".join(str(rows[3]).split())
-                            promoter_count = promoter_count + 1
-
-                    else:
-                        region = ''
-
-                    if (region != ''):
-                        info.append(collapseGeneNames(
-                            row=row, indices=indicesKnownGenes, 
-                            region=region, cnt=cnt))
-
-                    cnt = cnt + 1
-
-                str_info = ";".join(info)
-                fields[7] = fields[7] + ';' + str_info
-                fh_out.write('\t'.join(fields) + '\n')
-
-            else:
-                fields[7] = fields[7] + ";positionType=interGenic"
-                fh_out.write('\t'.join(fields) + '\n')
-                interGenic_count = interGenic_count + 1
-
-            linenum = linenum + 1
-
-        else:
-            fh_out.write(line + '\n')
-
-    print("Variants located:")
-    fh_log.write("Variants located:\n")
-
-    print(f"In interGenic {str(interGenic_count)}")
-    fh_log.write(f"In interGenic {str(interGenic_count)}\n")
-
-    print(f"In CDS {str(cds_count)}")
-    fh_log.write(f"In CDS {str(cds_count)}\n")
-
-    print(f"In \'3 UTR {str(utr3_count)}")
-    fh_log.write(f"In \'3 UTR {str(utr3_count)}\n")
-
-    print(f"In \'5 UTR {str(utr5_count)}")
-    fh_log.write(f"In \'5 UTR {str(utr5_count)}\n")
-
-    print(f"In Intronic {str(intronic_count)}")
-    fh_log.write(f"In Intronic "+str(intronic_count) +'\n')
-
-    print(f"In Non_coding_intronic {str(non_coding_intronic_count)}")
-    fh_log.write(f"In Non_coding_intronic {str(non_coding_intronic_count)}\n")
-
-    print(f"In Exonic {str(exonic_count)}")
-    fh_log.write(f"In Exonic {str(exonic_count)}\n")
-
-    print(f"In Non_coding_exonic {str(non_coding_exonic_count)}")
-    fh_log.write(f"In Non_coding_exonic {str(non_coding_exonic_count)}\n")
-
-    print(f"In Putative Promoter Region {str(promoter_count)}")
-    fh_log.write(f"In Putative Promoter Region {str(promoter_count)}\n")
-
-    fh_out.close()
-    fh_log.close()
-    fh.close()
-    conn.close()
-
-
-"""Overlap with tfbsConsSites
-"""
-def addOverlapWithTfbsConsSites(vcf, format='vcf', table='tfbsConsSites', 
-    tmpextin='.2', tmpextout='.3', sep='\t'):
-
-    allowed_chrom=['1','2','3','4','5','6','7','8','9','10','11','12','13',
-        '14','15','16','17','18','19','20','21','22','X','Y']
-
-    basefile = vcf
-    vcf = basefile + tmpextin
-    outfile = basefile + tmpextout
-
-    fh_out = open(outfile, "w")
-    fh = open(vcf)
-
-    logcountfile = basefile + '.count.log'
-    fh_log = open(logcountfile, 'a')
-    var_count = 0
-    line_count = 0
-
-    inds = getFormatSpecificIndices(format=format)
-    conn = u.db_connect()
-    cursor = conn.cursor()
-
-    linenum = 1
-    for line in fh:
-        line = line.strip()
-        ## not comments
-        if (line.startswith("##")):
-            fh_out.write(line + '\n')
-
-        #header line
-        elif (line.startswith('#CHROM') or line.startswith('CHROM')):
-            fh_out.write(line + '\n')
-
-        else:
-            fields = line.split(sep)
-            chr = fields[inds[0]].strip()
-            # For some reason this table has no "chr" preceeding number
-            if not chr.startswith("chr"):
-                chr = "chr" + chr
-
-            pos=fields[inds[1]].strip()
-            isOverlap = False
-            chrIndex=chr.replace('chr', '')
-
-            if (chrIndex in allowed_chrom):
-                isOverlap = False
-                sql = 'select chrom, chromStart, chromEnd, name ' + \
-                    'from tfbsConsSites' + chrIndex + \
-                    ' where  chromStart <= ' + str(pos) + ' AND ' + \
-                    str(pos) + ' <= chromEnd;'
-                cursor.execute(sql)
-                rows = cursor.fetchall()
-                records = []
-
-                if (len(rows) > 0):
-                    records_count = 1
-                    line_count = line_count + 1
-
-                    for row in rows:
-                        var_count = var_count + 1
-                        t = str(row[3]) + '.' + str(row[0]) + '.' + \
-                            str(row[1]) + '.' + str(row[2])
-                        t = t.strip()
-                        records.append('tfbsRegion' + '=' + t)
-                        records_count = records_count + 1
-
-                    if str(fields[7]).endswith(';'):
-                        fields[7] = fields[7] + ';'.join(records)
-                    else:
-                        fields[7] = fields[7] + ';' + ';'.join(records)
-
-                    fh_out.write('\t'.join(fields) + '\n')
-
-                else: # chrom is not on the list
-                    fh_out.write(line + '\n')
-
-            else: # chrom is not on the list
-                fh_out.write(line + '\n')
-
-        linenum = linenum + 1
-
-    fh_log.write(f"In {str(table)}: {str(var_count)} in " + \
-        f"{str(line_count)} variants\n")
-    fh_log.close()
-
-    conn.close()
-    fh.close()
-    fh_out.close()
-
-
-"""Overlap with GadAll table
-"""
-def addOverlapWithGadAll(vcf, format='vcf', table='gadAll', tmpextin='', 
-    tmpextout='.1', sep='\t'):
-    
-    basefile = vcf
-    vcf = basefile + tmpextin
-    outfile = basefile + tmpextout
-
-    fh_out = open(outfile, "w")
-    fh = open(vcf)
-
-    logcountfile = basefile+'.count.log'
-    fh_log = open(logcountfile, 'a')
-    var_count = 0
-    line_count = 0
-
-    inds = getFormatSpecificIndices(format=format)
-    conn = u.db_connect()
-    cursor = conn.cursor()
-    linenum = 1
-
-    for line in fh:
-        line = line.strip()
-        ## not comments
-        if not line.startswith("##"):
-            #header line
-            if (line.startswith('CHROM') or line.startswith('#CHROM')):
-                fh_out.write(line + '\n')
-            else:
-                fields = line.split(sep)
-                chr = fields[inds[0]].strip()
-                # For some reason this table has no "chr" preceeding number
-                if chr.startswith("chr"):
-                    chr = str(chr).replace("chr", "")
-
-                pos = fields[inds[1]].strip()
-                isOverlap = False
-
-                sql = 'select * from ' + table + ' where chromosome="' + \
-                    str(chr) + '" AND (chromStart <= ' + str(pos) + \
-                    ' AND ' + str(pos) + ' <= chromEnd);'
-                cursor.execute(sql)
-                rows = cursor.fetchall()
-                records = []
-
-                if (len(rows) > 0):
-                    records_count = 1
-                    line_count = line_count + 1
-                    r_tmp = []
-                    for row in rows:
-                        var_count = var_count + 1
-                        if not fu.isOnTheList(r_tmp, str(row[3])):
-                            r_tmp.append(str(row[3]) )
-                            records.append(str(table) + '=' + str(row[3]))
-                            records_count = records_count + 1
-                    if str(fields[7]).endswith(';'):
-                        fields[7] = fields[7] + ';'.join(records)
-                    else:
-                        fields[7] = fields[7] + ';' + ';'.join(records)
-                    fh_out.write('\t '.join(fields) + '\n')
-                else:
-                    fh_out.write(line + '\n')
-
-            linenum = linenum + 1
-        else:
-            fh_out.write(line + '\n')
-
-    fh_log.write(f"In {str(table)}: {str(var_count)} in " + \
-        f"{str(line_count)} variants\n")
-    fh_log.close()
-
-    conn.close()
-    fh.close()
-    fh_out.close()
-
-
-""" Overlap with gwasCatalog table """
-def addOverlapWithGwasCatalog(vcf, format='vcf', table='gwasCatalog', \
-    tmpextin='', tmpextout='.1', sep='\t'):
-    
-    basefile = vcf
-    vcf = basefile + tmpextin
-    outfile = basefile + tmpextout
-
-    fh_out = open(outfile, "w")
-    fh = open(vcf)
-
-    logcountfile = basefile+'.count.log'
-    fh_log = open(logcountfile, 'a')
-    var_count = 0
-    line_count = 0
-
-    inds = getFormatSpecificIndices(format=format)
-    conn = u.db_connect()
-    cursor = conn.cursor()
-    linenum = 1
-
-    for line in fh:
-        line = line.strip()
-        ## not comments
-        if not line.startswith("##"):
-            #header line
-            if (line.startswith('CHROM') or line.startswith('#CHROM')):
-                fh_out.write(line + '\n')
-            else:
-                fields = line.split(sep)
-                chr = fields[inds[0]].strip()
-                if not chr.startswith("chr"):
-                    chr = "chr" + chr
-                
-                pos = fields[inds[1]].strip()
-                isOverlap = False
-
-                sql = 'select * from ' + table + ' where chrom="' + \
-                    str(chr) + '" AND chromEnd = ' + str(pos) + ';'
-                cursor.execute(sql)
-                rows = cursor.fetchall()
-                records = []
-
-                if (len(rows) > 0):
-                    line_count = line_count + 1
-                    records_count = 1
-                    for row in rows:
-                        var_count = var_count + 1
-                        records.append(str(table) + '=' + str('pubMedID') + \
-                            '=' + str(row[5]) + ',trait=' + str(row[10]))
-                        records_count = records_count + 1
-                    if str(fields[7]).endswith(';'):
-                        fields[7] = fields[7] + ';'.join(records)
-                    else:
-                        fields[7] = fields[7] + ';' + ';'.join(records)
-                    fh_out.write('\t'.join(fields) + '\n')
-                else:
-                    fh_out.write(line + '\n')
-
-            linenum = linenum + 1
-        else:
-            fh_out.write(line + '\n')
-
-    fh_log.write(f"In {str(table)}: {str(var_count)} in " + \
-        f"{str(line_count)} variants\n")
-    fh_log.close()
-
-    conn.close()
-    fh.close()
-    fh_out.close()
-
-
-"""Overlap with HUGO Gene Nomenclature Committee (HGNC) table
-"""
-def addOverlapWitHUGOGeneNomenclature(vcf, format='vcf', table='hugo', 
-    tmpextin='', tmpextout='.1', sep='\t'):
-    
-    basefile = vcf
-    vcf = basefile + tmpextin
-    outfile = basefile + tmpextout
-
-    fh_out = open(outfile, "w")
-    fh = open(vcf)
-
-    logcountfile = basefile + '.count.log'
-    fh_log = open(logcountfile, 'a')
-    var_count = 0
-    line_count = 0
-
-    inds = getFormatSpecificIndices(format=format)
-    conn = u.db_connect()
-    cursor = conn.cursor()
-    linenum = 1
-
-    for line in fh:
-        line = line.strip()
-        ## not comments
-        if not line.startswith("##"):
-            #header line
-            if (line.startswith('CHROM') or line.startswith('#CHROM')):
-                fh_out.write(line + '\n')
-            else:
-                fields = line.split(sep)
-                chr = fields[inds[0]].strip()
-                if not chr.startswith("chr"):
-                    chr = "chr" + chr
+        records = []
+        self.line_count = self.line_count + 1
+        for row in rows:
+            self.var_count = self.var_count + 1
+            t = str(row[3]) + '.' + str(row[0]) + '.' + \
+                str(row[1]) + '.' + str(row[2])
+            t = t.strip()
+            records.append('tfbsRegion' + '=' + t)
 
-                pos=fields[inds[1]].strip()
-                isOverlap = False
+        if record.info_endswith(';'):
+            record.add_info(';'.join(records))
+        else:
+            record.add_info(';' + ';'.join(records))
 
-                sql = 'select * from ' + table + ' where chrom="' + \
-                    str(chr) + '" AND (chromStart <= ' + str(pos) + \
-                    ' AND ' + str(pos) + ' <= chromEnd);'
-                cursor.execute(sql)
-                rows = cursor.fetchall()
-                records = []
 
-                if (len(rows) > 0):
-                    line_count = line_count + 1
-                    records_count = 1
-                    r_tmp = []
-                    for row in rows:
-                        var_count = var_count + 1
-                        t = str(str(row[5]) + ',' + str(row[6])).strip()
-                        if not fu.isOnTheList(r_tmp, t):
-                            r_tmp.append(t)
-                            records.append('HGNC_GeneAnnotation' + '=' + t)
-                        records_count = records_count + 1
+def addOverlapWithTfbsConsSites(vcf, format='vcf', table='tfbsConsSites', 
+    tmpextin='.2', tmpextout='.3', sep='\t'):
 
-                    records_str = ','.join(records).replace(';', ',')
+    runStage(TfbsConsSitesStage(format=format, table=table, sep=sep),
+        vcf + tmpextin, vcf + tmpextout, vcf + '.count.log')
 
-                    if str(fields[7]).endswith(';'):
-                        fields[7] = fields[7] +records_str
-                    else:
-                        fields[7] = fields[7] + ';' + records_str
-                    fh_out.write('\t'.join(fields) + '\n')
-                else:
-                    fh_out.write(line + '\n')
 
-            linenum = linenum + 1
+"""Overlap with GadAll table
+"""
+class GadAllStage(OverlapStage):
+    chrom_column = 'chromosome'
+
+    # For some reason this table has no "chr" preceeding number
+    def key(self, variant):
+        return variant.bare_site
+
+    def lookup(self, key):
+        chr, pos = key
+        return self.overlapping(chr, pos)
+
+    def apply(self, record, rows):
+        if (len(rows) == 0):
+            return
+
+        records = []
+        self.line_count = self.line_count + 1
+        r_tmp = []
+        for row in rows:
+            self.var_count = self.var_count + 1
+            if not fu.isOnTheList(r_tmp, str(row[3])):
+                r_tmp.append(str(row[3]) )
+                records.append(str(self.table) + '=' + str(row[3]))
+        if record.info_endswith(';'):
+            record.add_info(';'.join(records))
         else:
-            fh_out.write(line + '\n')
+            record.add_info(';' + ';'.join(records))
+        record.pad(' ')
 
-    fh_log.write(f"In {str(table)}: {str(var_count)} in " + \
-        f"{str(line_count)} variants\n")
-    fh_log.close()
 
-    conn.close()
-    fh.close()
-    fh_out.close()
+def addOverlapWithGadAll(vcf, format='vcf', table='gadAll', tmpextin='', 
+    tmpextout='.1', sep='\t'):
+    
+    runStage(GadAllStage(format=format, table=table, sep=sep),
+        vcf + tmpextin, vcf + tmpextout, vcf + '.count.log')
 
 
-"""Overlap with segdup regions genomicSuperDups
-"""
-def addOverlapWithGenomicSuperDups(vcf, format='vcf', 
-    table='genomicSuperDups', tmpextin='', tmpextout='.1', sep='\t'):
-    
-    basefile = vcf
-    vcf = basefile + tmpextin
-    outfile = basefile + tmpextout
+""" Overlap with gwasCatalog table """
+class GwasCatalogStage(OverlapStage):
+    label = 'GwasCatalog'
+
+    def lookup(self, key):
+        chr, pos = key
+        return self.backend.exact_end_match(self.table, str(chr),
+            coordinate(pos))
+
+    def apply(self, record, rows):
+        if (len(rows) == 0):
+            return
+
+        records = []
+        self.line_count = self.line_count + 1
+        for row in rows:
+            self.var_count = self.var_count + 1
+            records.append(str(self.table) + '=' + str('pubMedID') + \
+                '=' + str(row[5]) + ',trait=' + str(row[10]))
+        if record.info_endswith(';'):
+            record.add_info(';'.join(records))
+        else:
+            record.add_info(';' + ';'.join(records))
 
-    fh_out = open(outfile, "w")
-    fh = open(vcf)
 
-    logcountfile = basefile + '.count.log'
-    fh_log = open(logcountfile, 'a')
-    var_count = 0
-    line_count = 0
+def addOverlapWithGwasCatalog(vcf, format='vcf', table='gwasCatalog', \
+    tmpextin='', tmpextout='.1', sep='\t'):
+    
+    runStage(GwasCatalogStage(format=format, table=table, sep=sep),
+        vcf + tmpextin, vcf + tmpextout, vcf + '.count.log')
 
-    inds = getFormatSpecificIndices(format=format)
-    conn = u.db_connect()
-    cursor = conn.cursor()
-    linenum = 1
 
-    for line in fh:
-        line = line.strip()
-        ## not comments
-        if not line.startswith("##"):
-            #header line
-            if (line.startswith('CHROM') or line.startswith('#CHROM')):
-                fh_out.write(line + '\n')
-            else:
-                fields = line.split(sep)
-                chr = fields[inds[0]].strip()
-                if not chr.startswith("chr"):
-                    chr = "chr" + chr
+"""Overlap with HUGO Gene Nomenclature Committee (HGNC) table
+"""
+class HugoStage(OverlapStage):
+    label = 'HUGO Gene Nomenclature Committee'
+
+    def lookup(self, key):
+        chr, pos = key
+        return self.overlapping(chr, pos)
+
+    def apply(self, record, rows):
+        if (len(rows) == 0):
+            return
+
+        records = []
+        self.line_count = self.line_count + 1
+        r_tmp = []
+        for row in rows:
+            self.var_count = self.var_count + 1
+            t = str(str(row[5]) + ',' + str(row[6])).strip()
+            if not fu.isOnTheList(r_tmp, t):
+                r_tmp.append(t)
+                records.append('HGNC_GeneAnnotation' + '=' + t)
+
+        records_str = ','.join(records).replace(';', ',')
+
+        if record.info_endswith(';'):
+            record.add_info(records_str)
+        else:
+            record.add_info(';' + records_str)
 
-                pos = fields[inds[1]].strip()
-                isOverlap = False
-                otherChrom = ''
-                otherStart = ''
-                otherEnd = ''
-                l = str(isOverlap)
-
-                sql = 'select * from ' + table + ' where chrom="'+ str(chr) + \
-                    '" AND (chromStart <= ' + str(pos) + \
-                    ' AND ' + str(pos) + ' <= chromEnd);'
-                cursor.execute(sql)
-                rows = cursor.fetchone()
 
-                if rows is not None:
-                    line_count = line_count + 1
-                    var_count = var_count + 1
-                    isOverlap = True
-                    otherChrom = rows[7]
-                    otherStart = rows[8]
-                    otherEnd = rows[9]
-                    fields[7] = fields[7] + ';' + str(table) + '=' + \
-                        str(isOverlap) + ';' + 'otherChrom=' + \
-                        str(otherChrom) + ';otherStart=' + \
-                        str(otherStart) + ';otherEnd=' + str(otherEnd)
+def addOverlapWitHUGOGeneNomenclature(vcf, format='vcf', table='hugo', 
+    tmpextin='', tmpextout='.1', sep='\t'):
+    
+    runStage(HugoStage(format=format, table=table, sep=sep),
+        vcf + tmpextin, vcf + tmpextout, vcf + '.count.log')
 
-                fh_out.write('\t'.join(fields) + '\n')
 
-            linenum = linenum + 1
-        else:
-            fh_out.write(line + '\n')
+"""Overlap with segdup regions genomicSuperDups
+"""
+class GenomicSuperDupsStage(OverlapStage):
+
+    def lookup(self, key):
+        chr, pos = key
+        return first(self.overlapping(chr, pos))
+
+    def apply(self, record, rows):
+        if rows is not None:
+            self.line_count = self.line_count + 1
+            self.var_count = self.var_count + 1
+            isOverlap = True
+            otherChrom = rows[7]
+            otherStart = rows[8]
+            otherEnd = rows[9]
+            record.add_info(';' + str(self.table) + '=' + \
+                str(isOverlap) + ';' + 'otherChrom=' + \
+                str(otherChrom) + ';otherStart=' + \
+                str(otherStart) + ';otherEnd=' + str(otherEnd))
 
-    fh_log.write(f"In {str(table)}: {str(var_count)} in " + \
-        f"{str(line_count)} variants\n")
-    fh_log.close()
 
-    conn.close()
-    fh.close()
-    fh_out.close()
+def addOverlapWithGenomicSuperDups(vcf, format='vcf', 
+    table='genomicSuperDups', tmpextin='', tmpextout='.1', sep='\t'):
+    
+    runStage(GenomicSuperDupsStage(format=format, table=table, sep=sep),
+        vcf + tmpextin, vcf + tmpextout, vcf + '.count.log')
 
 
 """Searches Genes Databases and returns Genes/Cytobands 
@@ -1189,215 +1520,192 @@ def addOverlapWithRefGene(vcf, format='vcf', table='refGene',
 
 """Method to find overlap with Cytoband table
 """
+class CytobandStage(OverlapStage):
+
+    def __init__(self, format='vcf', table='cytoBand', sep='\t',
+        use_index=False, sweep=False):
+        OverlapStage.__init__(self, format=format, table=table, sep=sep,
+            use_index=use_index, sweep=sweep)
+        self.colindex = 12
+        self.startName = 'txStart'
+        self.endName = 'txEnd'
+
+        if (table == 'cytoBand'):
+            self.colindex = 3
+            self.startName = 'chromStart'
+            self.endName = 'chromEnd'
+
+        self.start_column = self.startName
+        self.end_column = self.endName
+
+    """Named as the driver always reported the cytoband step done
+    """
+    def progress(self):
+        return ['Cytoband']
+
+    def lookup(self, key):
+        chr, pos = key
+        return self.overlapping(chr, pos)
+
+    def apply(self, record, rows):
+        if (len(rows) > 0):
+            overlapsWith = []
+            self.line_count = self.line_count + 1
+            for row in rows:
+                self.var_count = self.var_count + 1
+                overlapsWith.append(str(row[self.colindex]))
+            overlapsWith = u.dedup(overlapsWith)
+            cytoband = ';'.join([str(x) for x in overlapsWith])
+
+            if record.info_endswith(";"):
+                record.add_info(str(self.table) + '=' + str(cytoband))
+            else:
+                record.add_info(';' + str(self.table) + '=' + str(cytoband))
+
+
 def addOverlapWithCytoband(vcf, format='vcf', table='cytoBand', 
     tmpextin='', tmpextout='.1', sep='\t'):
     
-    basefile = vcf
-    vcf = basefile + tmpextin
-    outfile = basefile + tmpextout
-    fh_out = open(outfile, "w")
-    fh = open(vcf)
-
-    logcountfile = basefile + '.count.log'
-    fh_log = open(logcountfile, 'a')
-    var_count = 0
-    line_count = 0
-    colindex = 12
-    startName = 'txStart'
-    endName = 'txEnd'
-
-    if (table == 'cytoBand'):
-        colindex = 3
-        startName = 'chromStart'
-        endName = 'chromEnd'
+    runStage(CytobandStage(format=format, table=table, sep=sep),
+        vcf + tmpextin, vcf + tmpextout, vcf + '.count.log')
 
-    inds = getFormatSpecificIndices(format=format)
-    conn = u.db_connect()
-    cursor = conn.cursor()
-    linenum = 1
 
-    for line in fh:
-        line = line.strip()
-        ## not comments
-        if not line.startswith("##"):
-            #header line
-            if (line.startswith('CHROM') or line.startswith('#CHROM')):
-                fh_out.write(line + '\n')
+"""Method to find overlap with CNV tables
+"""
+class CnvStage(OverlapStage):
+
+    def lookup(self, key):
+        chr, pos = key
+        return first(self.overlapping(chr, pos))
+
+    def apply(self, record, rows):
+        if rows is not None:
+            self.line_count = self.line_count + 1
+            self.var_count = self.var_count + 1
+            isOverlap = True
+            if record.info_endswith(";"):
+                record.add_info(str(self.table) + '=' + \
+                str(isOverlap))
             else:
-                fields = line.split(sep)
-                chr = fields[inds[0]].strip()
-                if not chr.startswith("chr"):
-                    chr = "chr" + chr
+                record.add_info(';' + str(self.table) + \
+                '='+str(isOverlap))
 
-                pos = fields[inds[1]].strip()
-                isOverlap = False
-                
-                sql = 'select * from ' + table + ' where chrom="' + \
-                    str(chr) + '" AND (' + startName + ' <= ' + str(pos) + \
-                    ' AND ' + str(pos) + ' <= ' + endName + ');'
-                overlapsWith = []
-                cursor.execute(sql)
-                rows = cursor.fetchall()
 
-                if (len(rows) > 0):
-                    line_count = line_count + 1
-                    for row in rows:
-                        var_count = var_count + 1
-                        overlapsWith.append(str(row[colindex]))
-                    overlapsWith = u.dedup(overlapsWith)
-                    cytoband = ';'.join([str(x) for x in overlapsWith])
+# CNV tables of the CNV track, in the order their flags are added to INFO
+CNV_TABLES = ['dgv_Cnv', 'abParts_IG_T_CelReceptors', 'mcCarroll_Cnv',
+    'conrad_Cnv']
 
-                    if str(fields[7]).endswith(";"):
-                        fields[7] = fields[7] + str(table) + '=' + str(cytoband)
-                    else:
-                        fields[7] = fields[7] + ';' + str(table) + '=' + str(cytoband)
-                fh_out.write('\t'.join(fields) + '\n')
 
-            linenum = linenum + 1
-        else:
-            fh_out.write(line + '\n')
+"""The CnvStage of every CNV table in one stage
 
-    fh_log.write(f"In {str(table)}: {str(var_count)} in " + \
-        f"{str(line_count)} variants\n")
-    fh_log.close()
+The CNV tables are only asked whether they cover the position, so one
+probe per variant answers for all of them: a merged coverage map (see
+intervals.CoverageMap) with use_index, one query of exists() flags
+otherwise. Each table's flag is added to INFO, and counted in the log,
+exactly as its own CnvStage would in a run of them one after the other.
+"""
+class CnvTrackStage(OverlapStage):
+    label = 'CNV'
+
+    def __init__(self, format='vcf', tables=CNV_TABLES, sep='\t',
+        use_index=False):
+        OverlapStage.__init__(self, format=format, table=','.join(tables),
+            sep=sep, use_index=use_index)
+        self.tables = list(tables)
+        self.counters = tuple([table + '_count' for table in self.tables])
+        for name in self.counters:
+            setattr(self, name, 0)
+
+    def open(self):
+        Stage.open(self)
+        if self.use_index:
+            try:
+                self.index = intervals.get_coverage(self.connect,
+                    self.tables, self.chrom_column, self.start_column,
+                    self.end_column)
+            finally:
+                self.release()
+
+    """Bitmask of the tables covering the position, bit k for the k-th
+    table
+    """
+    def lookup(self, key):
+        chr, pos = key
+        if (self.index is not None) and isNumeric(pos) and \
+            intervals.held(chr):
+            return self.index.mask(chr, int(pos))
+
+        tiers = self.backend.matching([('stabbing_query', {'table': table,
+            'chrom': str(chr), 'pos': coordinate(pos)})
+            for table in self.tables])
+        mask = 0
+        for tier in tiers:
+            mask = mask | (1 << (tier - 1))
+        return mask
+
+    def apply(self, record, mask):
+        for bit, table in enumerate(self.tables):
+            if (mask & (1 << bit)):
+                name = table + '_count'
+                setattr(self, name, getattr(self, name) + 1)
+                if record.info_endswith(";"):
+                    record.add_info(str(table) + '=' + str(True))
+                else:
+                    record.add_info(';' + str(table) + '=' + str(True))
 
-    conn.close()
-    fh.close()
-    fh_out.close()
+    """One line per table, as the separate CNV stages reported them
+    """
+    def progress(self):
+        return list(self.tables)
+
+    def report(self):
+        return [f"In {str(table)}: {str(getattr(self, table + '_count'))} " + \
+            f"in {str(getattr(self, table + '_count'))} variants\n"
+            for table in self.tables]
 
 
-"""Method to find overlap with CNV tables
-"""
 def addOverlapWithCnvDatabase(vcf, format='vcf', table='dgv_Cnv', 
     tmpextin='', tmpextout='.1', sep='\t'):
     
-    basefile = vcf
-    vcf = basefile + tmpextin
-    outfile = basefile + tmpextout
-
-    fh_out = open(outfile, "w")
-    fh = open(vcf)
-
-    logcountfile = basefile + '.count.log'
-    fh_log = open(logcountfile, 'a')
-    var_count = 0
-    line_count = 0
+    runStage(CnvStage(format=format, table=table, sep=sep),
+        vcf + tmpextin, vcf + tmpextout, vcf + '.count.log')
 
-    inds = getFormatSpecificIndices(format=format)
-    conn = u.db_connect()
-    cursor = conn.cursor()
-    linenum = 1
 
-    for line in fh:
-        line = line.strip()
-        ## not comments
-        if not line.startswith("##"):
-            #header line
-            if (line.startswith('CHROM') or line.startswith('#CHROM')):
-                fh_out.write(line + '\n')
+"""Method to find overlap with targetScanS tables
+"""
+class MiRNAStage(OverlapStage):
+    label = 'miRNA'
+
+    def __init__(self, format='vcf', table='targetScanS', sep='\t',
+        use_index=False, sweep=False):
+        OverlapStage.__init__(self, format=format, table=table, sep=sep,
+            use_index=use_index, sweep=sweep)
+
+    def lookup(self, key):
+        chr, pos = key
+        return first(self.overlapping(chr, pos))
+
+    def apply(self, record, rows):
+        if rows is not None:
+            self.line_count = self.line_count + 1
+            self.var_count = self.var_count + 1
+            t = str(rows[4]) + ',' +  str(rows[1]) + '_' + \
+                str(rows[2]) + '_' + str(rows[3])
+            t = 'miRNAsites=' + t.strip()
+            if record.info_endswith(";"):
+                record.add_info(t)
             else:
-                fields = line.split(sep)
-                chr = fields[inds[0]].strip()
-                if not chr.startswith("chr"):
-                    chr = "chr" + chr
-
-                pos = fields[inds[1]].strip()
-                isOverlap = False
-                sql = 'select * from ' + table + ' where chrom="' + \
-                    str(chr) + '" AND (chromStart <= ' + str(pos) + \
-                    ' AND ' + str(pos) + ' <= chromEnd);'
-                cursor.execute(sql)
-                rows = cursor.fetchone()
-
-                if rows is not None:
-                    line_count = line_count + 1
-                    var_count = var_count + 1
-                    isOverlap = True
-                    if str(fields[7]).endswith(";"):
-                        fields[7] = fields[7] + str(table) + '=' + \
-                        str(isOverlap)
-                    else:
-                        fields[7] = fields[7] + ';' + str(table) + \
-                        '='+str(isOverlap)
-                fh_out.write('\t'.join(fields) + '\n')
-
-            linenum = linenum + 1
-        else:
-            fh_out.write(line + '\n')
-
-    fh_log.write(f"In {str(table)}: {str(var_count)} in " + \
-        f"{str(line_count)} variants\n")
-    fh_log.close()
+                record.add_info(';' + t)
 
-    conn.close()
-    fh.close()
-    fh_out.close()
+    def report(self):
+        return [f"In miRNAsites: {str(self.var_count)} in " + \
+            f"{str(self.line_count)} variants\n"]
 
 
-"""Method to find overlap with targetScanS tables
-"""
 def addOverlapWithMiRNA(vcf, format='vcf', table='targetScanS', 
     tmpextin='', tmpextout='.1', sep='\t'):
     
-    basefile = vcf
-    vcf = basefile + tmpextin
-    outfile = basefile + tmpextout
-
-    fh_out = open(outfile, "w")
-    fh = open(vcf)
-
-    logcountfile = basefile + '.count.log'
-    fh_log = open(logcountfile, 'a')
-    var_count = 0
-    line_count = 0
-
-    inds = getFormatSpecificIndices(format=format)
-    conn = u.db_connect()
-    cursor = conn.cursor()
-    linenum = 1
-
-    for line in fh:
-        line = line.strip()
-        ## not comments
-        if not line.startswith("##"):
-            #header line
-            if (line.startswith('CHROM') or line.startswith('#CHROM')):
-                fh_out.write(line + '\n')
-            else:
-                fields = line.split(sep)
-                chr = fields[inds[0]].strip()
-                if not chr.startswith("chr"):
-                    chr = "chr" + chr
-
-                pos = fields[inds[1]].strip()
-                sql = 'select * from ' + table + ' where chrom="' + \
-                    str(chr) + '" AND (chromStart <= ' + str(pos) + \
-                    ' AND ' + str(pos) + ' <= chromEnd);'
-                cursor.execute(sql)
-                rows = cursor.fetchone()
-
-                if rows is not None:
-                    line_count = line_count + 1
-                    var_count = var_count + 1
-                    t = str(rows[4]) + ',' +  str(rows[1]) + '_' + \
-                        str(rows[2]) + '_' + str(rows[3])
-                    t = 'miRNAsites=' + t.strip()
-                    if str(fields[7]).endswith(";"):
-                        fields[7] = fields[7] + t
-                    else:
-                        fields[7] = fields[7] + ';' + t
-                fh_out.write('\t'.join(fields) + '\n')
-
-            linenum = linenum + 1
-        else:
-            fh_out.write(line + '\n')
-
-    fh_log.write(f"In miRNAsites: {str(var_count)} in " + \
-        f"{str(line_count)} variants\n")
-    fh_log.close()
-
-    conn.close()
-    fh.close()
-    fh_out.close()
+    runStage(MiRNAStage(format=format, table=table, sep=sep),
+        vcf + tmpextin, vcf + tmpextout, vcf + '.count.log')
 
-### EOF
\ No newline at end of file
+### EOF
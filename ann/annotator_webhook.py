@@ -16,6 +16,7 @@ import json
 from botocore.exceptions import ClientError
 import subprocess
 import os
+import regions
 
 app = Flask(__name__)
 environment = 'ann_config.Config'
@@ -78,6 +79,24 @@ def annotate():
                 for message in messages:
                     msg_body = json.loads(json.loads(message.body)["Message"])
 
+                    # Pieces of a job split by chromosome (see affinity.py);
+                    # the job is already RUNNING
+                    if "pieces" in msg_body:
+                        path = app.config["ANNOTATOR_BASE_DIR"]
+                        message_file = f"{path}/{msg_body['job_id']}~piece{msg_body['piece']:05d}.json"
+                        with open(message_file, 'w') as fh:
+                            json.dump(msg_body, fh)
+                        try:
+                            job = subprocess.Popen(["python", f"{path}/affinity.py", "annotate", message_file])
+                        except OSError as e:
+                            print(e)
+                        else:
+                            try:
+                                message.delete()
+                            except ClientError as e:
+                                print(e)
+                        continue
+
                     # Extract job parameters from message
                     job_id = msg_body["job_id"]
                     input_file_name = msg_body["input_file_name"]
@@ -94,10 +113,39 @@ def annotate():
                     except ClientError as e:
                         print(e)
                     else:
+                        # Regions (BED lines) the job is restricted to, if any
+                        args = ["python", f"{path}/run.py",
+                            local_path, path, user_id, job_id, input_file_name]
+                        regions_file = ""
+                        if msg_body.get("regions"):
+                            regions_file = f"{local_path}.regions.bed"
+                            with open(regions_file, 'w') as fh:
+                                fh.write(msg_body["regions"])
+                            args.append(regions_file)
+
+                            # An index built with the input lets the job
+                            # read just the regions (see regions.py)
+                            if msg_body.get("s3_key_input_index"):
+                                index_file = f"{local_path}.vidx.download"
+                                try:
+                                    s3.Bucket(bucket_name).download_file(
+                                        msg_body["s3_key_input_index"],
+                                        index_file)
+                                except ClientError as e:
+                                    print(e)
+                                else:
+                                    regions.accept_index(local_path,
+                                        index_file)
+
+                        # Annotation tracks requested, if not all of them
+                        if msg_body.get("tracks"):
+                            if not regions_file:
+                                args.append(regions_file)
+                            args.append(",".join(msg_body["tracks"]))
+
                         # Launch annotation job as a background process
                         try:
-                            job = subprocess.Popen(["python", f"{path}/run.py", 
-                                local_path, path, user_id, job_id, input_file_name]) 
+                            job = subprocess.Popen(args) 
                         except ClientError as e:
                             print(e)
                         else:
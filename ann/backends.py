@@ -0,0 +1,420 @@
+# backends.py
+#
+# Reference data backends
+#
+# The stages ask for reference rows through a few typed lookups instead of
+# writing SQL themselves:
+#
+#   point_lookup     rows whose columns equal one of the given values
+#   stabbing_query   rows whose interval contains a position
+#   range_query      rows whose interval overlaps a range
+#   exact_end_match  rows whose interval ends at a position
+#   first_match      the rows of the first of several lookups finding any
+#   matching         which of several lookups find any rows
+#
+# The MySQL backend (the annotator database) and the SQLite backend (a
+# local copy of the reference tables, or the benchmark fixture) answer
+# them with parameterized queries. The in-memory backend reads each table
+# once per process, through the same connections, and answers them from
+# dictionaries and interval indexes; it suits reference data that fits in
+# memory. Rows come back as tuples, in table order where the databases
+# would return them that way. configure() chooses the backend, from the
+# [ann] backend setting.
+#
+# Every backend compares text the way MySQL's default collation does,
+# ignoring case and trailing blanks (see fold()), so that the same lookup
+# finds the same rows whichever backend answers it.
+#
+# A process serving only some chromosomes (see intervals.set_chromosomes())
+# reads only their rows into memory and sends the lookups on the other
+# chromosomes to the database.
+#
+##
+
+import sqlite3
+import functools
+import intervals
+import utils as u
+
+BACKENDS = ('mysql', 'sqlite', 'memory')
+
+# Backend handed out by make(), and the SQLite file behind it
+_kind = 'mysql'
+_path = None
+
+# Tables read by the in-memory backend in this process, with their
+# column names, the point lookup indexes built over them and their
+# chromosome column
+_tables = {}
+
+# Chromosome columns of the reference tables
+CHROM_COLUMNS = ('chrom', 'chr', 'chromosome')
+
+
+"""Opens the SQLite file of the sqlite backend; the connection is used
+from the stage threads too
+"""
+def sqlite_connection(path):
+    return sqlite3.connect(path, check_same_thread=False)
+
+
+"""Chooses the backend of the stages created from now on
+
+path is the SQLite file of the sqlite backend; the in-memory backend
+reads its tables from it too when it is set, and from the annotator
+database otherwise.
+"""
+def configure(kind='mysql', path=None):
+    global _kind, _path
+    if kind not in BACKENDS:
+        raise ValueError(f"Unknown reference backend {kind}")
+    if (kind == 'sqlite') and not path:
+        raise ValueError("The sqlite backend needs a database file")
+
+    _kind = kind
+    _path = path
+    _tables.clear()
+    if path and (kind != 'mysql'):
+        u.set_connector(functools.partial(sqlite_connection, path))
+    else:
+        u.set_connector(None)
+
+
+"""Backend of the configured kind; connect() returns the cursor the
+queries run on (see annotate.Stage.connect())
+"""
+def make(connect):
+    if (_kind == 'memory'):
+        return MemoryBackend(connect,
+            SqliteBackend(connect) if _path else MySqlBackend(connect))
+    if (_kind == 'sqlite'):
+        return SqliteBackend(connect)
+    return MySqlBackend(connect)
+
+
+"""A point lookup's match as (columns, value tuples) pairs
+
+Each condition of match is (column, value), (column, [values]) or
+((column, ...), [(value, ...), ...]); a row matches when, for every
+condition, its columns hold one of the values.
+"""
+def conditions(match):
+    out = []
+    for columns, values in match:
+        if isinstance(columns, str):
+            columns = (columns,)
+            if not isinstance(values, list):
+                values = [values]
+            values = [(value,) for value in values]
+        out.append((tuple(columns), [tuple(value) for value in values]))
+    return out
+
+
+"""A value the way MySQL's default collation compares it; two values are
+equal to MySQL when their folds are
+"""
+def fold(value):
+    if isinstance(value, bytes):
+        value = value.decode('utf-8')
+    if isinstance(value, str):
+        return value.rstrip(' ').lower()
+    return value
+
+
+"""Reference data behind the stages' lookups
+
+columns names the columns to return ('*' for all of them, the default);
+coordinates are passed as integers. first_match() takes (lookup, keyword
+arguments) pairs, e.g. ('point_lookup', {'table': ..., 'match': ...}).
+"""
+class Backend(object):
+
+    def __init__(self, connect):
+        self.connect = connect
+
+    def point_lookup(self, table, match, columns=None):
+        raise NotImplementedError
+
+    def stabbing_query(self, table, chrom, pos, chrom_column='chrom',
+        start_column='chromStart', end_column='chromEnd', columns=None):
+        return self.range_query(table, chrom, pos, pos,
+            chrom_column=chrom_column, start_column=start_column,
+            end_column=end_column, columns=columns)
+
+    def range_query(self, table, chrom, start, end, chrom_column='chrom',
+        start_column='chromStart', end_column='chromEnd', columns=None):
+        raise NotImplementedError
+
+    def exact_end_match(self, table, chrom, end, chrom_column='chrom',
+        end_column='chromEnd', columns=None):
+        return self.point_lookup(table, [(chrom_column, chrom),
+            (end_column, end)], columns=columns)
+
+    def first_match(self, lookups):
+        for name, kwargs in lookups:
+            rows = getattr(self, name)(**kwargs)
+            if (len(rows) > 0):
+                return rows
+        return ()
+
+    """Tiers (1 for the first) of the lookups finding any rows
+    """
+    def matching(self, lookups):
+        return set([tier for tier, (name, kwargs) in enumerate(lookups, 1)
+            if (len(getattr(self, name)(**kwargs)) > 0)])
+
+
+"""Backend answering the lookups with SQL queries
+A stabbing query or range query with chrom None searches all chromosomes.
+"""
+class SqlBackend(Backend):
+    placeholder = '%s'
+    collate = ''
+    clauses = {'point_lookup': 'point_where', 'range_query': 'range_where',
+        'stabbing_query': 'stabbing_where',
+        'exact_end_match': 'exact_end_where'}
+
+    def quote(self, name):
+        return '`' + name + '`'
+
+    """A column as its comparisons with the bound values are written; the
+    collation only applies to text, so comparisons with numbers can use
+    the column's index as it is
+    """
+    def compared(self, name, text=True):
+        if text:
+            return self.quote(name) + self.collate
+        return self.quote(name)
+
+    """A bound value as the comparisons take it
+    """
+    def bound(self, value):
+        return value
+
+    def run(self, sql, args):
+        cursor = self.connect()
+        cursor.execute(sql, args)
+        return tuple(cursor.fetchall())
+
+    def select(self, table, columns, where, tier=None):
+        names = [(self.quote(table) + '.*') if (c == '*') else self.quote(c)
+            for c in (columns or ['*'])]
+        if tier is not None:
+            names.insert(0, str(tier) + ' as tier')
+        return 'select ' + ', '.join(names) + ' from ' + self.quote(table) + \
+            ' where ' + ' AND '.join(where)
+
+    def point_where(self, table, match):
+        where = []
+        args = []
+        for columns, values in conditions(match):
+            text = [all([isinstance(value[i], str) for value in values])
+                for i in range(len(columns))]
+            if (len(columns) == 1):
+                names = self.compared(columns[0], text[0])
+                row = self.placeholder
+            else:
+                names = '(' + ', '.join([self.compared(c, t)
+                    for c, t in zip(columns, text)]) + ')'
+                row = '(' + ', '.join([self.placeholder] * len(columns)) + ')'
+            if (len(values) == 1) and (len(columns) == 1):
+                where.append(names + ' = ' + row)
+            else:
+                where.append(names + ' in (' + \
+                    ', '.join([row] * len(values)) + ')')
+            for value in values:
+                args.extend([self.bound(v) for v in value])
+        return where, args
+
+    def range_where(self, table, chrom, start, end, chrom_column='chrom',
+        start_column='chromStart', end_column='chromEnd'):
+        where = []
+        args = []
+        if chrom is not None:
+            where.append(self.compared(chrom_column,
+                isinstance(chrom, str)) + ' = ' + self.placeholder)
+            args.append(self.bound(chrom))
+        where.append(self.quote(start_column) + ' <= ' + self.placeholder)
+        where.append(self.placeholder + ' <= ' + self.quote(end_column))
+        return where, args + [end, start]
+
+    def stabbing_where(self, table, chrom, pos, **kwargs):
+        return self.range_where(table, chrom, pos, pos, **kwargs)
+
+    def exact_end_where(self, table, chrom, end, chrom_column='chrom',
+        end_column='chromEnd'):
+        return self.point_where(table, [(chrom_column, chrom),
+            (end_column, end)])
+
+    def point_lookup(self, table, match, columns=None):
+        if any([len(values) == 0 for names, values in conditions(match)]):
+            return ()
+        where, args = self.point_where(table, match)
+        return self.run(self.select(table, columns, where), args)
+
+    def range_query(self, table, chrom, start, end, chrom_column='chrom',
+        start_column='chromStart', end_column='chromEnd', columns=None):
+        where, args = self.range_where(table, chrom, start, end,
+            chrom_column=chrom_column, start_column=start_column,
+            end_column=end_column)
+        return self.run(self.select(table, columns, where), args)
+
+    def exact_end_match(self, table, chrom, end, chrom_column='chrom',
+        end_column='chromEnd', columns=None):
+        where, args = self.exact_end_where(table, chrom, end,
+            chrom_column=chrom_column, end_column=end_column)
+        return self.run(self.select(table, columns, where), args)
+
+    """All lookups in one query, each row tagged with its lookup's tier
+    """
+    def first_match(self, lookups):
+        parts = []
+        args = []
+        for tier, (name, kwargs) in enumerate(lookups, 1):
+            kwargs = dict(kwargs)
+            columns = kwargs.pop('columns', None)
+            where, part_args = getattr(self, self.clauses[name])(**kwargs)
+            parts.append(self.select(kwargs['table'], columns, where,
+                tier=tier))
+            args.extend(part_args)
+
+        rows = self.run(' union all '.join(parts), args)
+        if (len(rows) == 0):
+            return rows
+        tier = min([row[0] for row in rows])
+        return tuple([row[1:] for row in rows if (row[0] == tier)])
+
+    """All lookups in one query returning a single row of exists() flags
+    """
+    def matching(self, lookups):
+        parts = []
+        args = []
+        for name, kwargs in lookups:
+            kwargs = dict(kwargs)
+            kwargs.pop('columns', None)
+            where, part_args = getattr(self, self.clauses[name])(**kwargs)
+            parts.append('exists (select 1 from ' + \
+                self.quote(kwargs['table']) + ' where ' + \
+                ' AND '.join(where) + ')')
+            args.extend(part_args)
+        flags = self.run('select ' + ', '.join(parts), args)[0]
+        return set([tier for tier, flag in enumerate(flags, 1) if flag])
+
+
+class MySqlBackend(SqlBackend):
+    placeholder = '%s'
+
+
+"""SQLite compares text exactly; NOCASE folds its case and the bound
+values are passed without trailing blanks, so an index on the column can
+still be used when it is declared with that collation (as the benchmark
+fixture declares them). Trailing blanks stored in the table still count.
+"""
+class SqliteBackend(SqlBackend):
+    placeholder = '?'
+    collate = ' COLLATE NOCASE'
+
+    def bound(self, value):
+        if isinstance(value, str):
+            return value.rstrip(' ')
+        return value
+
+
+"""Backend answering the lookups from tables read into memory
+
+Stabbing and range queries use the interval indexes of intervals.py, so
+the tables are shared with the stages' own indexes and come from the
+reference snapshot when one is set. Point lookups use a dictionary over
+the first condition's columns, built on first use. Lookups on chromosomes
+this process does not hold go to fallback, a backend over the same
+connections.
+"""
+class MemoryBackend(Backend):
+
+    def __init__(self, connect, fallback):
+        Backend.__init__(self, connect)
+        self.fallback = fallback
+
+    def table(self, table):
+        if table not in _tables:
+            cursor = self.connect()
+            cursor.execute('select * from ' + table + ' where 0;')
+            names = [str(d[0]) for d in cursor.description]
+            chrom_column = None
+            for name in names:
+                if (name.lower() in CHROM_COLUMNS):
+                    chrom_column = name
+                    break
+            where = ''
+            if chrom_column is not None:
+                where = intervals.chromosome_filter(chrom_column)
+            cursor.execute('select * from ' + table + where + ';')
+            _tables[table] = (names, tuple(cursor.fetchall()), {},
+                chrom_column)
+        return _tables[table]
+
+    """True if the rows a point lookup's match asks for were read
+    """
+    def holds(self, chrom_column, match):
+        if (chrom_column is None) or (intervals.chromosomes() is None):
+            return True
+        for columns, values in match:
+            if chrom_column in columns:
+                i = columns.index(chrom_column)
+                if not all([intervals.held(value[i]) for value in values]):
+                    return False
+        return True
+
+    def project(self, names, rows, columns):
+        if (columns is None) or (list(columns) == ['*']):
+            return tuple(rows)
+        positions = []
+        for c in columns:
+            if (c == '*'):
+                positions.extend(range(len(names)))
+            else:
+                positions.append(names.index(c))
+        return tuple([tuple([row[i] for i in positions]) for row in rows])
+
+    def point_lookup(self, table, match, columns=None):
+        names, rows, keyed, chrom_column = self.table(table)
+        if not self.holds(chrom_column, conditions(match)):
+            return self.fallback.point_lookup(table, match, columns=columns)
+        match = conditions(match)
+        first, values = match[0]
+        if first not in keyed:
+            positions = [names.index(c) for c in first]
+            index = {}
+            for n, row in enumerate(rows):
+                index.setdefault(tuple([fold(row[i]) for i in positions]),
+                    []).append(n)
+            keyed[first] = index
+
+        hits = set()
+        for value in values:
+            hits.update(keyed[first].get(tuple([fold(v) for v in value]), []))
+
+        found = []
+        for n in sorted(hits):
+            row = rows[n]
+            if all([tuple([fold(row[names.index(c)]) for c in cols]) in
+                set([tuple([fold(v) for v in value]) for value in vals])
+                for cols, vals in match[1:]]):
+                found.append(row)
+        return self.project(names, found, columns)
+
+    def range_query(self, table, chrom, start, end, chrom_column='chrom',
+        start_column='chromStart', end_column='chromEnd', columns=None):
+        if not (isinstance(start, int) and isinstance(end, int)):
+            return ()
+        if (intervals.chromosomes() is not None) and \
+            ((chrom is None) or not intervals.held(chrom)):
+            return self.fallback.range_query(table, chrom, start, end,
+                chrom_column=chrom_column, start_column=start_column,
+                end_column=end_column, columns=columns)
+        index = intervals.get_index(self.connect, table, chrom_column,
+            start_column, end_column)
+        return self.project(index.columns, index.overlapping(chrom, start,
+            end), columns)
+
+### EOF
@@ -0,0 +1,445 @@
+# benchmark.py
+#
+# Offline benchmark of the annotation pipeline
+#
+# Runs the stages against a local SQLite stand-in for the annotator
+# database, read through the sqlite reference backend (see backends.py),
+# so neither RDS nor Secrets Manager is needed:
+#
+#   python benchmark.py fixture <db> [--length <bases>] [--snps <count>]
+#   python benchmark.py vcf <db> <vcf> [--variants <count>]
+#       [--dbsnp-rate <fraction>] [--multiallelic-rate <fraction>]
+#   python benchmark.py run <db> <vcf> [--baseline <json>] [--save-baseline]
+#
+# The fixture holds every table the stages query, with the columns they
+# read, filled with generated rows. The generated VCF is sorted and takes
+# the requested fraction of its sites from the fixture's dbSNP table. A
+# run reports the throughput of every stage (from the metrics file, see
+# engine.write_metrics()) and of the whole run, and the peak RSS; against
+# a stored baseline it exits with status 1 when throughput drops, or the
+# peak RSS grows, by more than the tolerance.
+#
+##
+
+import os
+import sys
+import json
+import time
+import random
+import shutil
+import sqlite3
+import argparse
+import resource
+import tempfile
+
+import backends
+import engine
+import driver
+import annotate as ann
+
+CHROMS = [str(c) for c in range(1, 23)] + ['X', 'Y']
+
+# Bases per chromosome of the fixture
+LENGTH = 2000000
+
+# dbSNP rows of the fixture
+SNPS = 200000
+
+# Rows per megabase of the overlap tables
+DENSITY = {'refGene': 20, 'chrom_pos_unequal': 20, 'cpgIslandExt': 10,
+    'tfbsConsSites': 200, 'gadAll': 10, 'hugo': 20, 'genomicSuperDups': 5,
+    'dgv_Cnv': 20, 'abParts_IG_T_CelReceptors': 2, 'mcCarroll_Cnv': 10,
+    'conrad_Cnv': 10, 'targetScanS': 50}
+
+CNV_TABLES = ['dgv_Cnv', 'abParts_IG_T_CelReceptors', 'mcCarroll_Cnv',
+    'conrad_Cnv']
+
+BIG_REF_GENE_COLUMNS = ['CHR', 'start', '"end"', 'haplotypeReference',
+    'haplotypeAlternate', 'name', 'name2', 'transcriptStrand',
+    'positionType', 'frame', 'mrnaCoord', 'codonCoord', 'spliceDist',
+    'referenceCodon', 'referenceAA', 'variantCodon', 'variantAA', 'changesAA',
+    'functionalClass', 'codingCoordStr', 'proteinCoordStr', 'inCodingRegion',
+    'spliceInfo', 'uorfChange']
+
+BASES = 'ACGT'
+
+# Relative drop in throughput (or growth in peak RSS) failing a run
+TOLERANCE = 0.25
+
+
+"""Random intervals on a chromosome, count per megabase, as (start, end)
+"""
+def intervals_on(rng, length, density, max_length):
+    count = max(1, int(density * length / 1000000))
+    spans = []
+    for i in range(count):
+        start = rng.randint(1, length)
+        spans.append((start, start + rng.randint(0, max_length)))
+    return sorted(spans)
+
+
+"""Writes the reference fixture: every table the stages query, with rows
+generated from seed
+"""
+def build_fixture(path, chroms=CHROMS, length=LENGTH, snps=SNPS, seed=1):
+    rng = random.Random(seed)
+    if os.path.exists(path):
+        os.remove(path)
+    db = sqlite3.connect(path)
+
+    db.execute('create table meta (name text primary key, value text)')
+    db.executemany('insert into meta values (?, ?)', [
+        ('chroms', ','.join(chroms)), ('length', str(length))])
+
+    db.execute('create table dbSNP (id, CHR, POS, RSID, REF, ALT, QUAL, ' + \
+        'GMAF, INFO)')
+    for t in ['chrom_pos_equal_base', 'chrom_pos_equal_nobase',
+        'chrom_pos_unequal']:
+        db.execute('create table ' + t + ' (id, ' + \
+            ', '.join(BIG_REF_GENE_COLUMNS) + ')')
+    db.execute('create table refGene (bin, name, chrom, strand, txStart, ' + \
+        'txEnd, cdsStart, cdsEnd, exonCount, exonStarts, exonEnds, score, ' + \
+        'name2, cdsStartStat, cdsEndStat, exonFrames)')
+    db.execute('create table cpgIslandExt (bin, chrom, chromStart, ' + \
+        'chromEnd, name)')
+    db.execute('create table gadAll (chromosome, chromStart, chromEnd, ' + \
+        'geneSymbol)')
+    db.execute('create table gwasCatalog (bin, chrom, chromStart, chromEnd, ' + \
+        'name, pubMedID, author, pubDate, journal, title, trait)')
+    db.execute('create table hugo (bin, chrom, chromStart, chromEnd, name, ' + \
+        'symbol, description)')
+    db.execute('create table genomicSuperDups (bin, chrom, chromStart, ' + \
+        'chromEnd, name, score, strand, otherChrom, otherStart, otherEnd)')
+    db.execute('create table cytoBand (chrom, chromStart, chromEnd, name, ' + \
+        'gieStain)')
+    for t in CNV_TABLES:
+        db.execute('create table ' + t + ' (bin, chrom, chromStart, ' + \
+            'chromEnd, name)')
+    db.execute('create table targetScanS (bin, chrom, chromStart, ' + \
+        'chromEnd, name, score)')
+
+    ids = iter(range(1, 1 << 62))
+
+    def refseq(chrom, start, end, ref, alt):
+        return (next(ids), chrom, start, end, ref, alt,
+            'NM_' + str(rng.randint(1, 40000)),
+            'GENE' + str(rng.randint(1, 20000)), rng.choice('+-'),
+            rng.choice(['CDS', 'intron', 'utr3', 'utr5', 'non_coding_exon']),
+            rng.randint(0, 2), rng.randint(1, 5000), 'c.' + str(start), 0,
+            'ATG', 'M', 'ATA', 'I', rng.choice(['Y', 'N']), 'missense',
+            'c.1A>G', 'p.M1I', 1, '', 0)
+
+    per_chrom = max(1, snps // len(chroms))
+    for chrom in chroms:
+        chr = 'chr' + chrom
+        sites = sorted([(rng.randint(1, length), rng.choice(BASES))
+            for i in range(per_chrom)])
+        db.executemany('insert into dbSNP values (?, ?, ?, ?, ?, ?, ?, ?, ?)',
+            [(i, chrom, pos, 'rs' + str(i), ref, rng.choice(BASES), '.',
+            rng.choice(['.', '0.01', '0.2']),
+            rng.choice(['SNV', 'SNV', 'SNV', 'DIV']))
+            for i, (pos, ref) in zip(ids, sites)])
+
+        sample = rng.sample(sites, len(sites) * 2 // 5)
+        base = sample[:len(sample) * 3 // 4]
+        nobase = sample[len(sample) * 3 // 4:]
+        placeholders = ', '.join(['?'] * 25)
+        db.executemany('insert into chrom_pos_equal_base values (' + \
+            placeholders + ')', [refseq(chrom, pos, pos, ref,
+            rng.choice(BASES)) for pos, ref in base])
+        db.executemany('insert into chrom_pos_equal_nobase values (' + \
+            placeholders + ')', [refseq(chrom, pos, pos, '', '')
+            for pos, ref in nobase])
+        db.executemany('insert into chrom_pos_unequal values (' + \
+            placeholders + ')', [refseq(chrom, start, end, '', '')
+            for start, end in intervals_on(rng, length,
+            DENSITY['chrom_pos_unequal'], 30000)])
+
+        rows = []
+        for start, end in intervals_on(rng, length, DENSITY['refGene'], 60000):
+            exons = min(rng.randint(1, 12), (end - start + 2) // 2)
+            bounds = sorted(rng.sample(range(start, end + 2), 2 * exons))
+            exonStarts = bounds[0::2]
+            exonEnds = bounds[1::2]
+            cdsStart, cdsEnd = sorted([rng.randint(start, end),
+                rng.randint(start, end)])
+            if (rng.random() < 0.2):
+                cdsStart = cdsEnd = end
+            rows.append((0, 'NM_' + str(rng.randint(1, 40000)), chr,
+                rng.choice('+-'), start, end, cdsStart, cdsEnd,
+                len(exonStarts),
+                (','.join([str(x) for x in exonStarts]) + ',').encode(),
+                (','.join([str(x) for x in exonEnds]) + ',').encode(), 0,
+                'GENE' + str(rng.randint(1, 20000)), 'cmpl', 'cmpl', ''))
+        db.executemany('insert into refGene values (' + \
+            ', '.join(['?'] * 16) + ')', rows)
+
+        db.executemany('insert into cpgIslandExt values (0, ?, ?, ?, ?)',
+            [(chr, start, end, 'CpG: ' + str(rng.randint(1, 200)))
+            for start, end in intervals_on(rng, length,
+            DENSITY['cpgIslandExt'], 3000)])
+
+        db.execute('create table tfbsConsSites' + chrom + ' (bin, chrom, ' + \
+            'chromStart, chromEnd, name, score)')
+        db.executemany('insert into tfbsConsSites' + chrom + \
+            ' values (0, ?, ?, ?, ?, 800)', [(chr, start, end,
+            rng.choice(['V$AP1_Q2', 'V$SP1_Q6', 'V$CREB_01']))
+            for start, end in intervals_on(rng, length,
+            DENSITY['tfbsConsSites'], 30)])
+
+        db.executemany('insert into gadAll values (?, ?, ?, ?)',
+            [(chrom, start, end, rng.choice(['BRCA1', 'TP53', 'APOE', 'CFTR']))
+            for start, end in intervals_on(rng, length, DENSITY['gadAll'],
+            50000)])
+
+        db.executemany('insert into gwasCatalog values ' + \
+            '(0, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)', [(chr, pos - 1, pos,
+            'rs' + str(rng.randint(1, 99999999)), rng.randint(1, 30000000),
+            'Author',
+            '2012-01-01', 'Journal', 'Title',
+            rng.choice(['Height', 'Body mass index', 'Type 2 diabetes']))
+            for pos, ref in rng.sample(sites, max(1, len(sites) // 1000))])
+
+        db.executemany('insert into hugo values (0, ?, ?, ?, ?, ?, ?)',
+            [(chr, start, end, 'HGNC:' + str(rng.randint(1, 50000)),
+            'SYM' + str(rng.randint(1, 20000)),
+            rng.choice(['kinase', 'receptor; putative', 'transporter']))
+            for start, end in intervals_on(rng, length, DENSITY['hugo'],
+            60000)])
+
+        db.executemany('insert into genomicSuperDups values ' + \
+            '(0, ?, ?, ?, ?, 0, ?, ?, ?, ?)', [(chr, start, end, 'dup',
+            rng.choice('+-'), 'chr' + rng.choice(chroms), start + 1000,
+            end + 1000) for start, end in intervals_on(rng, length,
+            DENSITY['genomicSuperDups'], 20000)])
+
+        start = 0
+        bands = []
+        while (start < length):
+            end = min(length, start + rng.randint(100000, 400000))
+            bands.append((chr, start, end, rng.choice('pq') + \
+                str(rng.randint(11, 36)) + '.' + str(rng.randint(1, 3)),
+                rng.choice(['gneg', 'gpos50', 'acen'])))
+            start = end
+        db.executemany('insert into cytoBand values (?, ?, ?, ?, ?)', bands)
+
+        for t in CNV_TABLES:
+            db.executemany('insert into ' + t + ' values (0, ?, ?, ?, ?)',
+                [(chr, start, end, t) for start, end in intervals_on(rng,
+                length, DENSITY[t], 20000)])
+
+        db.executemany('insert into targetScanS values (0, ?, ?, ?, ?, 50)',
+            [(chr, start, end, 'miR-' + str(rng.randint(1, 500)))
+            for start, end in intervals_on(rng, length,
+            DENSITY['targetScanS'], 8)])
+
+    # The sqlite backend compares chromosome names with NOCASE (see
+    # backends.py), which only an index of that collation serves
+    db.execute('create index dbSNP_site on dbSNP (CHR COLLATE NOCASE, POS)')
+    for t in ['chrom_pos_equal_base', 'chrom_pos_equal_nobase',
+        'chrom_pos_unequal']:
+        db.execute('create index ' + t + '_site on ' + t + \
+            ' (CHR COLLATE NOCASE, start)')
+    db.execute('create index refGene_site on refGene ' + \
+        '(chrom COLLATE NOCASE, txStart)')
+    db.execute('create index gadAll_site on gadAll ' + \
+        '(chromosome COLLATE NOCASE, chromStart)')
+    for t in ['cpgIslandExt', 'gwasCatalog', 'hugo', 'genomicSuperDups',
+        'cytoBand', 'targetScanS'] + CNV_TABLES:
+        db.execute('create index ' + t + '_site on ' + t + \
+            ' (chrom COLLATE NOCASE, chromStart)')
+    for chrom in chroms:
+        db.execute('create index tfbsConsSites' + chrom + '_site on ' + \
+            'tfbsConsSites' + chrom + ' (chrom, chromStart)')
+    db.commit()
+    db.close()
+
+
+"""Writes a sorted synthetic VCF of about variants records
+
+A dbsnp_rate fraction of the sites is taken from the fixture's dbSNP table
+(with its REF, so the dbSNP lookup matches); multiallelic_rate of the
+records have two alternate alleles.
+"""
+def write_vcf(path, fixture, variants=10000, dbsnp_rate=0.4,
+    multiallelic_rate=0.05, seed=1):
+
+    rng = random.Random(seed)
+    db = sqlite3.connect(fixture)
+    meta = dict(db.execute('select name, value from meta').fetchall())
+    chroms = meta['chroms'].split(',')
+    length = int(meta['length'])
+
+    with open(path, 'w') as fh:
+        fh.write('##fileformat=VCFv4.1\n')
+        fh.write('##source=benchmark.py\n')
+        fh.write('##INFO=<ID=DP,Number=1,Type=Integer,' + \
+            'Description="Total Depth">\n')
+        fh.write('#CHROM\tPOS\tID\tREF\tALT\tQUAL\tFILTER\tINFO\tFORMAT\t' + \
+            'SAMPLE\n')
+
+        for n, chrom in enumerate(chroms):
+            count = variants // len(chroms) + \
+                (1 if (n < variants % len(chroms)) else 0)
+            known = db.execute('select POS, REF from dbSNP where CHR = ?',
+                (chrom,)).fetchall()
+
+            sites = []
+            for i in range(count):
+                if (len(known) > 0) and (rng.random() < dbsnp_rate):
+                    pos, ref = rng.choice(known)
+                else:
+                    pos, ref = (rng.randint(1, length), rng.choice(BASES))
+                alts = [b for b in BASES if (b != ref)]
+                if (rng.random() < multiallelic_rate):
+                    alt = ','.join(rng.sample(alts, 2))
+                else:
+                    alt = rng.choice(alts)
+                sites.append((pos, ref, alt))
+
+            for pos, ref, alt in sorted(sites):
+                fh.write('\t'.join([chrom, str(pos), '.', ref, alt, '50',
+                    'PASS', 'DP=' + str(rng.randint(5, 200)), 'GT',
+                    rng.choice(['0/1', '1/1'])]) + '\n')
+    db.close()
+
+
+"""Peak resident set size in KB of this process and its worker processes
+"""
+def peak_rss():
+    return max(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+        resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss)
+
+
+"""Annotates vcf against the fixture with driver.run() and returns the
+throughput of the run and of every stage, and the peak RSS
+"""
+def run(fixture, vcf, workers=1, stage_threads=0,
+    batch_size=engine.BATCH_SIZE, dbsnp_batch_size=ann.DBSNP_BATCH_SIZE,
+    use_index=True, sweep=False):
+
+    directory = tempfile.mkdtemp(prefix='benchmark.')
+    try:
+        infile = os.path.join(directory, os.path.basename(vcf))
+        os.symlink(os.path.abspath(vcf), infile)
+        started = time.perf_counter()
+        driver.run(infile, 'vcf', batch_size=batch_size,
+            dbsnp_batch_size=dbsnp_batch_size, use_index=use_index,
+            sweep=sweep, workers=workers, stage_threads=stage_threads,
+            backend='sqlite', backend_path=os.path.abspath(fixture))
+        elapsed = time.perf_counter() - started
+        with open(infile + '.metrics.json') as fh:
+            metrics = json.load(fh)
+    finally:
+        backends.configure()
+        shutil.rmtree(directory, ignore_errors=True)
+
+    variants = metrics['stages'][0]['variants']
+    stages = {}
+    for entry in metrics['stages']:
+        name = entry['stage']
+        if entry['table'] is not None:
+            name = name + ':' + entry['table']
+        stages[name] = entry['variants_per_second']
+
+    return {'variants': variants, 'wall_time': elapsed,
+        'variants_per_second': variants / elapsed, 'peak_rss_kb': peak_rss(),
+        'stages': stages}
+
+
+"""Regressions of result against baseline, as messages
+"""
+def compare(result, baseline, tolerance=TOLERANCE):
+    failures = []
+    if (result['variants_per_second'] < \
+        baseline['variants_per_second'] * (1 - tolerance)):
+        failures.append(f"Throughput {result['variants_per_second']:.0f} " + \
+            f"variants/s, baseline {baseline['variants_per_second']:.0f}")
+    if (result['peak_rss_kb'] > baseline['peak_rss_kb'] * (1 + tolerance)):
+        failures.append(f"Peak RSS {result['peak_rss_kb']} KB, " + \
+            f"baseline {baseline['peak_rss_kb']} KB")
+    for name, rate in result['stages'].items():
+        before = baseline['stages'].get(name)
+        if (rate is None) or (before is None):
+            continue
+        if (rate < before * (1 - tolerance)):
+            failures.append(f"{name}: {rate:.0f} variants/s, " + \
+                f"baseline {before:.0f}")
+    return failures
+
+
+def report(result):
+    for name, rate in result['stages'].items():
+        rate = 'n/a' if (rate is None) else f"{rate:.0f}"
+        print(f"{name:<45} {rate:>12} variants/s")
+    print(f"Total: {result['variants']} variants in " + \
+        f"{result['wall_time']:.2f} s " + \
+        f"({result['variants_per_second']:.0f} variants/s), " + \
+        f"peak RSS {result['peak_rss_kb'] / 1024.0:.1f} MB")
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        description='Benchmark the annotator against a local fixture')
+    commands = parser.add_subparsers(dest='command', required=True)
+
+    fixture = commands.add_parser('fixture',
+        help='generate the reference fixture')
+    fixture.add_argument('db')
+    fixture.add_argument('--length', type=int, default=LENGTH,
+        help='bases per chromosome')
+    fixture.add_argument('--snps', type=int, default=SNPS,
+        help='dbSNP rows')
+    fixture.add_argument('--seed', type=int, default=1)
+
+    vcf = commands.add_parser('vcf', help='generate a synthetic VCF')
+    vcf.add_argument('db')
+    vcf.add_argument('vcf')
+    vcf.add_argument('--variants', type=int, default=10000)
+    vcf.add_argument('--dbsnp-rate', type=float, default=0.4)
+    vcf.add_argument('--multiallelic-rate', type=float, default=0.05)
+    vcf.add_argument('--seed', type=int, default=1)
+
+    bench = commands.add_parser('run', help='annotate and report throughput')
+    bench.add_argument('db')
+    bench.add_argument('vcf')
+    bench.add_argument('--workers', type=int, default=1)
+    bench.add_argument('--stage-threads', type=int, default=0)
+    bench.add_argument('--batch-size', type=int, default=engine.BATCH_SIZE)
+    bench.add_argument('--no-index', action='store_true')
+    bench.add_argument('--baseline', default=None,
+        help='JSON result of an earlier run to compare against')
+    bench.add_argument('--save-baseline', action='store_true',
+        help='store this run as the baseline instead of comparing')
+    bench.add_argument('--tolerance', type=float, default=TOLERANCE)
+    args = parser.parse_args()
+    if (args.command == 'run') and args.save_baseline and not args.baseline:
+        bench.error('--save-baseline needs --baseline <json> to write to')
+
+    if (args.command == 'fixture'):
+        build_fixture(args.db, length=args.length, snps=args.snps,
+            seed=args.seed)
+        print(f"Fixture written to {args.db}")
+    elif (args.command == 'vcf'):
+        write_vcf(args.vcf, args.db, variants=args.variants,
+            dbsnp_rate=args.dbsnp_rate,
+            multiallelic_rate=args.multiallelic_rate, seed=args.seed)
+        print(f"{args.variants} variants written to {args.vcf}")
+    else:
+        result = run(args.db, args.vcf, workers=args.workers,
+            stage_threads=args.stage_threads, batch_size=args.batch_size,
+            use_index=not args.no_index)
+        report(result)
+        if args.baseline and args.save_baseline:
+            with open(args.baseline, 'w') as fh:
+                json.dump(result, fh, indent=2)
+            print(f"Baseline written to {args.baseline}")
+        elif args.baseline:
+            with open(args.baseline) as fh:
+                failures = compare(result, json.load(fh), args.tolerance)
+            for failure in failures:
+                print(f"REGRESSION {failure}")
+            if (len(failures) > 0):
+                sys.exit(1)
+
+### EOF
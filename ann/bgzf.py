@@ -0,0 +1,139 @@
+# bgzf.py
+#
+# Compressed input and output for the annotation pipeline
+#
+# Input may be plain text, gzip or BGZF (the blocked gzip of samtools and
+# tabix); gzip readers handle both since BGZF is a series of gzip members.
+# Output can be written as BGZF: the text is cut into blocks of at most
+# 64 KB that are compressed independently, on several threads, and
+# written in order.
+#
+##
+
+import gzip
+import io
+import struct
+import zlib
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+
+# Uncompressed bytes per block, small enough for any compressed block to
+# stay within the 64 KB BGZF limit
+BLOCK_SIZE = 0xff00
+
+# Empty block marking the end of a BGZF file
+EOF_BLOCK = bytes.fromhex(
+    '1f8b08040000000000ff0600424302001b0003000000000000000000')
+
+GZIP_MAGIC = b'\x1f\x8b'
+
+
+"""True if the file starts like a gzip (or BGZF) file
+"""
+def is_gzip(path):
+    with open(path, 'rb') as fh:
+        return fh.read(2) == GZIP_MAGIC
+
+
+"""Opens an input file for reading text, decompressing it if needed
+"""
+def open_input(path):
+    if is_gzip(path):
+        return gzip.open(path, 'rt')
+    return open(path)
+
+
+"""Compresses data into one BGZF block
+"""
+def compress_block(data, level=6):
+    compressor = zlib.compressobj(level, zlib.DEFLATED, -15)
+    cdata = compressor.compress(data) + compressor.flush()
+    header = struct.pack('<4BI2BH2BHH', 31, 139, 8, 4, 0, 0, 255, 6,
+        66, 67, 2, len(cdata) + 25)
+    return header + cdata + struct.pack('<II', zlib.crc32(data), len(data))
+
+
+"""Binary file writing BGZF blocks
+
+With threads > 1, blocks are compressed on a thread pool (zlib releases
+the GIL); at most twice as many blocks as threads are in flight. mode 'ab'
+appends blocks to an existing file.
+"""
+class BgzfWriter(io.RawIOBase):
+
+    def __init__(self, path, threads=1, level=6, mode='wb'):
+        io.RawIOBase.__init__(self)
+        self.fh = open(path, mode)
+        self.threads = threads
+        self.level = level
+        self.buffer = bytearray()
+        self.pending = deque()
+        self.executor = None
+        if (threads > 1):
+            self.executor = ThreadPoolExecutor(max_workers=threads)
+
+    def writable(self):
+        return True
+
+    def write(self, data):
+        self.buffer += data
+        while (len(self.buffer) >= BLOCK_SIZE):
+            self.emit(bytes(self.buffer[:BLOCK_SIZE]))
+            del self.buffer[:BLOCK_SIZE]
+        return len(data)
+
+    def emit(self, data):
+        if self.executor is None:
+            self.fh.write(compress_block(data, self.level))
+            return
+        self.pending.append(self.executor.submit(compress_block, data,
+            self.level))
+        while (len(self.pending) > 2 * self.threads):
+            self.fh.write(self.pending.popleft().result())
+
+    """Writes all data so far to the file, ending the current block early
+    """
+    def flush(self):
+        if self.fh.closed:
+            return
+        if (len(self.buffer) > 0):
+            self.emit(bytes(self.buffer))
+            self.buffer = bytearray()
+        while (len(self.pending) > 0):
+            self.fh.write(self.pending.popleft().result())
+        self.fh.flush()
+
+    def close(self):
+        if self.closed:
+            return
+        try:
+            if (len(self.buffer) > 0):
+                self.emit(bytes(self.buffer))
+                self.buffer = bytearray()
+            while (len(self.pending) > 0):
+                self.fh.write(self.pending.popleft().result())
+            self.fh.write(EOF_BLOCK)
+        finally:
+            self.fh.close()
+            if self.executor is not None:
+                self.executor.shutdown(wait=True)
+            io.RawIOBase.close(self)
+
+
+"""Opens an output file for writing text, as BGZF if compress is set;
+append adds to the end of an existing file
+"""
+def open_output(path, compress=False, threads=1, append=False):
+    if compress:
+        return io.TextIOWrapper(io.BufferedWriter(BgzfWriter(path,
+            threads=threads, mode='ab' if append else 'wb')))
+    return open(path, 'a' if append else 'w')
+
+
+"""Writes everything written to a file from open_output() so far to disk
+"""
+def flush_output(fh):
+    fh.flush()
+    fh.buffer.raw.flush()
+
+### EOF
@@ -0,0 +1,150 @@
+# checkpoint.py
+#
+# Checkpoints of long annotation runs
+#
+# Every batch goes through all stages before it is written, so a run's
+# progress is the point in the input up to which every stage is done.
+# Every few batches annotate_file() flushes the partial result (the .part
+# file) and saves a checkpoint next to it: the stages that completed the
+# records so far with their counters, the offset in the input after the
+# last record written and the size of the partial result at that point.
+# A run restarted with the same checkpoint cuts the partial result back
+# to that size, seeks the input to that offset and carries on with the
+# saved counters, so the result and the count log come out as if it had
+# never stopped.
+#
+# With an S3 location, every save also uploads the bytes added to the
+# partial result since the previous save, as one numbered chunk, and then
+# the checkpoint itself. A job retried on another instance downloads the
+# checkpoint and the chunks when it finds no local checkpoint.
+#
+##
+
+import os
+import json
+
+FORMAT = 1
+
+# Batches between checkpoints
+INTERVAL = 50
+
+
+"""Progress of one annotation run, saved to path (and to the S3 object
+key in bucket, when both are given) every interval batches
+"""
+class Checkpoint(object):
+
+    def __init__(self, path, interval=INTERVAL, bucket=None, key=None):
+        self.path = path
+        self.interval = interval
+        self.bucket = bucket
+        self.key = key
+        self.chunks = []
+        self.s3 = None
+
+    def client(self):
+        if self.s3 is None:
+            import boto3
+            self.s3 = boto3.client('s3')
+        return self.s3
+
+    def uploads(self):
+        return (self.bucket is not None) and (self.key is not None)
+
+    """The saved state if it belongs to this run of stages over infile,
+    with partfile holding at least the saved output, otherwise None
+    A checkpoint found only in S3 is downloaded along with the partial
+    result.
+    """
+    def load(self, stages, infile, partfile):
+        state = self.read()
+        if (state is None) and self.uploads():
+            state = self.download(partfile)
+        if state is None:
+            return None
+
+        try:
+            if (state['format'] != FORMAT) or \
+                (state['input_size'] != os.path.getsize(infile)) or \
+                (state['stages'] != identify(stages)) or \
+                (os.path.getsize(partfile) < state['output_offset']):
+                return None
+        except (OSError, KeyError):
+            return None
+        self.chunks = state.get('chunks', [])
+        return state
+
+    def read(self):
+        try:
+            with open(self.path) as fh:
+                return json.load(fh)
+        except (OSError, ValueError):
+            return None
+
+    """Fetches the checkpoint and its chunks from S3 into the local files
+    """
+    def download(self, partfile):
+        from botocore.exceptions import ClientError
+        try:
+            body = self.client().get_object(Bucket=self.bucket,
+                Key=self.key)['Body'].read()
+            state = json.loads(body)
+            with open(partfile, 'wb') as fh:
+                for key, size in state.get('chunks', []):
+                    fh.write(self.client().get_object(Bucket=self.bucket,
+                        Key=key)['Body'].read())
+        except (ClientError, ValueError):
+            return None
+
+        with open(self.path, 'wb') as fh:
+            fh.write(body)
+        return state
+
+    """Records that every stage has annotated the input up to
+    input_offset, written as the first output_offset bytes of partfile
+    counts are the stage counters at that point, as stage.counts() gave
+    them.
+    """
+    def save(self, stages, counts, infile, partfile, input_offset,
+        output_offset):
+        if self.uploads():
+            start = sum([size for key, size in self.chunks])
+            if (output_offset > start):
+                with open(partfile, 'rb') as fh:
+                    fh.seek(start)
+                    data = fh.read(output_offset - start)
+                key = f"{self.key}.part{len(self.chunks):06d}"
+                self.client().put_object(Bucket=self.bucket, Key=key,
+                    Body=data)
+                self.chunks.append([key, len(data)])
+
+        state = {'format': FORMAT, 'input_size': os.path.getsize(infile),
+            'stages': identify(stages), 'counts': counts,
+            'input_offset': input_offset, 'output_offset': output_offset,
+            'chunks': self.chunks}
+        body = json.dumps(state)
+        with open(self.path + '.tmp', 'w') as fh:
+            fh.write(body)
+        os.replace(self.path + '.tmp', self.path)
+        if self.uploads():
+            self.client().put_object(Bucket=self.bucket, Key=self.key,
+                Body=body.encode('utf-8'))
+
+    """Deletes the checkpoint once the run is complete
+    """
+    def remove(self):
+        if os.path.exists(self.path):
+            os.remove(self.path)
+        if self.uploads():
+            keys = [key for key, size in self.chunks] + [self.key]
+            self.client().delete_objects(Bucket=self.bucket,
+                Delete={'Objects': [{'Key': key} for key in keys]})
+        self.chunks = []
+
+
+"""The stages of a run as a checkpoint records them
+"""
+def identify(stages):
+    return [list(stage.cache_id()) for stage in stages]
+
+### EOF
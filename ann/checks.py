@@ -0,0 +1,559 @@
+# checks.py
+#
+# Offline behaviour checks of the annotation pipeline
+#
+# Runs against the SQLite fixture of benchmark.py, read through the
+# sqlite and memory reference backends (see backends.py), so neither RDS,
+# S3 nor Secrets Manager is needed:
+#
+#   python checks.py <db> [--variants <count>] [--seed <seed>]
+#       [--only <check>,...]
+#
+# The fixture is generated first when <db> does not exist. Every check
+# compares a fast path with the plain one it stands in for:
+#
+#   intervals   interval index, sweep and snapshot index against SQL
+#   dbsnp       batched against per-variant dbSNP lookups, per backend
+#   checkpoint  a run resumed from a checkpoint against an unbroken one
+#   regions     region extraction by scan, written and accepted index
+#               against a filter
+#   tracks      every track subset leaves well-formed INFO fields
+#   affinity    chromosome-group pieces interleave back to the input
+#   snapshot    snapshot values, rows and index against the table
+#   golden      all tracks against the output of the old pipeline
+#
+# The golden check does not use <db>. It annotates golden/golden.vcf
+# against a fixture generated with GOLDEN_FIXTURE, by default and with
+# workers, sweep, stage threads and the memory backend, and compares the
+# result and the count log byte for byte with golden/golden.annot.vcf and
+# golden/golden.vcf.count.log. Those were written from the same fixture by
+# the pipeline as it was before the stages were streamed (one temporary
+# file per stage), with PYTHONHASHSEED=0: the transcripts stage writes its
+# matches in set order, so every run is a child process with that seed.
+# The golden VCF holds records past the last cytoBand band
+# (see add_past_bands()).
+#
+# Each check prints PASS or FAIL with what differed; the run exits with
+# status 1 when any check fails.
+#
+##
+
+import io
+import os
+import sys
+import json
+import random
+import shutil
+import sqlite3
+import argparse
+import subprocess
+import tempfile
+import contextlib
+from decimal import Decimal
+
+import backends
+import bgzf
+import engine
+import driver
+import intervals
+import snapshot
+import checkpoint
+import regions
+import benchmark
+
+# Bases per chromosome and dbSNP rows of a generated fixture
+LENGTH = 200000
+SNPS = 20000
+
+# Positions probed per table by the interval check
+PROBES = 2000
+
+# Golden input and results of the old pipeline, and the fixture they were
+# annotated against
+GOLDEN = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'golden')
+GOLDEN_FIXTURE = {'chroms': ['1', '2', 'X'], 'length': 200000, 'snps': 3000,
+    'seed': 1}
+
+# driver.run() settings of the golden runs, besides the defaults
+GOLDEN_MODES = [('default', {}), ('workers', {'workers': 2}),
+    ('sweep', {'sweep': True}), ('stage threads', {'stage_threads': 4}),
+    ('memory backend', {'backend': 'memory'})]
+
+# Track subsets annotated by the tracks check, besides every single track
+TRACK_SETS = [['genes', 'tfbs'], ['dbsnp', 'genes'],
+    ['transcripts', 'genes', 'mirna'], ['cytoband', 'cnv', 'superdups']]
+
+
+"""Reference tables of the fixture as (table, chrom, start, end) columns
+"""
+def fixture_tables(db):
+    names = set([row[0] for row in db.execute(
+        "select name from sqlite_master where type = 'table'")])
+    return [(table, columns[0] or 'chrom', columns[1], columns[2])
+        for table, columns in snapshot.TABLES.items() if table in names]
+
+
+"""Annotates a copy of vcf in directory with driver.run(), without its
+progress output
+
+Returns the result and the count log, less the lines that depend on how
+the run was batched.
+"""
+def annotate(vcf, directory, **options):
+    os.makedirs(directory)
+    infile = os.path.join(directory, os.path.basename(vcf))
+    shutil.copy(vcf, infile)
+    try:
+        with contextlib.redirect_stdout(io.StringIO()):
+            result = driver.run(infile, 'vcf', **options)
+    finally:
+        backends.configure()
+    with open(result) as fh:
+        lines = fh.read()
+    with open(infile + '.count.log') as fh:
+        log = [line for line in fh
+            if not line.startswith(('Lookup keys', 'Peak memory'))]
+    return lines, log
+
+
+"""Records of a VCF as lists of fields
+"""
+def records(path):
+    with open(path) as fh:
+        return [line.rstrip('\n').split('\t') for line in fh
+            if not line.startswith('#')]
+
+
+"""Index, sweep and snapshot index hits against the same query in SQL,
+over the fixture's tables and over random intervals with long ones among
+them
+"""
+def check_intervals(fixture, vcf, directory, rng):
+    failures = []
+    db = sqlite3.connect(fixture)
+    sites = [(r[0], int(r[1])) for r in records(vcf)]
+
+    for table, chrom_column, start_column, end_column in \
+        fixture_tables(db):
+        cursor = db.cursor()
+        index = intervals.load_table(cursor, table, chrom_column,
+            start_column, end_column)
+        names = index.columns
+        rows = db.execute('select * from ' + table).fetchall()
+        path = os.path.join(directory, table + '.snap')
+        snapshot.write_table(path, table, names, rows, chrom_column,
+            start_column, end_column)
+        mapped = snapshot.SnapshotTable(path).index()
+
+        probes = sorted(rng.sample(sites, min(PROBES, len(sites))),
+            key=lambda site: (intervals.chrom_key(site[0]), site[1]))
+        sweep = intervals.Sweep(index)
+        sql = 'select * from ' + table + ' where ' + chrom_column + \
+            ' = ? collate nocase and ' + start_column + ' <= ? and ? <= ' + \
+            end_column + ' order by rowid'
+        for chrom, pos in probes:
+            hi = pos + rng.choice([0, 0, 10, 1000])
+            expected = db.execute(sql, (chrom, hi, pos)).fetchall()
+            found = {'index': index.overlapping(chrom, pos, hi),
+                'snapshot': [tuple(row) for row in
+                    mapped.overlapping(chrom, pos, hi)]}
+            if (hi == pos):
+                found['sweep'] = sweep.stab(chrom, pos)
+            for name, hits in found.items():
+                if (hits != expected):
+                    failures.append(f"{table} {chrom}:{pos}-{hi}: {name} " + \
+                        f"found {len(hits)} rows, SQL {len(expected)}")
+            if (len(failures) > 10):
+                return failures
+
+    # Nested intervals down to a chromosome-long one
+    starts, ends = [], []
+    for i in range(2000):
+        start = rng.randint(1, 1000000)
+        starts.append(start)
+        ends.append(start + rng.choice([0, 10, 1000, 100000, 1000000]))
+    starts.append(1)
+    ends.append(2000000)
+    index = intervals.IntervalIndex.build('random',
+        [('1', s, e, n) for n, (s, e) in enumerate(zip(starts, ends))])
+    for i in range(PROBES):
+        lo = rng.randint(0, 2100000)
+        hi = lo + rng.choice([0, 100, 10000])
+        expected = [n for n, (s, e) in enumerate(zip(starts, ends))
+            if (s <= hi) and (lo <= e)]
+        if (index.overlapping('1', lo, hi) != expected):
+            failures.append(f"random intervals {lo}-{hi}: index differs")
+            break
+    return failures
+
+
+"""Results and count logs of every backend at a dbSNP batch size of 1
+and of DBSNP_BATCH_SIZE, with the REF of every third record in lower case
+"""
+def check_dbsnp(fixture, vcf, directory, rng):
+    folded = os.path.join(directory, 'folded.vcf')
+    with open(vcf) as fh, open(folded, 'w') as fh_out:
+        n = 0
+        for line in fh:
+            if not line.startswith('#'):
+                n = n + 1
+                if (n % 3 == 0):
+                    fields = line.split('\t')
+                    fields[3] = fields[3].lower()
+                    line = '\t'.join(fields)
+            fh_out.write(line)
+
+    failures = []
+    results = {}
+    for source in [vcf, folded]:
+        for backend in ['sqlite', 'memory']:
+            for size in [1, driver.ann.DBSNP_BATCH_SIZE]:
+                run = os.path.basename(source) + f" {backend} batch {size}"
+                results[run] = annotate(source, os.path.join(directory,
+                    run.replace(' ', '.')), backend=backend,
+                    backend_path=fixture, dbsnp_batch_size=size,
+                    tracks=['dbsnp'])
+        runs = [run for run in results if run.startswith(
+            os.path.basename(source) + ' ')]
+        for run in runs[1:]:
+            if (results[run] != results[runs[0]]):
+                failures.append(f"{run} differs from {runs[0]}")
+    return failures
+
+
+"""A run broken off after a few batches and restarted against one that
+never stopped, compressed and not
+"""
+def check_checkpoint(fixture, vcf, directory, rng):
+    failures = []
+    driver.init_worker(backend='sqlite', backend_path=fixture)
+    real = engine.annotate_batch
+    calls = [0]
+
+    def broken(*args, **kwargs):
+        calls[0] = calls[0] + 1
+        if (calls[0] == 7):
+            raise RuntimeError('stopped')
+        return real(*args, **kwargs)
+
+    def run(infile, outfile, logfile, compress, interval=0):
+        progress = None
+        if (interval > 0):
+            progress = checkpoint.Checkpoint(outfile + '.ckpt',
+                interval=interval)
+        with contextlib.redirect_stdout(io.StringIO()):
+            engine.annotate_file(infile, outfile, driver.stages(),
+                logfile=logfile, batch_size=200, compress=compress,
+                checkpoint=progress)
+
+    try:
+        for compress in [False, True]:
+            infile = os.path.join(directory, f"in{int(compress)}.vcf")
+            shutil.copy(vcf, infile)
+            outfile = infile + '.out'
+
+            calls[0] = 0
+            engine.annotate_batch = broken
+            try:
+                run(infile, outfile, infile + '.log', compress, interval=2)
+                failures.append(f"compress={compress}: run did not stop")
+                continue
+            except RuntimeError:
+                pass
+            finally:
+                engine.annotate_batch = real
+            run(infile, outfile, infile + '.log', compress, interval=2)
+            run(infile, outfile + '.ref', infile + '.ref.log', compress)
+
+            if os.path.exists(outfile + '.ckpt'):
+                failures.append(f"compress={compress}: checkpoint left")
+            # Compressed blocks end at every checkpoint, so the text of
+            # the results is compared rather than their bytes
+            for a, b in [(outfile, outfile + '.ref'),
+                (infile + '.log', infile + '.ref.log')]:
+                with bgzf.open_input(a) as fh_a, bgzf.open_input(b) as fh_b:
+                    if (fh_a.read() != fh_b.read()):
+                        failures.append(f"compress={compress}: " + \
+                            f"{os.path.basename(a)} differs from " + \
+                            "an unbroken run")
+    finally:
+        engine.annotate_batch = real
+        backends.configure()
+    return failures
+
+
+"""Records extracted by scanning, through a written index and through an
+index accepted from another copy of the input (as a job accepts one)
+against filtering every record by the regions; an index of another file
+must not be accepted
+"""
+def check_regions(fixture, vcf, directory, rng):
+    sites = records(vcf)
+    bedfile = os.path.join(directory, 'regions.bed')
+    with open(bedfile, 'w') as fh:
+        fh.write('track name=checks\n')
+        for chrom, pos in rng.sample([(r[0], int(r[1])) for r in sites],
+            min(50, len(sites))):
+            fh.write(f"{chrom}\t{max(pos - 1 - rng.randint(0, 5000), 0)}" + \
+                f"\t{pos + rng.randint(0, 50000)}\n")
+
+    spans = regions.read_bed(bedfile)
+    expected = [r for r in sites if regions.in_regions(
+        spans.get(regions.region_chrom(r[0]), []), int(r[1]))]
+
+    failures = []
+    infile = os.path.join(directory, 'in.vcf')
+    shutil.copy(vcf, infile)
+    jobfile = os.path.join(directory, 'job.vcf')
+    for name in ['scan', 'index', 'accepted']:
+        source = infile
+        if (name == 'index'):
+            regions.write_index(infile)
+        elif (name == 'accepted'):
+            source = jobfile
+            shutil.copy(vcf, jobfile)
+            shutil.copy(infile + regions.INDEX_EXT, jobfile + '.download')
+            if not regions.accept_index(jobfile, jobfile + '.download') or \
+                (regions.get_index(jobfile) is None):
+                failures.append("accepted: index of a copy not accepted")
+        outfile = os.path.join(directory, name + '.vcf')
+        regions.extract(source, bedfile, outfile)
+        found = records(outfile)
+        if (found != expected):
+            failures.append(f"{name}: {len(found)} records, " + \
+                f"{len(expected)} in the regions")
+
+    other = os.path.join(directory, 'other.vcf')
+    with open(vcf) as fh, open(other, 'w') as fh_out:
+        fh_out.write(fh.read().replace('\tPASS\t', '\tPASS\tX', 1)[:-1])
+    shutil.copy(infile + regions.INDEX_EXT, other + '.download')
+    if regions.accept_index(other, other + '.download'):
+        failures.append("index of another file accepted")
+    return failures
+
+
+"""Copies vcf to outfile with count more records per chromosome past its
+last cytoBand band, in the promoter windows of the refGene transcripts
+reaching beyond it
+"""
+def add_past_bands(fixture, vcf, outfile, rng, count=20):
+    db = sqlite3.connect(fixture)
+    extra = {}
+    for chrom, last in db.execute(
+        'select chrom, max(chromEnd) from cytoBand group by chrom'):
+        windows = db.execute('select txEnd from refGene where chrom = ? ' + \
+            'and txEnd + 500 > ?', (chrom, last)).fetchall()
+        if (len(windows) == 0):
+            continue
+        positions = set()
+        for i in range(count):
+            positions.add(rng.randint(last + 1, rng.choice(windows)[0] + 500))
+        extra[intervals.chrom_name(chrom)] = [[intervals.chrom_name(chrom),
+            str(pos), '.', 'A', 'G', '50', 'PASS', 'DP=3', 'GT', '0/1']
+            for pos in positions]
+    db.close()
+
+    with open(vcf) as fh:
+        lines = fh.readlines()
+    header = [line for line in lines if line.startswith('#')]
+    found = records(vcf)
+    chroms = list(dict.fromkeys([fields[0] for fields in found]))
+    with open(outfile, 'w') as fh_out:
+        fh_out.write(''.join(header))
+        for chrom in chroms:
+            fields = [f for f in found if (f[0] == chrom)] + \
+                extra.get(intervals.chrom_name(chrom), [])
+            fields.sort(key=lambda f: int(f[1]))
+            fh_out.write(''.join(['\t'.join(f) + '\n' for f in fields]))
+
+
+"""Every track on its own and a few subsets, over records past the last
+cytoBand band too: INFO fields without empty entries, and every record
+annotated
+
+A trailing ';' is what the refGene stage has always left for the cytoband
+stage to fill in, so it is only an empty entry without that track.
+"""
+def check_tracks(fixture, vcf, directory, rng):
+    failures = []
+    source = os.path.join(directory, 'tracks.vcf')
+    add_past_bands(fixture, vcf, source, rng)
+    count = len(records(source))
+    for tracks in [[track] for track in driver.TRACKS] + TRACK_SETS:
+        name = ','.join(tracks)
+        banded = 'cytoband' in driver.select_tracks(tracks)
+        lines, log = annotate(source, os.path.join(directory, name),
+            backend='sqlite', backend_path=fixture, tracks=tracks)
+        found = [line.split('\t') for line in lines.splitlines()
+            if not line.startswith('#')]
+        malformed = [fields for fields in found if (len(fields) < 8) or
+            (fields[7].endswith(';') and not banded) or (';;' in fields[7])]
+        if (len(found) != count):
+            failures.append(f"{name}: {len(found)} of {count} records")
+        if (len(malformed) > 0):
+            failures.append(f"{name}: {len(malformed)} records with " + \
+                "empty INFO entries")
+    return failures
+
+
+"""Pieces of every chromosome group interleaved back into the input
+"""
+def check_affinity(fixture, vcf, directory, rng):
+    # affinity reads the job settings from ann_config.ini when imported,
+    # and run.py, which it imports, complains about the missing arguments
+    with contextlib.redirect_stdout(io.StringIO()):
+        import affinity
+
+    failures = []
+    for text in ['1,2,3;4,5,6,7,8;X,Y', '22', '1;2;3;4;5;6;7;8;9;10']:
+        work = os.path.join(directory, text.replace(';', '_'))
+        os.makedirs(work)
+        pieces, layout = affinity.split_pieces(vcf, work,
+            affinity.parse_groups(text))
+        outfile = os.path.join(work, 'merged.vcf')
+        affinity.interleave(pieces, layout, outfile)
+        with open(vcf) as fh, open(outfile) as fh_out:
+            if (fh.read() != fh_out.read()):
+                failures.append(f"groups {text}: merged pieces differ " + \
+                    "from the input")
+    return failures
+
+
+"""Pooled values, rows and index of snapshot tables against the rows and
+index of the tables they were written from
+"""
+def check_snapshot(fixture, vcf, directory, rng):
+    failures = []
+    for value in [None, 0, -1, 2 ** 63 - 1, 2 ** 70, 1.5, -0.0,
+        Decimal('12.50'), '', 'chr1', 'gène', b'', b'1,2,\x00']:
+        decoded = snapshot.decode_value(snapshot.encode_value(value))
+        if (decoded != value) or (type(decoded) != type(value)):
+            failures.append(f"value {value!r} decodes to {decoded!r}")
+
+    db = sqlite3.connect(fixture)
+    for table, chrom_column, start_column, end_column in \
+        fixture_tables(db):
+        cursor = db.execute('select * from ' + table)
+        names = [str(d[0]) for d in cursor.description]
+        rows = cursor.fetchall()
+        chrom_column = snapshot.TABLES[table][0]
+        path = os.path.join(directory, table + '.snap')
+        snapshot.write_table(path, table, names, rows, chrom_column,
+            start_column, end_column)
+        mapped = snapshot.SnapshotTable(path)
+
+        stored = [mapped.row(n) for n in range(mapped.header['rows'])]
+        if (sorted(stored, key=repr) != sorted(rows, key=repr)):
+            failures.append(f"{table}: rows differ from the table")
+
+        c = names.index(chrom_column) if chrom_column is not None else None
+        s = names.index(start_column)
+        e = names.index(end_column)
+        index = intervals.IntervalIndex.build(table,
+            [(row[c] if c is not None else '', row[s], row[e], row)
+            for row in rows])
+        found = mapped.index()
+        for chrom, partition in index.partitions.items():
+            for i in range(100):
+                pos = rng.randint(0, max(partition.ends) + 1)
+                if ([tuple(row) for row in found.stab(chrom, pos)] != \
+                    index.stab(chrom, pos)):
+                    failures.append(f"{table} {chrom}:{pos}: snapshot " + \
+                        "index differs")
+                    break
+    return failures
+
+
+"""Every track, in every mode of GOLDEN_MODES, against the golden result
+and count log of the old pipeline
+The count log may go on with the summary lines the old pipeline did not
+write.
+"""
+def check_golden(fixture, vcf, directory, rng):
+    golden = os.path.join(directory, 'golden.db')
+    benchmark.build_fixture(golden, **GOLDEN_FIXTURE)
+    with open(os.path.join(GOLDEN, 'golden.annot.vcf'), 'rb') as fh:
+        expected = fh.read()
+    with open(os.path.join(GOLDEN, 'golden.vcf.count.log'), 'rb') as fh:
+        expected_log = fh.read()
+
+    failures = []
+    script = 'import sys, json, driver; ' + \
+        'driver.run(sys.argv[1], "vcf", **json.loads(sys.argv[2]))'
+    for name, options in GOLDEN_MODES:
+        work = os.path.join(directory, name.replace(' ', '_'))
+        os.makedirs(work)
+        infile = os.path.join(work, 'golden.vcf')
+        shutil.copy(os.path.join(GOLDEN, 'golden.vcf'), infile)
+        options = dict({'backend': 'sqlite', 'backend_path': golden},
+            **options)
+        run = subprocess.run([sys.executable, '-c', script, infile,
+            json.dumps(options)], cwd=os.path.dirname(GOLDEN),
+            env=dict(os.environ, PYTHONHASHSEED='0'),
+            stdout=subprocess.DEVNULL, stderr=subprocess.PIPE)
+        if (run.returncode != 0):
+            failures.append(f"{name}: run failed: " + \
+                run.stderr.decode().strip().splitlines()[-1])
+            continue
+
+        with open(os.path.join(work, 'golden.annot.vcf'), 'rb') as fh:
+            if (fh.read() != expected):
+                failures.append(f"{name}: result differs from " + \
+                    "golden.annot.vcf")
+        with open(infile + '.count.log', 'rb') as fh:
+            log = fh.read()
+        rest = log[len(expected_log):].decode().splitlines()
+        if not log.startswith(expected_log) or not all([line.startswith(
+            ('Lookup keys', 'Peak memory')) for line in rest]):
+            failures.append(f"{name}: count log differs from " + \
+                "golden.vcf.count.log")
+    return failures
+
+
+CHECKS = [('intervals', check_intervals), ('dbsnp', check_dbsnp),
+    ('checkpoint', check_checkpoint), ('regions', check_regions),
+    ('tracks', check_tracks), ('affinity', check_affinity),
+    ('snapshot', check_snapshot), ('golden', check_golden)]
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        description='Check the annotator against a local fixture')
+    parser.add_argument('db')
+    parser.add_argument('--variants', type=int, default=2000)
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('--only', default=None,
+        help='comma-separated list of checks (default: all)')
+    args = parser.parse_args()
+
+    if not os.path.exists(args.db):
+        benchmark.build_fixture(args.db, length=LENGTH, snps=SNPS,
+            seed=args.seed)
+        print(f"Fixture written to {args.db}")
+    fixture = os.path.abspath(args.db)
+    selected = args.only.split(',') if args.only else \
+        [name for name, check in CHECKS]
+
+    failed = False
+    directory = tempfile.mkdtemp(prefix='checks.')
+    try:
+        vcf = os.path.join(directory, 'checks.vcf')
+        benchmark.write_vcf(vcf, fixture, variants=args.variants,
+            seed=args.seed)
+        for name, check in CHECKS:
+            if name not in selected:
+                continue
+            work = os.path.join(directory, name)
+            os.makedirs(work)
+            failures = check(fixture, vcf, work, random.Random(args.seed))
+            print(f"{'PASS' if (len(failures) == 0) else 'FAIL'} {name}")
+            for failure in failures:
+                print(f"  {failure}")
+            failed = failed or (len(failures) > 0)
+    finally:
+        shutil.rmtree(directory, ignore_errors=True)
+
+    if failed:
+        sys.exit(1)
+
+### EOF
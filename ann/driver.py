@@ -12,110 +12,201 @@ __author__ = 'Vas Vasiliadis <vas@uchicago.edu>'
 
 import sys
 import os
-import file_utils as fu
+import functools
+import engine
+import intervals
+import snapshot
+import regions
+import variant_cache
+import backends
+import checkpoint
 import annotate as ann
 
-def run(infile, format):
+# Annotation tracks a job can ask for, each added by one or more stages
+TRACKS = ('dbsnp', 'transcripts', 'genes', 'cytoband', 'disease', 'gwas',
+    'mirna', 'hugo', 'cnv', 'superdups', 'tfbs')
+
+# Tracks whose stages read what the stages of other tracks wrote to INFO
+# (the refGene stage reads the positionType of the BigRefGene stage)
+DEPENDENCIES = {'genes': ['transcripts']}
+
+
+"""The requested tracks and the tracks they depend on; all tracks when
+tracks is None
+"""
+def select_tracks(tracks=None):
+    if tracks is None:
+        return set(TRACKS)
+    unknown = [t for t in tracks if t not in TRACKS]
+    if (len(unknown) > 0):
+        raise ValueError(f"Unknown annotation tracks {', '.join(unknown)}")
+    if (len(tracks) == 0):
+        raise ValueError("No annotation tracks requested")
+
+    selected = set()
+    pending = list(tracks)
+    while (len(pending) > 0):
+        track = pending.pop()
+        if track not in selected:
+            selected.add(track)
+            pending.extend(DEPENDENCIES.get(track, []))
+    return selected
+
+
+"""Annotation stages, in the order they are applied to each record,
+after the stage normalizing each record's variant for them
+
+use_index answers the overlap stages from in-memory interval indexes and
+sweep walks those indexes in step with coordinate-sorted input. With
+cache_path, lookup results are kept in that variant cache file under
+reference_version. tracks limits the stages to those of the requested
+tracks and their dependencies (see select_tracks()).
+"""
+def stages(format='vcf', dbsnp_batch_size=ann.DBSNP_BATCH_SIZE,
+    use_index=True, sweep=False, cache_path=None, reference_version=None,
+    tracks=None):
+    indexed = {'use_index': use_index, 'sweep': sweep}
+    selected = select_tracks(tracks)
+    pipeline = [
+        ('dbsnp', ann.DbSnpStage(format=format, batch_size=dbsnp_batch_size)),
+        ('transcripts', ann.BigRefGeneStage(format=format)),
+        ('genes', ann.GenesStage(format=format, table='refGene',
+            promoter_offset=500, use_index=use_index,
+            separator=('cytoband' in selected))),
+        ('cytoband', ann.CytobandStage(format=format, table='cytoBand',
+            **indexed)),
+        ('disease', ann.GadAllStage(format=format, table='gadAll',
+            **indexed)),
+        ('gwas', ann.GwasCatalogStage(format=format, table='gwasCatalog')),
+        ('mirna', ann.MiRNAStage(format=format, table='targetScanS',
+            **indexed)),
+        ('hugo', ann.HugoStage(format=format, table='hugo', **indexed)),
+        ('cnv', ann.CnvTrackStage(format=format, tables=ann.CNV_TABLES,
+            use_index=use_index)),
+        ('superdups', ann.GenomicSuperDupsStage(format=format,
+            table='genomicSuperDups', **indexed)),
+        ('tfbs', ann.TfbsConsSitesStage(table='tfbsConsSites'))
+    ]
+    pipeline = [stage for track, stage in pipeline if (track in selected)]
+
+    if cache_path:
+        cache = variant_cache.open_cache(cache_path, reference_version)
+        for stage in pipeline:
+            stage.cache = cache
+    return [ann.NormalizeStage(format=format)] + pipeline
+
+
+"""Sets up a worker process of a parallel run
+"""
+def init_worker(snapshot_dir=None, backend='mysql', backend_path=None,
+    chromosomes=None):
+    intervals.set_chromosomes(chromosomes)
+    backends.configure(backend, backend_path)
+    if snapshot_dir:
+        intervals.set_snapshot(snapshot.open_snapshot(snapshot_dir))
+
+
+"""Annotates infile; batch_size is the number of lines pushed through the
+stages at a time, dbsnp_batch_size the number of variants resolved by
+each dbSNP query and use_index loads the small overlap tables into memory
+instead of querying them for every variant. With snapshot_dir, indexed
+tables are mapped from that reference snapshot instead of being loaded
+from the database. sweep suits coordinate-sorted input; unsorted input is
+detected and falls back to indexed lookups.
+
+workers other than 1 annotates shards of the file in that many processes
+(0 for one per CPU); shards are cut at chromosome boundaries, or at
+windows of shard_window bases when it is set. stage_threads > 0 runs the
+lookups of independent stages concurrently on that many threads. The
+input is read, and the result written, on threads of their own at most
+queue_depth batches ahead of or behind the stages (0 for neither), which
+bounds memory to about 2 * queue_depth + 1 batches of batch_size lines.
+
+cache_path enables the cross-job variant cache. Its entries are tagged
+with reference_version, which defaults to the version of the reference
+snapshot; without either the cache cannot tell stale entries apart and
+is refused.
+
+infile may be gzip or BGZF compressed. bgzf_output writes the result as
+<name>.annot.vcf.gz, compressed on bgzf_threads threads (0 for one per
+CPU). With regions_file (BED), only the records in those regions are
+annotated. tracks (names from TRACKS) restricts annotation to those
+tracks and the tracks they depend on; None runs them all. backend chooses
+where the stages read the reference tables from (see backends.py):
+'mysql', 'sqlite' (the file backend_path) or 'memory'. Next to the count
+log, <infile>.metrics.json records the time, queries and rows of every
+stage.
+
+checkpoint_interval > 0 saves a checkpoint every that many batches, to
+<result>.ckpt and, with checkpoint_s3 (bucket, key), to S3; a run of the
+same job finding one resumes from it. Parallel runs (workers other than
+1) are not checkpointed.
+
+chromosomes restricts the in-memory tables to those chromosomes; records
+on other chromosomes are looked up in the database. countsfile receives
+the stage counters as JSON (see engine.write_counts()). Returns the path
+of the result.
+"""
+def run(infile, format, batch_size=engine.BATCH_SIZE,
+    dbsnp_batch_size=ann.DBSNP_BATCH_SIZE, use_index=True,
+    snapshot_dir=None, sweep=False, workers=1, shard_window=0,
+    stage_threads=0, cache_path=None, reference_version=None,
+    bgzf_output=False, bgzf_threads=0, regions_file=None, backend='mysql',
+    backend_path=None, tracks=None, checkpoint_interval=0,
+    checkpoint_s3=None, queue_depth=engine.QUEUE_DEPTH, chromosomes=None,
+    countsfile=None):
 
     print("Running . . .")
 
-    ann.getSnpsFromDbSnp(vcf=infile, format='vcf', tmpextin='', 
-        tmpextout='.1')
-    print("dbSNP - done.")
-    tmpextin = 1
-    tmpextout = 2
-
-    ann.getBigRefGene(vcf=infile, format='vcf', tmpextin='.' + str(tmpextin),
-        tmpextout='.' + str(tmpextout))
-    print("BigRefGene - done.")
-    tmpextin = tmpextin + 1
-    tmpextout = tmpextout + 1
-
-    ann.getGenes(vcf=infile, format='vcf', table='refGene', 
-        promoter_offset=500, tmpextin='.' + str(tmpextin), 
-        tmpextout='.' + str(tmpextout))
-    print("BigRefGene - done.")
-    tmpextin = tmpextin + 1
-    tmpextout = tmpextout + 1
-
-    ann.addOverlapWithCytoband(vcf=infile, format='vcf', table='cytoBand', 
-        tmpextin='.' + str(tmpextin), tmpextout='.' + str(tmpextout))
-    print("Cytoband - done.")
-    tmpextin = tmpextin + 1
-    tmpextout = tmpextout + 1
-
-    ann.addOverlapWithGadAll(vcf=infile, format='vcf', table='gadAll', 
-        tmpextin='.' + str(tmpextin), tmpextout='.' + str(tmpextout))
-    print("gadAll - done.")
-    tmpextin = tmpextin + 1
-    tmpextout = tmpextout + 1
-
-    ann.addOverlapWithGwasCatalog(vcf=infile, format='vcf', 
-        table='gwasCatalog', tmpextin='.' + str(tmpextin), 
-        tmpextout='.' + str(tmpextout))
-    print("GwasCatalog - done.")
-    tmpextin = tmpextin + 1
-    tmpextout = tmpextout + 1
-
-    ann.addOverlapWithMiRNA(vcf=infile, format='vcf', table='targetScanS', 
-        tmpextin='.' + str(tmpextin), tmpextout='.' + str(tmpextout))
-    print("miRNA - done.")
-    tmpextin = tmpextin + 1
-    tmpextout = tmpextout + 1
-
-    ann.addOverlapWitHUGOGeneNomenclature(vcf=infile, format='vcf', 
-        table='hugo', tmpextin='.' + str(tmpextin), 
-        tmpextout='.' + str(tmpextout))
-    print("HUGO Gene Nomenclature Committee - done.")
-    tmpextin = tmpextin + 1
-    tmpextout = tmpextout + 1
-
-    ann.addOverlapWithCnvDatabase(vcf=infile, format='vcf', table='dgv_Cnv', 
-        tmpextin='.' + str(tmpextin), tmpextout='.' + str(tmpextout))
-    print("dgv_Cnv - done.")
-    tmpextin = tmpextin + 1
-    tmpextout = tmpextout + 1
-
-    ann.addOverlapWithCnvDatabase(vcf=infile, format='vcf', 
-        table='abParts_IG_T_CelReceptors', tmpextin='.' + str(tmpextin), 
-        tmpextout='.' + str(tmpextout))
-    print("abParts_IG_T_CelReceptors - done.")
-    tmpextin = tmpextin + 1
-    tmpextout = tmpextout + 1
-
-    ann.addOverlapWithCnvDatabase(vcf=infile, format='vcf', 
-        table='mcCarroll_Cnv', tmpextin='.' + str(tmpextin), 
-        tmpextout='.' + str(tmpextout))
-    print("mcCarroll_Cnv - done.")
-    tmpextin = tmpextin + 1
-    tmpextout = tmpextout + 1
-
-    ann.addOverlapWithCnvDatabase(vcf=infile, format='vcf', 
-        table='conrad_Cnv', tmpextin='.' + str(tmpextin), 
-        tmpextout='.' + str(tmpextout))
-    print("conrad_Cnv - done.")
-    tmpextin = tmpextin + 1
-    tmpextout = tmpextout + 1
-
-    ann.addOverlapWithGenomicSuperDups(vcf=infile, format='vcf', 
-        table='genomicSuperDups', tmpextin='.' + str(tmpextin),
-        tmpextout='.' + str(tmpextout))
-    print("genomicSuperDups - done.")
-    tmpextin = tmpextin + 1
-    tmpextout = tmpextout + 1
-
-    ann.addOverlapWithTfbsConsSites(vcf=infile, table='tfbsConsSites',
-        tmpextin='.' + str(tmpextin), tmpextout='.' + str(tmpextout))
-    print("addOverlapWithTfbsConsSites - done.")
-    tmpextin = tmpextin + 1
-    tmpextout = tmpextout + 1
-
-    ## Cleanup
-    for i in range(1, tmpextin):
-        fu.delete(infile + '.' + str(i))
-
-    os.rename(infile + '.' + str(tmpextin), infile + '.annot')
-    finalout=(infile + '.annot').replace('.vcf.annot', '.annot.vcf')
-    os.rename(infile + '.annot', finalout)
-
-### EOF
\ No newline at end of file
+    select_tracks(tracks)
+    init_worker(snapshot_dir, backend, backend_path, chromosomes)
+
+    if cache_path and not reference_version:
+        if not snapshot_dir:
+            raise ValueError("The variant cache needs a reference version " + \
+                "or a reference snapshot")
+        reference_version = snapshot.open_snapshot(snapshot_dir).version
+
+    name = infile[:-len('.gz')] if infile.endswith('.gz') else infile
+    finalout = (name + '.annot').replace('.vcf.annot', '.annot.vcf')
+    if bgzf_output:
+        finalout = finalout + '.gz'
+    compressed = {'compress': bgzf_output,
+        'compress_threads': bgzf_threads or os.cpu_count()}
+    make_stages = functools.partial(stages, format=format,
+        dbsnp_batch_size=dbsnp_batch_size, use_index=use_index, sweep=sweep,
+        cache_path=cache_path, reference_version=reference_version,
+        tracks=tracks)
+
+    source = infile
+    if regions_file:
+        source = infile + '.regions'
+        regions.extract(infile, regions_file, source)
+    try:
+        if (workers == 1):
+            progress = None
+            if (checkpoint_interval > 0):
+                bucket, key = checkpoint_s3 or (None, None)
+                progress = checkpoint.Checkpoint(finalout + '.ckpt',
+                    interval=checkpoint_interval, bucket=bucket, key=key)
+            engine.annotate_file(source, finalout, make_stages(),
+                logfile=infile + '.count.log', batch_size=batch_size,
+                verbose=True, threads=stage_threads, summary=True,
+                metricsfile=infile + '.metrics.json', checkpoint=progress,
+                queue_depth=queue_depth, countsfile=countsfile, **compressed)
+        else:
+            engine.annotate_parallel(source, finalout, make_stages,
+                logfile=infile + '.count.log', batch_size=batch_size,
+                workers=workers or None, window=shard_window,
+                initializer=init_worker,
+                initargs=(snapshot_dir, backend, backend_path, chromosomes),
+                verbose=True, threads=stage_threads, summary=True,
+                metricsfile=infile + '.metrics.json',
+                queue_depth=queue_depth, countsfile=countsfile, **compressed)
+    finally:
+        if (source != infile):
+            os.remove(source)
+
+    return finalout
+
+### EOF
@@ -0,0 +1,593 @@
+# engine.py
+#
+# Streaming annotation engine
+#
+# Reads the input file once and pushes every record through all annotation
+# stages in memory, in batches of lines. Each line is split into a record
+# once and written out once (see record.py). Each stage sees exactly the
+# columns it would have read back from the previous stage's output file, so
+# the result is identical to running the stages one after the other over
+# numbered temporary files. With a thread pool, the lookups of stages that
+# do not depend on each other's output run concurrently, while the results
+# are still applied to each line in stage order. annotate_parallel() splits
+# the input into shards of contiguous lines and annotates them in a process
+# pool. Input may be gzip or BGZF compressed, and the result can be written
+# as BGZF (see bgzf.py). What each stage cost can be written to a JSON
+# metrics file next to the count log. annotate_file() can save checkpoints
+# to resume an interrupted run from (see checkpoint.py). Parts of a file
+# annotated elsewhere (see affinity.py) can write their counters to a JSON
+# counts file, for merge_counts() to put one count log together.
+#
+##
+
+import os
+import re
+import json
+import time
+import queue
+import shutil
+import resource
+import tempfile
+import threading
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+import bgzf
+from record import Record
+
+# Default number of input lines pushed through the stages at a time
+BATCH_SIZE = 10000
+
+# Line breaks recognized when reading a file in text mode
+LINE_BREAKS = re.compile('\r\n|\r|\n')
+
+# Lines a shard holds at least before it is cut at a region boundary
+SHARD_LINES = 10000
+
+# Batches the reader may be ahead of the stages, and the writer behind
+QUEUE_DEPTH = 2
+
+# Marks the end of the items passed through a queue
+END = object()
+
+
+"""Reads the input file as batches of stripped lines
+"""
+def read_batches(fh, batch_size=BATCH_SIZE):
+    batch = []
+    for line in fh:
+        batch.append(line.strip())
+        if (len(batch) >= batch_size):
+            yield batch
+            batch = []
+    if (len(batch) > 0):
+        yield batch
+
+
+"""Reads the input file like read_batches(), with every batch the offset
+after its last line, for seek() to resume from
+"""
+def read_batches_at(fh, batch_size=BATCH_SIZE):
+    batch = []
+    for line in iter(fh.readline, ''):
+        batch.append(line.strip())
+        if (len(batch) >= batch_size):
+            yield batch, fh.tell()
+            batch = []
+    if (len(batch) > 0):
+        yield batch, fh.tell()
+
+
+"""Iterates over items produced on a reader thread, at most depth items
+ahead of the consumer; the reader waits while the queue is full
+With depth 0 the items are produced on the consumer's thread. An
+exception on the reader thread is raised again to the consumer.
+"""
+class ReadAhead(object):
+
+    def __init__(self, items, depth=QUEUE_DEPTH):
+        self.items = items
+        self.depth = depth
+        self.queue = None
+        self.thread = None
+        self.cancelled = threading.Event()
+        if (depth > 0):
+            self.queue = queue.Queue(maxsize=depth)
+            self.thread = threading.Thread(target=self.read, daemon=True)
+            self.thread.start()
+
+    def put(self, item):
+        while not self.cancelled.is_set():
+            try:
+                self.queue.put(item, timeout=0.1)
+                return True
+            except queue.Full:
+                pass
+        return False
+
+    """Queues (item, None) for every item, then (END, the exception
+    raised or None)
+    """
+    def read(self):
+        try:
+            for item in self.items:
+                if not self.put((item, None)):
+                    return
+        except BaseException as e:
+            self.put((END, e))
+            return
+        self.put((END, None))
+
+    def __iter__(self):
+        if self.thread is None:
+            for item in self.items:
+                yield item
+            return
+        while True:
+            item, error = self.queue.get()
+            if item is END:
+                if error is not None:
+                    raise error
+                return
+            yield item
+
+    def close(self):
+        self.cancelled.set()
+        if self.thread is not None:
+            self.thread.join()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+
+"""Calls write(item) on a writer thread for every item put(), in order,
+at most depth items behind; put() waits while the queue is full
+With depth 0 the items are written on the caller's thread. An exception
+in write() is raised again by the next put() or by close().
+"""
+class WriteBehind(object):
+
+    def __init__(self, write, depth=QUEUE_DEPTH):
+        self.write = write
+        self.error = None
+        self.queue = None
+        self.thread = None
+        if (depth > 0):
+            self.queue = queue.Queue(maxsize=depth)
+            self.thread = threading.Thread(target=self.drain, daemon=True)
+            self.thread.start()
+
+    def drain(self):
+        while True:
+            item = self.queue.get()
+            if item is END:
+                return
+            if self.error is None:
+                try:
+                    self.write(item)
+                except BaseException as e:
+                    self.error = e
+
+    def put(self, item):
+        if self.error is not None:
+            raise self.error
+        if self.thread is None:
+            self.write(item)
+        else:
+            self.queue.put(item)
+
+    """Waits for the items still queued to be written
+    """
+    def close(self):
+        if self.thread is not None:
+            self.queue.put(END)
+            self.thread.join()
+            self.thread = None
+        if self.error is not None:
+            raise self.error
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            self.close()
+        elif self.thread is not None:
+            self.queue.put(END)
+            self.thread.join()
+            self.thread = None
+
+
+"""Hands one stage's output lines to the next stage as if they had been
+written to a file and read back line by line
+"""
+def relay(lines):
+    out = []
+    for line in lines:
+        if ('\n' in line) or ('\r' in line):
+            out.extend([l.strip()
+                for l in LINE_BREAKS.split(line + '\n')[:-1]])
+        else:
+            out.append(line.strip())
+    return out
+
+
+"""Hands one stage's records to the next stage like relay()
+Intact records are passed on as they are; the others are written out,
+read back and split again.
+"""
+def relay_records(records):
+    if all([record.intact() for record in records]):
+        return records
+    out = []
+    for record in records:
+        if record.intact():
+            out.append(record)
+        else:
+            out.extend([Record(line, record.sep)
+                for line in relay([record.line()])])
+    return out
+
+
+"""For every stage, the earlier stages writing a column its lookups read
+"""
+def dependencies(stages):
+    deps = []
+    for k, stage in enumerate(stages):
+        deps.append([j for j in range(k)
+            if set(stage.reads) & set(stages[j].writes)])
+    return deps
+
+
+"""Pushes one batch of input lines through all stages
+
+With an executor, each stage's lookups are submitted as soon as the last
+stage it depends on has been applied (stages without dependencies start
+right away), and its results are applied when its turn comes. The lines
+a stage's keys were taken from can only differ from the ones it is
+applied to in columns it does not read, and any key that still differs
+is looked up again, so the output is the same as without an executor.
+"""
+def annotate_batch(lines, stages, executor=None, deps=None):
+    records = [Record(line, stages[0].sep) for line in lines]
+    if executor is None:
+        for n, stage in enumerate(stages):
+            if (n > 0):
+                records = relay_records(records)
+            records = stage.process(records)
+        return [record.line() for record in records]
+
+    if deps is None:
+        deps = dependencies(stages)
+    waiting = {}
+    pending = {}
+    for k, stage in enumerate(stages):
+        if (len(deps[k]) == 0):
+            pending[k] = executor.submit(stage.prefetch, records)
+        else:
+            waiting.setdefault(max(deps[k]), []).append(k)
+
+    for n, stage in enumerate(stages):
+        if (n > 0):
+            records = relay_records(records)
+        prefetched = None
+        if n in pending:
+            prefetched = pending.pop(n).result()
+        records = stage.process(records, prefetched)
+        if n in waiting:
+            relayed = relay_records(records)
+            for k in waiting[n]:
+                pending[k] = executor.submit(stages[k].prefetch,
+                    list(relayed))
+    return [record.line() for record in records]
+
+
+"""Writes the stage counters to the count log, in stage order
+"""
+def write_log(stages, logfile, verbose=False):
+    for stage in stages:
+        lines = stage.report()
+        if lines is not None:
+            with open(logfile, stage.log_mode) as fh_log:
+                fh_log.write(''.join(lines))
+            if stage.echo:
+                for line in lines:
+                    print(line.rstrip('\n'))
+        if verbose:
+            for label in stage.progress():
+                print(f"{label} - done.")
+
+
+"""Adds the lookup counters of the whole pipeline to the count log: how
+many lookup keys were repeats within a batch and, when the stages use
+one, the variant cache hits and misses
+"""
+def write_summary(stages, logfile):
+    lookups = sum([stage.lookups for stage in stages])
+    distinct = sum([stage.distinct_lookups for stage in stages])
+    ratio = (lookups / float(distinct)) if (distinct > 0) else 1.0
+    with open(logfile, 'a') as fh_log:
+        fh_log.write(f"Lookup keys: {str(lookups)} in batches, " + \
+            f"{str(distinct)} distinct (dedup ratio {ratio:.2f})\n")
+
+    if any([stage.cache is not None for stage in stages]):
+        hits = sum([stage.cache_hits for stage in stages])
+        misses = sum([stage.cache_misses for stage in stages])
+        with open(logfile, 'a') as fh_log:
+            fh_log.write(f"Variant cache: {str(hits)} hits, " + \
+                f"{str(misses)} misses\n")
+
+
+"""Peak resident memory, in MB, of this process and of the worker
+processes it has waited for
+"""
+def peak_memory():
+    return max(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+        resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss) / 1024.0
+
+
+"""Adds the peak memory of the run to the count log, with the batch size
+and queue depth that bound it; peak defaults to peak_memory()
+"""
+def write_memory(logfile, batch_size, queue_depth, peak=None):
+    if peak is None:
+        peak = peak_memory()
+    with open(logfile, 'a') as fh_log:
+        fh_log.write(f"Peak memory: {peak:.1f} MB (batches of " + \
+            f"{str(batch_size)} lines, queue depth {str(queue_depth)})\n")
+
+
+"""Writes the metric counters of every stage to a JSON metrics file
+
+wall_time and cpu_time are the seconds spent in the stage, summed over
+the threads and processes that ran it, and variants_per_second relates
+the records it annotated to its wall time. elapsed is the wall time of
+the whole run.
+"""
+def write_metrics(stages, metricsfile, elapsed):
+    metrics = []
+    for stage in stages:
+        entry = {'stage': type(stage).__name__,
+            'table': getattr(stage, 'table', None)}
+        for name in stage.metric_counters + stage.lookup_counters:
+            entry[name] = getattr(stage, name)
+        entry['variants_per_second'] = (stage.variants / stage.wall_time) \
+            if (stage.wall_time > 0) else None
+        metrics.append(entry)
+
+    with open(metricsfile, 'w') as fh:
+        json.dump({'wall_time': elapsed, 'stages': metrics}, fh, indent=2)
+
+
+"""Writes the counters of the stages, as stage.counts() gives them, to a
+JSON counts file along with the run's wall time and peak memory
+"""
+def write_counts(stages, countsfile, elapsed):
+    with open(countsfile, 'w') as fh:
+        json.dump({'counts': [stage.counts() for stage in stages],
+            'wall_time': elapsed, 'peak_memory': peak_memory()}, fh)
+
+
+"""Fresh stages from make_stages() holding the counters of all parts of a
+file, each given as a list of stage.counts()
+"""
+def merge_counts(make_stages, counts):
+    stages = make_stages()
+    for part_counts in counts:
+        for stage, stage_counts in zip(stages, part_counts):
+            stage.merge(stage_counts)
+    return stages
+
+
+"""Annotates infile with the given stages and writes the result to outfile
+
+The output is written to a temporary file first and renamed once all
+records have been processed, so a failed run never leaves a partial
+result behind. threads > 0 runs the stage lookups of each batch on that
+many threads; summary adds write_summary() and write_memory() to the
+count log. compress writes outfile as BGZF, compressing on
+compress_threads threads. With metricsfile, write_metrics() records what
+each stage cost; countsfile gets the counters through write_counts().
+
+The input is read queue_depth batches ahead on a reader thread and the
+output written up to queue_depth batches behind on a writer thread, so
+reading and writing overlap with the stages while at most 2 * queue_depth
++ 1 batches are held in memory; a full queue holds the reader back until
+the stages catch up. queue_depth 0 reads and writes on the calling thread.
+
+With a checkpoint (checkpoint.Checkpoint), the partial result is kept
+after a failure and progress is saved every checkpoint.interval batches;
+a run finding a checkpoint of the same stages over the same input
+resumes from it.
+"""
+def annotate_file(infile, outfile, stages, logfile=None, 
+    batch_size=BATCH_SIZE, verbose=False, threads=0, summary=False,
+    compress=False, compress_threads=1, metricsfile=None, checkpoint=None,
+    queue_depth=0, countsfile=None):
+
+    begun = time.perf_counter()
+    tmpfile = outfile + '.part'
+    executor = None
+    state = None
+    if checkpoint is not None:
+        state = checkpoint.load(stages, infile, tmpfile)
+    try:
+        for stage in stages:
+            started = stage.timer()
+            stage.open()
+            stage.charge(started)
+        if state is not None:
+            for stage, counts in zip(stages, state['counts']):
+                stage.merge(counts)
+            os.truncate(tmpfile, state['output_offset'])
+
+        if (threads > 0):
+            executor = ThreadPoolExecutor(max_workers=threads)
+        deps = dependencies(stages)
+
+        with bgzf.open_input(infile) as fh, \
+            bgzf.open_output(tmpfile, compress, compress_threads,
+                append=(state is not None)) as fh_out:
+            if checkpoint is None:
+                batches = ((batch, None)
+                    for batch in read_batches(fh, batch_size))
+            else:
+                if state is not None:
+                    fh.seek(state['input_offset'])
+                batches = read_batches_at(fh, batch_size)
+
+            # Writes a batch's lines, then the checkpoint taken with them
+            def write(item):
+                lines, offset, counts = item
+                fh_out.write(''.join([line + '\n' for line in lines]))
+                if counts is not None:
+                    bgzf.flush_output(fh_out)
+                    checkpoint.save(stages, counts, infile, tmpfile, offset,
+                        os.path.getsize(tmpfile))
+
+            with ReadAhead(batches, queue_depth) as reader, \
+                WriteBehind(write, queue_depth) as writer:
+                for n, (batch, offset) in enumerate(reader, 1):
+                    lines = annotate_batch(batch, stages, executor, deps)
+                    counts = None
+                    if (checkpoint is not None) and \
+                        (n % checkpoint.interval == 0):
+                        counts = [stage.counts() for stage in stages]
+                    writer.put((lines, offset, counts))
+    finally:
+        # Wait for lookups still running before the stages are closed
+        if executor is not None:
+            executor.shutdown(wait=True)
+        for stage in stages:
+            stage.close()
+
+    os.replace(tmpfile, outfile)
+    if checkpoint is not None:
+        checkpoint.remove()
+
+    if logfile is not None:
+        write_log(stages, logfile, verbose=verbose)
+        if summary:
+            write_summary(stages, logfile)
+            write_memory(logfile, batch_size, queue_depth)
+    if metricsfile is not None:
+        write_metrics(stages, metricsfile, time.perf_counter() - begun)
+    if countsfile is not None:
+        write_counts(stages, countsfile, time.perf_counter() - begun)
+
+
+"""Splits infile into shard files of contiguous lines in directory
+
+A shard is cut where the chromosome changes or, with window, where the
+position moves into the next window of that many bases, once it holds at
+least min_lines lines. Header lines stay with the lines around them, so
+the shards concatenate back to the input.
+"""
+def split_shards(infile, directory, window=0, min_lines=SHARD_LINES,
+    sep='\t'):
+
+    shards = []
+    fh_shard = None
+    region = None
+    count = 0
+    try:
+        with bgzf.open_input(infile) as fh:
+            for line in fh:
+                if not line.startswith('#'):
+                    fields = line.split(sep, 2)
+                    new_region = fields[0].strip()
+                    if window and (len(fields) > 1) and \
+                        fields[1].strip().isdigit():
+                        new_region = (new_region,
+                            int(fields[1].strip()) // window)
+                    if (fh_shard is not None) and (new_region != region) and \
+                        (count >= min_lines):
+                        fh_shard.close()
+                        fh_shard = None
+                    region = new_region
+
+                if fh_shard is None:
+                    shards.append(os.path.join(directory,
+                        f"shard{len(shards):06d}"))
+                    fh_shard = open(shards[-1], 'w')
+                    count = 0
+                fh_shard.write(line)
+                count = count + 1
+    finally:
+        if fh_shard is not None:
+            fh_shard.close()
+
+    return shards
+
+
+"""Annotates one shard in a worker process and returns the stage counters
+"""
+def annotate_shard(make_stages, infile, outfile, batch_size=BATCH_SIZE,
+    threads=0, queue_depth=0):
+    stages = make_stages()
+    annotate_file(infile, outfile, stages, batch_size=batch_size,
+        threads=threads, queue_depth=queue_depth)
+    return [stage.counts() for stage in stages]
+
+
+"""Annotates infile like annotate_file(), with the shards from
+split_shards() spread over a pool of worker processes
+
+make_stages is a picklable callable returning a fresh list of stages;
+every shard gets its own. The shard outputs are concatenated in input
+order and the counters of all shards are merged into one count log.
+initializer(*initargs) runs once in every worker, and threads and
+queue_depth are passed on to annotate_file() for every shard. With
+compress, the concatenated output is written as BGZF. The metrics of all
+shards are merged into one metricsfile, and their counters into one
+countsfile.
+"""
+def annotate_parallel(infile, outfile, make_stages, logfile=None,
+    batch_size=BATCH_SIZE, workers=None, window=0, min_lines=SHARD_LINES,
+    initializer=None, initargs=(), verbose=False, threads=0, summary=False,
+    compress=False, compress_threads=1, metricsfile=None, queue_depth=0,
+    countsfile=None):
+
+    begun = time.perf_counter()
+    directory = tempfile.mkdtemp(prefix=os.path.basename(outfile) + '.',
+        dir=os.path.dirname(os.path.abspath(outfile)))
+    tmpfile = outfile + '.part'
+    try:
+        shards = split_shards(infile, directory, window=window,
+            min_lines=min_lines)
+        outputs = [shard + '.annot' for shard in shards]
+
+        with ProcessPoolExecutor(max_workers=workers or os.cpu_count(),
+            initializer=initializer, initargs=initargs) as pool:
+            counts = list(pool.map(annotate_shard,
+                [make_stages] * len(shards), shards, outputs,
+                [batch_size] * len(shards), [threads] * len(shards),
+                [queue_depth] * len(shards)))
+
+        if compress:
+            fh_out = bgzf.BgzfWriter(tmpfile, threads=compress_threads)
+        else:
+            fh_out = open(tmpfile, 'wb')
+        with fh_out:
+            for output in outputs:
+                with open(output, 'rb') as fh:
+                    shutil.copyfileobj(fh, fh_out)
+    finally:
+        shutil.rmtree(directory, ignore_errors=True)
+
+    os.replace(tmpfile, outfile)
+
+    stages = merge_counts(make_stages, counts)
+
+    if logfile is not None:
+        write_log(stages, logfile, verbose=verbose)
+        if summary:
+            write_summary(stages, logfile)
+            write_memory(logfile, batch_size, queue_depth)
+    if metricsfile is not None:
+        write_metrics(stages, metricsfile, time.perf_counter() - begun)
+    if countsfile is not None:
+        write_counts(stages, countsfile, time.perf_counter() - begun)
+
+### EOF
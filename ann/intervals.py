@@ -0,0 +1,427 @@
+# intervals.py
+#
+# In-memory interval index for the reference tables
+#
+# Small reference tables (cytoBand, the CNV tables, genomicSuperDups,
+# gadAll, hugo, targetScanS) are loaded once per process, from the
+# database or from a memory-mapped reference snapshot, and kept as
+# per-chromosome arrays of interval starts and ends, sorted by start. Each
+# partition also nests its intervals into a nested containment list:
+# every interval sits in the list of the smallest interval containing it,
+# so within a list starts and ends both increase. A stabbing query bisects
+# the top list on the ends, takes the intervals up to the first one
+# starting past the position and descends only into the lists of those
+# hits, which costs O(log n) per list visited plus the hits however long
+# some of the intervals are. Sweep
+# answers the same queries for coordinate-sorted input in a single merge
+# pass over the variants and the intervals. CoverageMap merges the
+# intervals of several tables into one structure telling, with a single
+# probe, which of them cover a position. A process serving only some
+# chromosomes (see set_chromosomes()) keeps only their partitions; the
+# stages ask held() before using an index and query the database for the
+# other chromosomes.
+#
+##
+
+import re
+from array import array
+from bisect import bisect_left, bisect_right
+from heapq import heappush, heappop
+
+# Indexes already loaded by this process, keyed by table and columns
+_indexes = {}
+
+# Coverage maps already built by this process, keyed by their tables
+_coverages = {}
+
+# Reference snapshot consulted before the database (see snapshot.py)
+_snapshot = None
+
+# Chromosomes the indexes of this process hold (None for all of them),
+# named without the chr prefix
+_chromosomes = None
+
+
+"""Normalizes a chromosome name the way MySQL's default collation
+compares it
+"""
+def chrom_key(chrom):
+    if isinstance(chrom, bytes):
+        chrom = chrom.decode('utf-8')
+    return str(chrom).rstrip(' ').lower()
+
+
+"""Chromosome name as chromosome sets name it: "chr1", "Chr1" and "1"
+are all "1"
+"""
+def chrom_name(chrom):
+    chrom = chrom_key(chrom)
+    if chrom.startswith('chr'):
+        chrom = chrom[3:]
+    return chrom
+
+
+"""Restricts the indexes of this process to the partitions of chroms
+(with or without the chr prefix); None serves all chromosomes again
+Indexes already loaded are dropped.
+"""
+def set_chromosomes(chroms):
+    global _chromosomes
+    if chroms is None:
+        _chromosomes = None
+    else:
+        names = set([chrom_name(c) for c in chroms])
+        for name in names:
+            if not re.fullmatch('[0-9a-z_]+', name):
+                raise ValueError(f"Invalid chromosome name {name}")
+        _chromosomes = names
+    _indexes.clear()
+    _coverages.clear()
+
+
+def chromosomes():
+    return _chromosomes
+
+
+"""True if the indexes of this process hold chrom
+"""
+def held(chrom):
+    return (_chromosomes is None) or (chrom_name(chrom) in _chromosomes)
+
+
+"""Where clause keeping the rows of the chromosomes held, '' when all
+chromosomes are
+"""
+def chromosome_filter(chrom_column):
+    if _chromosomes is None:
+        return ''
+    names = []
+    for name in sorted(_chromosomes):
+        names.extend(["'" + name + "'", "'chr" + name + "'"])
+    return ' where lower(' + chrom_column + ') in (' + ', '.join(names) + ')'
+
+
+"""Intervals of one chromosome, sorted by start
+
+rank holds each interval's position in the table, so hits can be returned
+in the order the database would have returned them. nesting holds the
+nested containment list as nest() builds it, when it was built already.
+"""
+class Partition(object):
+
+    def __init__(self, starts, ends, ranks, rows, nesting=None):
+        self.starts = starts
+        self.ends = ends
+        self.ranks = ranks
+        self.rows = rows
+        if nesting is None:
+            nesting = nest(starts, ends)
+        self.members, self.member_ends, self.lists = nesting
+
+    def __len__(self):
+        return len(self.starts)
+
+    """Indices of the intervals with start <= hi and lo <= end
+    """
+    def overlapping(self, lo, hi):
+        hits = []
+        starts = self.starts
+        members = self.members
+        lists = self.lists
+        pending = []
+        first, last = 0, lists[0]
+        while True:
+            j = bisect_left(self.member_ends, lo, first, last)
+            while (j < last) and (starts[members[j]] <= hi):
+                i = members[j]
+                hits.append(i)
+                if (lists[i + 1] > lists[i]):
+                    pending.append((lists[i], lists[i + 1]))
+                j = j + 1
+            if (len(pending) == 0):
+                break
+            first, last = pending.pop()
+        if (len(hits) > 1):
+            hits.sort(key=lambda h: self.ranks[h])
+        return hits
+
+
+"""Nested containment list of intervals sorted by start
+
+Every interval goes into the list of the smallest interval containing it
+(the top list when none does), so no interval of a list contains another
+and both their starts and their ends increase along it. Returns the
+intervals' indices list by list (members), their ends in the same order
+(member_ends) and the bounds of each list in members (lists): the top
+list is members[0:lists[0]] and the list nested in interval i is
+members[lists[i]:lists[i + 1]].
+"""
+def nest(starts, ends):
+    order = sorted(range(len(starts)), key=lambda i: (starts[i], -ends[i]))
+    children = [[] for i in range(len(starts) + 1)]
+    stack = []
+    for i in order:
+        while (len(stack) > 0) and (ends[stack[-1]] < ends[i]):
+            stack.pop()
+        children[stack[-1] + 1 if (len(stack) > 0) else 0].append(i)
+        stack.append(i)
+
+    members = array('q')
+    lists = array('q')
+    for nested in children:
+        members.extend(nested)
+        lists.append(len(members))
+    member_ends = array('q', [ends[i] for i in members])
+    return members, member_ends, lists
+
+
+"""Per-chromosome stabbing index over one reference table
+columns holds the table's column names, when they are known.
+"""
+class IntervalIndex(object):
+
+    def __init__(self, table, columns=None):
+        self.table = table
+        self.columns = columns
+        self.partitions = {}
+
+    """Builds the index from (chrom, start, end, row) entries in table order
+    """
+    @classmethod
+    def build(cls, table, entries):
+        index = cls(table)
+        byChrom = {}
+        rank = 0
+        for chrom, start, end, row in entries:
+            if (chrom is not None) and (start is not None) and \
+                (end is not None):
+                byChrom.setdefault(chrom_key(chrom), []).append(
+                    (int(start), rank, int(end), row))
+            rank = rank + 1
+
+        for chrom, intervals in byChrom.items():
+            intervals.sort(key=lambda x: (x[0], x[1]))
+            index.partitions[chrom] = Partition(
+                array('q', [x[0] for x in intervals]),
+                array('q', [x[2] for x in intervals]),
+                array('q', [x[1] for x in intervals]),
+                [x[3] for x in intervals])
+        return index
+
+    def __len__(self):
+        return sum([len(p) for p in self.partitions.values()])
+
+    """The index with only the partitions of the chromosomes held
+    """
+    def restricted(self):
+        index = IntervalIndex(self.table, self.columns)
+        index.partitions = dict([(chrom, partition) for chrom, partition
+            in self.partitions.items() if held(chrom)])
+        return index
+
+    """Rows with start <= hi and lo <= end, in table order
+    chrom None searches every chromosome.
+    """
+    def overlapping(self, chrom, lo, hi):
+        if chrom is None:
+            hits = []
+            for partition in self.partitions.values():
+                hits.extend([(partition.ranks[i], partition.rows[i])
+                    for i in partition.overlapping(lo, hi)])
+            hits.sort(key=lambda h: h[0])
+            return [row for rank, row in hits]
+
+        partition = self.partitions.get(chrom_key(chrom))
+        if partition is None:
+            return []
+        return [partition.rows[i] for i in partition.overlapping(lo, hi)]
+
+    """Rows whose interval contains pos, in table order
+    """
+    def stab(self, chrom, pos):
+        return self.overlapping(chrom, pos, pos)
+
+
+"""Stabbing queries for positions that arrive sorted by chromosome and
+position
+
+Walks the positions and the partition's intervals (sorted by start)
+together, keeping the intervals that have started in a heap ordered by
+end: every interval is pushed and popped once, so a coordinate-sorted
+file costs O(n + m log m) instead of n index probes. Chromosomes only
+need to be contiguous, not in any particular order. As soon as a
+position goes backwards, or a chromosome comes back, the sweep gives up
+and answers every further query from the index.
+"""
+class Sweep(object):
+
+    def __init__(self, index):
+        self.index = index
+        self.sorted = True
+        self.chrom = None
+        self.partition = None
+        self.last = None
+        self.next = 0
+        self.active = []
+        self.seen = set()
+
+    def start(self, chrom):
+        self.chrom = chrom
+        self.partition = self.index.partitions.get(chrom)
+        self.last = None
+        self.next = 0
+        self.active = []
+        self.seen.add(chrom)
+
+    def stab(self, chrom, pos):
+        if not self.sorted:
+            return self.index.stab(chrom, pos)
+
+        key = chrom_key(chrom)
+        if (key != self.chrom):
+            if (key in self.seen):
+                self.sorted = False
+                return self.index.stab(chrom, pos)
+            self.start(key)
+        elif (pos < self.last):
+            self.sorted = False
+            return self.index.stab(chrom, pos)
+        self.last = pos
+
+        partition = self.partition
+        if partition is None:
+            return []
+
+        while (self.next < len(partition)) and \
+            (partition.starts[self.next] <= pos):
+            heappush(self.active, (partition.ends[self.next], self.next))
+            self.next = self.next + 1
+        while (len(self.active) > 0) and (self.active[0][0] < pos):
+            heappop(self.active)
+
+        hits = [i for end, i in self.active]
+        if (len(hits) > 1):
+            hits.sort(key=lambda h: partition.ranks[h])
+        return [partition.rows[i] for i in hits]
+
+
+"""Which of several tables cover each position
+
+Every chromosome is cut into elementary intervals at the starts and ends
+of all the tables' intervals, and each elementary interval carries a
+bitmask with bit k set when the k-th table has an interval covering it.
+A binary search over the cut points then answers for all tables at once.
+"""
+class CoverageMap(object):
+
+    def __init__(self, tables):
+        self.tables = tables
+        self.partitions = {}
+
+    """Builds the map from the IntervalIndex of each table, in order
+    """
+    @classmethod
+    def build(cls, tables, indexes):
+        coverage = cls(tables)
+        changes = {}
+        for bit, index in enumerate(indexes):
+            for chrom, partition in index.partitions.items():
+                events = changes.setdefault(chrom, [])
+                for start, end in zip(partition.starts, partition.ends):
+                    if (start <= end):
+                        events.append((start, bit, 1))
+                        events.append((end + 1, bit, -1))
+
+        for chrom, events in changes.items():
+            events.sort()
+            counts = [0] * len(tables)
+            bounds = array('q')
+            masks = array('q')
+            i = 0
+            while (i < len(events)):
+                pos = events[i][0]
+                while (i < len(events)) and (events[i][0] == pos):
+                    counts[events[i][1]] = counts[events[i][1]] + events[i][2]
+                    i = i + 1
+                mask = 0
+                for bit, count in enumerate(counts):
+                    if (count > 0):
+                        mask = mask | (1 << bit)
+                if (len(masks) == 0) or (masks[-1] != mask):
+                    bounds.append(pos)
+                    masks.append(mask)
+            coverage.partitions[chrom] = (bounds, masks)
+        return coverage
+
+    """Bitmask of the tables covering pos
+    """
+    def mask(self, chrom, pos):
+        partition = self.partitions.get(chrom_key(chrom))
+        if partition is None:
+            return 0
+        bounds, masks = partition
+        i = bisect_right(bounds, pos) - 1
+        if (i < 0):
+            return 0
+        return masks[i]
+
+
+"""Loads a whole table into an IntervalIndex
+"""
+def load_table(cursor, table, chrom_column, start_column, end_column):
+    cursor.execute('select * from ' + table + \
+        chromosome_filter(chrom_column) + ';')
+    names = [str(d[0]) for d in cursor.description]
+    c = names.index(chrom_column)
+    s = names.index(start_column)
+    e = names.index(end_column)
+    index = IntervalIndex.build(table,
+        [(row[c], row[s], row[e], row) for row in cursor.fetchall()])
+    index.columns = names
+    return index
+
+
+"""Makes get_index() serve tables from an opened reference snapshot
+"""
+def set_snapshot(snapshot):
+    global _snapshot
+    _snapshot = snapshot
+
+
+"""Returns the index of a table, loading it on first use in this process
+
+The index comes from the reference snapshot when one is set and holds the
+table; otherwise the table is read through the cursor returned by
+connect(), which is only called in that case. Only the partitions of the
+chromosomes held are kept.
+"""
+def get_index(connect, table, chrom_column='chrom', start_column='chromStart',
+    end_column='chromEnd'):
+    key = (table, chrom_column, start_column, end_column)
+    if key not in _indexes:
+        index = None
+        if _snapshot is not None:
+            index = _snapshot.index(table, chrom_column, start_column,
+                end_column)
+            if (index is not None) and (_chromosomes is not None):
+                index = index.restricted()
+        if index is None:
+            index = load_table(connect(), table, chrom_column,
+                start_column, end_column)
+        _indexes[key] = index
+    return _indexes[key]
+
+
+"""Returns the coverage map of tables, built on first use in this process
+from their indexes (see get_index())
+"""
+def get_coverage(connect, tables, chrom_column='chrom',
+    start_column='chromStart', end_column='chromEnd'):
+    key = (tuple(tables), chrom_column, start_column, end_column)
+    if key not in _coverages:
+        _coverages[key] = CoverageMap.build(list(tables),
+            [get_index(connect, table, chrom_column, start_column,
+            end_column) for table in tables])
+    return _coverages[key]
+
+### EOF
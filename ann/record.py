@@ -0,0 +1,166 @@
+# record.py
+#
+# Variant records passed between the annotation stages
+#
+# A line is split into its columns once, when it enters the stages, and
+# joined back once, when it is written out. Only the columns up to INFO are
+# split out; FORMAT and the sample columns after it, which no stage reads,
+# stay in one string that is passed through as it was read. Stages annotate
+# INFO by appending their contributions, in order, instead of rebuilding
+# the column; the contributions are only joined when a stage reads INFO or
+# the line is written. A record that reads back differently from how it
+# would be written (a column or line break in a value, whitespace that
+# reading a line would strip) is not intact and is serialized and split
+# again before the next stage sees it. The variant the stages normalize
+# from a record (see annotate.Variant) is kept with it until one of the
+# columns it was taken from changes.
+#
+##
+
+# Column holding INFO
+INFO = 7
+
+
+"""One line of a batch, split into columns
+
+fields holds CHROM to INFO and, for lines with more columns, the rest of
+the line as its last item. Header lines are records too; each stage
+decides which lines it treats as headers through startswith(), as it did
+with the text of the line.
+"""
+class Record(object):
+    __slots__ = ('fields', 'sep', 'info', 'text', 'broken', 'variant')
+
+    def __init__(self, line, sep='\t'):
+        self.fields = line.split(sep, INFO + 1)
+        self.sep = sep
+        self.info = None
+        self.text = line
+        self.broken = False
+        self.variant = None
+
+    """Marks the record as not intact if value cannot be read back as
+    written
+    """
+    def check(self, value):
+        if (self.sep in value) or ('\n' in value) or ('\r' in value):
+            self.broken = True
+
+    """Contributions to INFO not joined yet, starting with the column as
+    it was
+    """
+    def pending(self):
+        if self.info is None:
+            return [self.fields[INFO]]
+        return self.info
+
+    """INFO as a stage reads it, with all contributions so far
+    """
+    def get_info(self):
+        if self.info is not None:
+            self.fields[INFO] = ''.join(self.info)
+            self.info = None
+        return self.fields[INFO]
+
+    def set_info(self, value):
+        self.check(value)
+        self.fields[INFO] = value
+        self.info = None
+        self.text = None
+
+    """Appends value to INFO
+    """
+    def add_info(self, value):
+        self.check(value)
+        if self.info is None:
+            self.info = [self.fields[INFO]]
+        self.info.append(value)
+        self.text = None
+
+    """True if INFO ends with the character c
+    """
+    def info_endswith(self, c):
+        for piece in reversed(self.pending()):
+            if (len(piece) > 0):
+                return piece.endswith(c)
+        return False
+
+    def info_startswith(self, prefix):
+        head = ''
+        for piece in self.pending():
+            head = head + piece
+            if (len(head) >= len(prefix)):
+                break
+        return head.startswith(prefix)
+
+    def set_field(self, i, value):
+        if (i == INFO):
+            self.set_info(value)
+            return
+        self.check(value)
+        self.fields[i] = value
+        self.text = None
+        if (self.variant is not None) and (i in self.variant.inds):
+            self.variant = None
+
+    """Column i, with the contributions to INFO
+    """
+    def column(self, i):
+        if (i == INFO):
+            return self.get_info()
+        return self.fields[i]
+
+    """Puts pad after every column separator, as joining the columns with
+    the separator followed by pad would
+    """
+    def pad(self, pad):
+        if (len(self.fields) > INFO):
+            self.get_info()
+        if (len(self.fields) > INFO + 1):
+            self.fields[-1] = self.fields[-1].replace(self.sep,
+                self.sep + pad)
+        fields = [self.fields[0]] + [pad + f for f in self.fields[1:]]
+        self.check(pad)
+        self.fields = fields
+        self.text = None
+        if (len(pad.strip()) > 0):
+            self.variant = None
+
+    """True if the line starts with prefix, joining only the columns the
+    prefix can reach
+    """
+    def startswith(self, prefix):
+        text = self.text
+        if text is not None:
+            return text.startswith(prefix)
+        fields = self.fields
+        if (len(fields[0]) >= len(prefix)):
+            return fields[0].startswith(prefix)
+        head = self.sep.join([self.column(i)
+            for i in range(min(len(prefix), len(fields)))])
+        return head.startswith(prefix)
+
+    """True if reading the line back gives the same columns
+    """
+    def intact(self):
+        if self.text is not None:
+            return True
+        if self.broken or self.fields[0][:1].isspace():
+            return False
+        if (len(self.fields) - 1 == INFO):
+            for piece in reversed(self.pending()):
+                if (len(piece) > 0):
+                    return not piece[-1].isspace()
+            return True
+        return not self.fields[-1][-1:].isspace()
+
+    """The line as written out
+    """
+    def line(self):
+        if self.text is None:
+            if self.info is not None:
+                self.get_info()
+            self.text = self.sep.join(self.fields)
+        return self.text
+
+### EOF
@@ -0,0 +1,296 @@
+# regions.py
+#
+# Region-restricted annotation
+#
+# A job can restrict annotation to a list of regions (BED: chromosome,
+# 0-based start, end). Only the header and the records whose POS falls in
+# one of the regions are handed to the stages. An uncompressed input
+# with a current coordinate index next to it (<input>.vidx) is read by
+# seeking straight to the regions: for every chromosome the index holds
+# the byte offset of the first record of each WINDOW-sized window.
+# Building the index takes a full pass over the file, so it only pays off
+# for a file whose regions are read more than once, and extract() never
+# builds one itself. A job instead accepts an index built once with the
+# input: the annotator downloads the S3 object s3_key_input_index of the
+# job message next to the input (see accept_index()). Input without a
+# current index, compressed input and input that is not sorted by
+# position within contiguous chromosomes are scanned instead.
+#
+# Usage: python regions.py <vcf>   (builds <vcf>.vidx)
+#
+##
+
+import os
+import sys
+import json
+import locale
+from bisect import bisect_right
+import bgzf
+import engine
+import intervals
+
+FORMAT = 1
+
+# Bases covered by one window of the index
+WINDOW = 16384
+
+INDEX_EXT = '.vidx'
+
+
+"""Chromosome name as compared between the VCF and the region list:
+"chr1", "Chr1" and "1" are the same chromosome
+"""
+def region_chrom(chrom):
+    return intervals.chrom_name(chrom)
+
+
+"""Reads a BED file into sorted, merged (start, end) intervals of 1-based
+positions per chromosome
+Track, browser and comment lines are skipped.
+"""
+def read_bed(path):
+    regions = {}
+    with open(path) as fh:
+        for line in fh:
+            fields = line.strip().split()
+            if (len(fields) < 3) or fields[0].startswith('#') or \
+                (fields[0] in ['track', 'browser']):
+                continue
+            regions.setdefault(region_chrom(fields[0]), []).append(
+                (int(fields[1]) + 1, int(fields[2])))
+
+    for chrom, spans in regions.items():
+        merged = []
+        for start, end in sorted(spans):
+            if (len(merged) > 0) and (start <= merged[-1][1] + 1):
+                merged[-1] = (merged[-1][0], max(merged[-1][1], end))
+            else:
+                merged.append((start, end))
+        regions[chrom] = merged
+    return regions
+
+
+"""True if pos (1-based) falls in one of the merged spans
+"""
+def in_regions(spans, pos):
+    i = bisect_right(spans, (pos, float('inf'))) - 1
+    return (i >= 0) and (spans[i][0] <= pos <= spans[i][1])
+
+
+"""Chromosome and integer position of a record line, or None for header
+lines and records without a numeric position
+"""
+def locate(line, sep='\t'):
+    if line.startswith('#'):
+        return None
+    fields = line.split(sep, 2)
+    if (len(fields) < 2) or not fields[1].strip().isdigit():
+        return None
+    return (fields[0].strip(), int(fields[1].strip()))
+
+
+"""Splits raw bytes of a line into text lines the way reading the file
+in text mode would
+"""
+def decode_lines(data, encoding):
+    pieces = engine.LINE_BREAKS.split(data.decode(encoding))
+    if (pieces[-1] == ''):
+        pieces = pieces[:-1]
+    return [piece + '\n' for piece in pieces]
+
+
+"""Builds the coordinate index of an uncompressed VCF
+
+For each chromosome, in file order, the index keeps the offset of the
+first record of every window, and where the chromosome's records end.
+A file whose chromosomes are not contiguous, or whose positions go
+backwards within a chromosome, is marked unsorted, and so is a file with
+bare carriage returns for line breaks.
+"""
+def build_index(path):
+    stat = os.stat(path)
+    chroms = []
+    entries = {}
+    sorted_input = True
+    header_end = None
+    last = None
+    offset = 0
+
+    with open(path, 'rb') as fh:
+        for data in fh:
+            if (b'\r' in (data[:-2] if data.endswith(b'\r\n') else data)):
+                sorted_input = False
+            site = locate(data.decode('latin-1'))
+            if site is not None:
+                chrom, pos = site
+                if header_end is None:
+                    header_end = offset
+                if (last is None) or (chrom != last[0]):
+                    if chrom in entries:
+                        sorted_input = False
+                    else:
+                        chroms.append(chrom)
+                        entries[chrom] = {'windows': [], 'end': offset}
+                elif (pos < last[1]):
+                    sorted_input = False
+
+                windows = entries[chrom]['windows']
+                window = pos // WINDOW
+                if (len(windows) == 0) or (windows[-1][0] < window):
+                    windows.append([window, offset])
+                last = (chrom, pos)
+                offset = offset + len(data)
+                entries[chrom]['end'] = offset
+            else:
+                offset = offset + len(data)
+
+    if header_end is None:
+        header_end = offset
+
+    return {'format': FORMAT, 'size': stat.st_size,
+        'mtime_ns': stat.st_mtime_ns, 'window': WINDOW,
+        'sorted': sorted_input, 'header_end': header_end,
+        'chroms': [[chrom, entries[chrom]] for chrom in chroms]}
+
+
+"""Writes the index of a VCF next to it
+"""
+def write_index(path, index=None):
+    if index is None:
+        index = build_index(path)
+    with open(path + INDEX_EXT + '.part', 'w') as fh:
+        json.dump(index, fh)
+    os.replace(path + INDEX_EXT + '.part', path + INDEX_EXT)
+    return index
+
+
+"""Index of an uncompressed VCF: the one next to it when it is still
+current, otherwise None (see write_index())
+Returns None for compressed input, which cannot be seeked into.
+"""
+def get_index(path):
+    if bgzf.is_gzip(path):
+        return None
+
+    stat = os.stat(path)
+    try:
+        with open(path + INDEX_EXT) as fh:
+            index = json.load(fh)
+        if (index['format'] == FORMAT) and \
+            (index['size'] == stat.st_size) and \
+            (index['mtime_ns'] == stat.st_mtime_ns):
+            return index
+    except (OSError, ValueError, KeyError):
+        pass
+    return None
+
+
+"""Makes the index at index_path, built from another copy of the VCF at
+path, the index of path: moves it next to path and gives path the
+modification time the indexed copy had, so get_index() finds it current
+
+The index is removed instead, and False returned, when it is not one of
+this format for a file of path's size whose chromosomes start where it
+says they do.
+"""
+def accept_index(path, index_path):
+    try:
+        with open(index_path) as fh:
+            index = json.load(fh)
+        matches = (index['format'] == FORMAT) and not bgzf.is_gzip(path) and \
+            (index['size'] == os.path.getsize(path))
+        if matches:
+            with open(path, 'rb') as fh:
+                for chrom, entry in index['chroms']:
+                    fh.seek(entry['windows'][0][1])
+                    site = locate(fh.readline().decode('latin-1'))
+                    if (site is None) or (site[0] != chrom):
+                        matches = False
+                        break
+    except (OSError, ValueError, KeyError, IndexError, TypeError):
+        matches = False
+
+    if not matches:
+        if os.path.exists(index_path):
+            os.remove(index_path)
+        return False
+    os.replace(index_path, path + INDEX_EXT)
+    os.utime(path, ns=(os.stat(path).st_atime_ns, index['mtime_ns']))
+    return True
+
+
+"""Lines of the records in the regions, read through the index
+"""
+def seek_lines(path, index, regions):
+    encoding = locale.getpreferredencoding(False)
+    with open(path, 'rb') as fh:
+        while (fh.tell() < index['header_end']):
+            for line in decode_lines(fh.readline(), encoding):
+                yield line
+
+        for chrom, entry in index['chroms']:
+            spans = regions.get(region_chrom(chrom))
+            if not spans:
+                continue
+            starts = [window for window, offset in entry['windows']]
+
+            for start, end in spans:
+                # Offset of the last window starting at or before the span
+                i = bisect_right(starts, start // index['window']) - 1
+                fh.seek(entry['windows'][max(i, 0)][1])
+                while (fh.tell() < entry['end']):
+                    data = fh.readline()
+                    site = locate(data.decode(encoding))
+                    if site is None:
+                        continue
+                    if (site[1] > end):
+                        break
+                    if (site[1] >= start):
+                        for line in decode_lines(data, encoding):
+                            yield line
+
+
+"""Lines of the header and of the records in the regions, read in file
+order from start to end
+"""
+def scan_lines(path, regions):
+    header = True
+    with bgzf.open_input(path) as fh:
+        for line in fh:
+            site = locate(line)
+            if site is None:
+                if header:
+                    yield line
+                continue
+            header = False
+            spans = regions.get(region_chrom(site[0]))
+            if spans and in_regions(spans, site[1]):
+                yield line
+
+
+"""Writes the header and the records of infile in the regions of bedfile
+to outfile, in input order
+The records are read through infile's index when it has a current one,
+and scanned for otherwise.
+"""
+def extract(infile, bedfile, outfile):
+    regions = read_bed(bedfile)
+    index = get_index(infile)
+    if (index is not None) and index['sorted']:
+        lines = seek_lines(infile, index, regions)
+    else:
+        lines = scan_lines(infile, regions)
+
+    with open(outfile, 'w') as fh_out:
+        for line in lines:
+            fh_out.write(line)
+
+
+if __name__ == '__main__':
+    if (len(sys.argv) != 2):
+        print(f"Usage: python {sys.argv[0]} <vcf>")
+        sys.exit(1)
+    index = write_index(sys.argv[1])
+    print(f"Indexed {len(index['chroms'])} chromosomes of {sys.argv[1]}")
+
+### EOF
@@ -46,11 +46,129 @@ class Timer(object):
     if self.verbose:
       print(f"Approximate runtime: {self.secs:.2f} seconds")
 
+"""Settings of driver.run() from the [ann] section of the configuration
+"""
+def driver_options():
+    return {
+        'batch_size': config.getint("ann", "batch_size",
+            fallback=driver.engine.BATCH_SIZE),
+        'queue_depth': config.getint("ann", "queue_depth",
+            fallback=driver.engine.QUEUE_DEPTH),
+        'dbsnp_batch_size': config.getint("ann", "dbsnp_batch_size",
+            fallback=driver.ann.DBSNP_BATCH_SIZE),
+        'use_index': config.getboolean("ann", "interval_index",
+            fallback=True),
+        'snapshot_dir': config.get("ann", "snapshot_dir", fallback=None),
+        'sweep': config.getboolean("ann", "sweep", fallback=False),
+        'workers': config.getint("ann", "workers", fallback=1),
+        'shard_window': config.getint("ann", "shard_window", fallback=0),
+        'stage_threads': config.getint("ann", "stage_threads", fallback=0),
+        'cache_path': config.get("ann", "variant_cache", fallback=None),
+        'reference_version': config.get("ann", "reference_version",
+            fallback=None),
+        'bgzf_output': config.getboolean("ann", "bgzf_output",
+            fallback=False),
+        'bgzf_threads': config.getint("ann", "bgzf_threads", fallback=0),
+        'backend': config.get("ann", "backend", fallback="mysql"),
+        'backend_path': config.get("ann", "backend_path", fallback=None),
+        'checkpoint_interval': config.getint("ann", "checkpoint_interval",
+            fallback=0),
+        'chromosomes': [c for c in config.get("ann", "chromosomes",
+            fallback="").split(",") if c.strip()] or None}
+
+
+"""Uploads the results, count log and metrics of a job to the results
+bucket, marks the job COMPLETED, starts its archive state machine and
+deletes the local files
+"""
+def complete_job(user_id, job_id, input_file_full_name, local_results_file,
+    local_log_file, local_metrics_file):
+    input_file_name = input_file_full_name.split(".")[0]
+    results_ext = ".annot.vcf.gz" if local_results_file.endswith(".gz") \
+        else ".annot.vcf"
+    results_bucket = config.get("s3", "bucket_results")
+    cnetid = config.get("prefix", "cnetid")
+
+    # create results and log keys
+    key_results = cnetid + user_id + f"/{job_id}~{input_file_name}" + results_ext
+    key_log = cnetid + user_id + f"/{job_id}~{input_file_full_name}" + ".count.log"
+    key_metrics = cnetid + user_id + f"/{job_id}~{input_file_full_name}" + ".metrics.json"
+
+    # connect to s3 and upload results/log files
+    s3_client = boto3.client('s3')
+    # Boto3 documentation: https://boto3.amazonaws.com/v1/documentation/api/latest/guide/s3-uploading-files.html
+    try:
+        response_results = s3_client.upload_file(local_results_file, results_bucket, key_results)
+        response_log = s3_client.upload_file(local_log_file, results_bucket, key_log)
+        response_metrics = s3_client.upload_file(local_metrics_file, results_bucket, key_metrics)
+    except ClientError as e:
+        print(e)
+
+    # connect to dynamodb and update job item
+    region = config.get("aws", "AwsRegionName")
+    table_name = config.get("dynamodb", "db")
+    table = boto3.resource("dynamodb", region_name=region).Table(table_name)
+    complete_time = int(time.time())
+
+    # Updating DB: https://docs.aws.amazon.com/amazondynamodb/latest/developerguide/GettingStarted.UpdateItem.html
+    try:
+        table.update_item(Key={"job_id": job_id},
+            UpdateExpression= "set job_status = :r, s3_results_bucket = :b,\
+            s3_key_result_file = :kr, s3_key_log_file = :kl, complete_time = :cl",
+            ExpressionAttributeValues={
+            ":r": "COMPLETED", ":b": results_bucket, ":kr": key_results, 
+            ":kl": key_log,":cl": complete_time})    
+    except ClientError as e:
+        print(e)
+
+    ### NEW CODE FOR A14 ###
+
+    topic_arn = config["sns"]["archive_topic"]
+    duration = config.get("aws", "duration")
+
+    # Create archive message to pass into step function
+    # First answer that formats input: https://stackoverflow.com/questions/55379944/pass-variable-into-step-function-start-execution-input-parameter
+    archive_message = "{\"job_id\": \"" + job_id + "\", \"topic_arn\": \"" + topic_arn + "\", \"duration\": \
+    \"" + duration + "\", \"user_id\": \"" + user_id + "\"}"
+
+    # Initialize step function client and start execution
+    # Step Function documentation: https://boto3.amazonaws.com/v1/documentation/api/latest/reference/services/stepfunctions.html#SFN.Client.start_execution
+    step_function_client = boto3.client('stepfunctions', region_name=region)
+    machine_arn = config.get("step_function", "state_machine_arn")
+    try:
+        machine_resp = step_function_client.start_execution(
+                        stateMachineArn=machine_arn,
+                        name=job_id,
+                        input= archive_message
+                        )
+    except ClientError as e:
+        print(e)
+    print("Success: Starting state machine execution")
+
+    # Delete local copies of files
+    os.remove(local_results_file)
+    os.remove(local_log_file)
+    os.remove(local_metrics_file)
+
 if __name__ == '__main__':
     # Call the AnnTools pipeline
     if len(sys.argv) > 1:
         with Timer():
-            driver.run(sys.argv[1], 'vcf')
+            # Checkpoints in the results bucket, so another instance can
+            # resume the job
+            checkpoint_s3 = None
+            if config.getboolean("ann", "checkpoint_s3", fallback=False):
+                checkpoint_s3 = (config.get("s3", "bucket_results"),
+                    config.get("prefix", "cnetid") + sys.argv[3] + \
+                    f"/{sys.argv[4]}~{sys.argv[5]}.ckpt")
+
+            driver.run(sys.argv[1], 'vcf',
+                checkpoint_s3=checkpoint_s3,
+                regions_file=sys.argv[6] if (len(sys.argv) > 6) and \
+                    sys.argv[6] else None,
+                tracks=sys.argv[7].split(",") if (len(sys.argv) > 7) \
+                    else None,
+                **driver_options())
             
             # extract args from config and sys.arg
             local_path = sys.argv[1]
@@ -59,69 +177,20 @@ if __name__ == '__main__':
             user_id = sys.argv[3]
             input_file_full_name = sys.argv[5]
             input_file_name = input_file_full_name.split(".")[0]
-            local_results_file = f"{root_path}/{job_id}~{input_file_name}.annot.vcf"
-            local_log_file = f"{local_path}.count.log"
-            results_bucket = config.get("s3", "bucket_results")
-            cnetid = config.get("prefix", "cnetid")
-
-            # create results and log keys
-            key_results = cnetid + user_id + f"/{job_id}~{input_file_name}" + ".annot.vcf"
-            key_log = cnetid + user_id + f"/{job_id}~{input_file_full_name}" + ".count.log"
-
-            # connect to s3 and upload results/log files
-            s3_client = boto3.client('s3')
-            # Boto3 documentation: https://boto3.amazonaws.com/v1/documentation/api/latest/guide/s3-uploading-files.html
-            try:
-                response_results = s3_client.upload_file(local_results_file, results_bucket, key_results)
-                response_log = s3_client.upload_file(local_log_file, results_bucket, key_log)
-            except ClientError as e:
-                print(e)
-
-            # connect to dynamodb and update job item
-            region = config.get("aws", "AwsRegionName")
-            table_name = config.get("dynamodb", "db")
-            table = boto3.resource("dynamodb", region_name=region).Table(table_name)
-            complete_time = int(time.time())
-            
-            # Updating DB: https://docs.aws.amazon.com/amazondynamodb/latest/developerguide/GettingStarted.UpdateItem.html
-            try:
-                table.update_item(Key={"job_id": job_id},
-                    UpdateExpression= "set job_status = :r, s3_results_bucket = :b,\
-                    s3_key_result_file = :kr, s3_key_log_file = :kl, complete_time = :cl",
-                    ExpressionAttributeValues={
-                    ":r": "COMPLETED", ":b": results_bucket, ":kr": key_results, 
-                    ":kl": key_log,":cl": complete_time})    
-            except ClientError as e:
-                print(e)
-            
-            ### NEW CODE FOR A14 ###
-
-            topic_arn = config["sns"]["archive_topic"]
-            duration = config.get("aws", "duration")
-           
-            # Create archive message to pass into step function
-            # First answer that formats input: https://stackoverflow.com/questions/55379944/pass-variable-into-step-function-start-execution-input-parameter
-            archive_message = "{\"job_id\": \"" + job_id + "\", \"topic_arn\": \"" + topic_arn + "\", \"duration\": \
-            \"" + duration + "\", \"user_id\": \"" + user_id + "\"}"
-            
-            # Initialize step function client and start execution
-            # Step Function documentation: https://boto3.amazonaws.com/v1/documentation/api/latest/reference/services/stepfunctions.html#SFN.Client.start_execution
-            step_function_client = boto3.client('stepfunctions', region_name=region)
-            machine_arn = config.get("step_function", "state_machine_arn")
-            try:
-                machine_resp = step_function_client.start_execution(
-                                stateMachineArn=machine_arn,
-                                name=job_id,
-                                input= archive_message
-                                )
-            except ClientError as e:
-                print(e)
-            print("Success: Starting state machine execution")
+            results_ext = ".annot.vcf.gz" if config.getboolean("ann",
+                "bgzf_output", fallback=False) else ".annot.vcf"
+            local_results_file = f"{root_path}/{job_id}~{input_file_name}" + results_ext
+
+            complete_job(user_id, job_id, input_file_full_name,
+                local_results_file, f"{local_path}.count.log",
+                f"{local_path}.metrics.json")
 
             # Delete local copies of files
-            os.remove(local_results_file)
-            os.remove(local_log_file)
             os.remove(local_path)
+            if os.path.exists(local_path + driver.regions.INDEX_EXT):
+                os.remove(local_path + driver.regions.INDEX_EXT)
+            if (len(sys.argv) > 6) and sys.argv[6]:
+                os.remove(sys.argv[6])
 else:
    print("A valid .vcf file must be provided as input to this program.")
 
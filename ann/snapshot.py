@@ -0,0 +1,410 @@
+# snapshot.py
+#
+# Memory-mapped snapshot of the annotator reference database
+#
+# A snapshot is a directory with one <table>.snap file per reference table
+# and a MANIFEST.json describing the snapshot version and its tables.
+# Each table file holds the table's rows sorted by chromosome and interval
+# start, stored column by column:
+#
+#   magic (8 bytes) | header length (8 bytes) | JSON header | sections
+#
+# Interval starts and ends are int32 (or int64 when a coordinate does not
+# fit), followed by each partition's nested containment list (see
+# intervals.nest()). Integer columns are int64 and every other
+# column holds int32 ids into a pool of interned values shared by the
+# whole table. Sections are 8-byte aligned so they can be used in place
+# as memoryviews over a read-only mmap: opening a snapshot costs a few
+# page faults, and all annotator processes share the page cache.
+#
+# Build a snapshot from the live database with:
+#   python snapshot.py <snapshot_dir> [--version <version>] [--tables a,b]
+#
+##
+
+import os
+import json
+import mmap
+import struct
+import hashlib
+import argparse
+from array import array
+from decimal import Decimal
+from datetime import datetime, timezone
+
+import intervals
+
+FORMAT = 2
+
+# Formats this module reads; format 1 snapshots have no nested containment
+# lists, which are built when their tables are opened
+READABLE = (1, 2)
+MAGIC = b'ANNSNAP1'
+MANIFEST = 'MANIFEST.json'
+
+# Reference tables and their (chromosome, start, end) columns. A table
+# without a chromosome column is stored as a single partition.
+TABLES = {
+    'refGene': ('chrom', 'txStart', 'txEnd'),
+    'cpgIslandExt': ('chrom', 'chromStart', 'chromEnd'),
+    'cytoBand': ('chrom', 'chromStart', 'chromEnd'),
+    'gadAll': ('chromosome', 'chromStart', 'chromEnd'),
+    'gwasCatalog': ('chrom', 'chromStart', 'chromEnd'),
+    'targetScanS': ('chrom', 'chromStart', 'chromEnd'),
+    'hugo': ('chrom', 'chromStart', 'chromEnd'),
+    'dgv_Cnv': ('chrom', 'chromStart', 'chromEnd'),
+    'abParts_IG_T_CelReceptors': ('chrom', 'chromStart', 'chromEnd'),
+    'mcCarroll_Cnv': ('chrom', 'chromStart', 'chromEnd'),
+    'conrad_Cnv': ('chrom', 'chromStart', 'chromEnd'),
+    'genomicSuperDups': ('chrom', 'chromStart', 'chromEnd'),
+}
+for _chrom in [str(i) for i in range(1, 23)] + ['X', 'Y']:
+    TABLES['tfbsConsSites' + _chrom] = (None, 'chromStart', 'chromEnd')
+
+# Snapshots already opened by this process, keyed by directory
+_snapshots = {}
+
+INT32_MIN = -2 ** 31
+INT32_MAX = 2 ** 31 - 1
+INT64_MIN = -2 ** 63
+INT64_MAX = 2 ** 63 - 1
+
+
+"""Encodes one value of a pooled column as a type tag plus payload
+"""
+def encode_value(value):
+    if value is None:
+        return b'n'
+    if isinstance(value, bool):
+        raise ValueError(f"unsupported column value {value!r}")
+    if isinstance(value, int):
+        return b'i' + str(value).encode('ascii')
+    if isinstance(value, float):
+        return b'f' + repr(value).encode('ascii')
+    if isinstance(value, Decimal):
+        return b'd' + str(value).encode('ascii')
+    if isinstance(value, str):
+        return b's' + value.encode('utf-8')
+    if isinstance(value, (bytes, bytearray)):
+        return b'b' + bytes(value)
+    raise ValueError(f"unsupported column value {value!r}")
+
+
+def decode_value(data):
+    tag = data[:1]
+    payload = bytes(data[1:])
+    if tag == b'n':
+        return None
+    if tag == b'i':
+        return int(payload)
+    if tag == b'f':
+        return float(payload)
+    if tag == b'd':
+        return Decimal(payload.decode('ascii'))
+    if tag == b's':
+        return payload.decode('utf-8')
+    return payload
+
+
+def isInt64(value):
+    return isinstance(value, int) and not isinstance(value, bool) and \
+        (INT64_MIN <= value <= INT64_MAX)
+
+
+"""Smallest array type code holding all the values
+"""
+def coordinate_type(values):
+    for v in values:
+        if (v < INT32_MIN) or (v > INT32_MAX):
+            return 'q'
+    return 'i'
+
+
+"""Writes one table to a snapshot file and returns its manifest entry
+"""
+def write_table(path, table, names, rows, chrom_column, start_column,
+    end_column):
+    c = names.index(chrom_column) if chrom_column is not None else None
+    s = names.index(start_column)
+    e = names.index(end_column)
+
+    # Rows in table order, then sorted by chromosome and start
+    entries = []
+    for rank, row in enumerate(rows):
+        if (row[s] is None) or (row[e] is None) or \
+            ((c is not None) and (row[c] is None)):
+            continue
+        chrom = intervals.chrom_key(row[c]) if c is not None else ''
+        entries.append((chrom, int(row[s]), rank, int(row[e]), row))
+    entries.sort(key=lambda x: (x[0], x[1], x[2]))
+
+    sections = []
+    partitions = {}
+    for n, entry in enumerate(entries):
+        if entry[0] not in partitions:
+            partitions[entry[0]] = [n, 0, n + len(partitions)]
+        partitions[entry[0]][1] += 1
+
+    starts = [x[1] for x in entries]
+    ends = [x[3] for x in entries]
+    ctype = coordinate_type(starts + ends)
+    sections.append(('starts', array(ctype, starts)))
+    sections.append(('ends', array(ctype, ends)))
+
+    # Each partition's nested containment list, with the members indexed
+    # within the partition and one more list bound than intervals
+    members = array('q')
+    member_ends = array(ctype)
+    lists = array('q')
+    for lo, count, offset in partitions.values():
+        nesting = intervals.nest(starts[lo:lo + count], ends[lo:lo + count])
+        members.extend(nesting[0])
+        member_ends.extend(list(nesting[1]))
+        lists.extend(nesting[2])
+    sections.append(('members', members))
+    sections.append(('member_ends', member_ends))
+    sections.append(('lists', lists))
+    sections.append(('ranks', array('q', [x[2] for x in entries])))
+
+    # Integer columns are stored as they are, everything else is interned
+    pool = {}
+    blobs = []
+    columns = []
+    for i, name in enumerate(names):
+        values = [x[4][i] for x in entries]
+        if all([isInt64(v) for v in values]):
+            columns.append({'name': name, 'kind': 'int'})
+            sections.append(('col:' + name, array('q', values)))
+            continue
+
+        ids = array('i')
+        for v in values:
+            data = encode_value(v)
+            if data not in pool:
+                pool[data] = len(blobs)
+                blobs.append(data)
+            ids.append(pool[data])
+        columns.append({'name': name, 'kind': 'pooled'})
+        sections.append(('col:' + name, ids))
+
+    offsets = array('q', [0])
+    for data in blobs:
+        offsets.append(offsets[-1] + len(data))
+    sections.append(('pool_offsets', offsets))
+    sections.append(('pool', b''.join(blobs)))
+
+    # Lay the sections out after the header, 8-byte aligned
+    layout = {}
+    position = 0
+    for name, data in sections:
+        size = len(data) * data.itemsize if isinstance(data, array) \
+            else len(data)
+        layout[name] = [position, size,
+            data.typecode if isinstance(data, array) else 'B']
+        position = position + size + (-size % 8)
+
+    header = json.dumps({'format': FORMAT, 'table': table,
+        'chrom_column': chrom_column, 'start_column': start_column,
+        'end_column': end_column, 'rows': len(entries), 'columns': columns,
+        'partitions': partitions, 'sections': layout}).encode('utf-8')
+    header = header + b' ' * (-(len(MAGIC) + 8 + len(header)) % 8)
+
+    digest = hashlib.sha256()
+    with open(path, 'wb') as fh:
+        for chunk in [MAGIC, struct.pack('<Q', len(header)), header]:
+            fh.write(chunk)
+            digest.update(chunk)
+        for name, data in sections:
+            chunk = data.tobytes() if isinstance(data, array) else data
+            chunk = chunk + b'\0' * (-len(chunk) % 8)
+            fh.write(chunk)
+            digest.update(chunk)
+
+    return {'file': os.path.basename(path), 'rows': len(entries),
+        'sha256': digest.hexdigest()}
+
+
+"""Exports the reference tables from the database into a snapshot
+"""
+def build(conn, directory, tables=None, version=None):
+    if tables is None:
+        tables = list(TABLES.keys())
+    if version is None:
+        version = datetime.now(timezone.utc).strftime('%Y%m%d%H%M%S')
+
+    os.makedirs(directory, exist_ok=True)
+    cursor = conn.cursor()
+    manifest = {'format': FORMAT, 'version': version,
+        'created': datetime.now(timezone.utc).isoformat(), 'tables': {}}
+
+    for table in tables:
+        chrom_column, start_column, end_column = TABLES[table]
+        cursor.execute('select * from ' + table + ';')
+        names = [str(d[0]) for d in cursor.description]
+        rows = cursor.fetchall()
+        entry = write_table(os.path.join(directory, table + '.snap'), table,
+            names, rows, chrom_column, start_column, end_column)
+        manifest['tables'][table] = entry
+        print(f"{table}: {entry['rows']} rows")
+
+    # The manifest is written last, so a snapshot without one is incomplete
+    tmp = os.path.join(directory, MANIFEST + '.part')
+    with open(tmp, 'w') as fh:
+        json.dump(manifest, fh, indent=2)
+    os.replace(tmp, os.path.join(directory, MANIFEST))
+    return manifest
+
+
+"""Rows of a snapshot table, rebuilt from its columns on access
+"""
+class SnapshotRows(object):
+
+    def __init__(self, table, lo, count):
+        self.table = table
+        self.lo = lo
+        self.count = count
+
+    def __len__(self):
+        return self.count
+
+    def __getitem__(self, i):
+        if (i < 0) or (i >= self.count):
+            raise IndexError(i)
+        return self.table.row(self.lo + i)
+
+
+"""One table of an opened snapshot
+"""
+class SnapshotTable(object):
+
+    def __init__(self, path):
+        with open(path, 'rb') as fh:
+            self.mm = mmap.mmap(fh.fileno(), 0, access=mmap.ACCESS_READ)
+
+        buf = memoryview(self.mm)
+        if bytes(buf[:len(MAGIC)]) != MAGIC:
+            raise ValueError(f"{path} is not an annotator snapshot")
+        (size,) = struct.unpack('<Q', buf[len(MAGIC):len(MAGIC) + 8])
+        start = len(MAGIC) + 8
+        self.header = json.loads(bytes(buf[start:start + size]))
+        if self.header['format'] not in READABLE:
+            raise ValueError(f"{path}: unsupported snapshot format " + \
+                f"{self.header['format']}")
+
+        base = start + size
+        self.sections = {}
+        for name, (offset, length, typecode) in \
+            self.header['sections'].items():
+            view = buf[base + offset:base + offset + length]
+            self.sections[name] = view if typecode == 'B' \
+                else view.cast(typecode)
+
+        self.table = self.header['table']
+        self.chrom_column = self.header['chrom_column']
+        self.start_column = self.header['start_column']
+        self.end_column = self.header['end_column']
+        self.columns = [(c['name'], c['kind'], self.sections['col:' + c['name']])
+            for c in self.header['columns']]
+        self.values = {}
+
+    def value(self, id):
+        if id not in self.values:
+            offsets = self.sections['pool_offsets']
+            self.values[id] = decode_value(
+                self.sections['pool'][offsets[id]:offsets[id + 1]])
+        return self.values[id]
+
+    def row(self, n):
+        return tuple([data[n] if kind == 'int' else self.value(data[n])
+            for name, kind, data in self.columns])
+
+    """Interval index over the mapped columns, without copying them
+    """
+    def index(self):
+        index = intervals.IntervalIndex(self.table,
+            [c['name'] for c in self.header['columns']])
+        for chrom, partition in self.header['partitions'].items():
+            lo, count = partition[0], partition[1]
+            hi = lo + count
+            nesting = None
+            if ('lists' in self.sections):
+                offset = partition[2]
+                nesting = (self.sections['members'][lo:hi],
+                    self.sections['member_ends'][lo:hi],
+                    self.sections['lists'][offset:offset + count + 1])
+            index.partitions[chrom] = intervals.Partition(
+                self.sections['starts'][lo:hi], self.sections['ends'][lo:hi],
+                self.sections['ranks'][lo:hi], SnapshotRows(self, lo, count),
+                nesting=nesting)
+        return index
+
+
+"""An opened snapshot directory
+"""
+class Snapshot(object):
+
+    def __init__(self, directory):
+        with open(os.path.join(directory, MANIFEST)) as fh:
+            self.manifest = json.load(fh)
+        if self.manifest['format'] not in READABLE:
+            raise ValueError(f"{directory}: unsupported snapshot format " + \
+                f"{self.manifest['format']}")
+        self.directory = directory
+        self.version = self.manifest['version']
+        self.tables = {}
+        self.indexes = {}
+
+    def __contains__(self, table):
+        return table in self.manifest['tables']
+
+    def table(self, table):
+        if table not in self.tables:
+            self.tables[table] = SnapshotTable(os.path.join(self.directory,
+                self.manifest['tables'][table]['file']))
+        return self.tables[table]
+
+    """Interval index of a table, or None if the snapshot does not hold it
+    with the requested columns
+    """
+    def index(self, table, chrom_column, start_column, end_column):
+        if table not in self:
+            return None
+        t = self.table(table)
+        if (t.chrom_column, t.start_column, t.end_column) != \
+            (chrom_column, start_column, end_column):
+            return None
+        if table not in self.indexes:
+            self.indexes[table] = t.index()
+        return self.indexes[table]
+
+
+"""Opens a snapshot directory, once per process
+"""
+def open_snapshot(directory):
+    directory = os.path.abspath(directory)
+    if directory not in _snapshots:
+        _snapshots[directory] = Snapshot(directory)
+    return _snapshots[directory]
+
+
+if __name__ == '__main__':
+    import utils as u
+
+    parser = argparse.ArgumentParser(
+        description='Build a reference snapshot for the annotator')
+    parser.add_argument('directory')
+    parser.add_argument('--version', default=None)
+    parser.add_argument('--tables', default=None,
+        help='comma-separated list of tables (default: all)')
+    args = parser.parse_args()
+
+    tables = args.tables.split(',') if args.tables else None
+    conn = u.db_connect()
+    try:
+        manifest = build(conn, args.directory, tables=tables,
+            version=args.version)
+    finally:
+        conn.close()
+    print(f"Snapshot {manifest['version']} written to {args.directory}")
+
+### EOF
@@ -13,39 +13,194 @@ __author__ = 'Vas Vasiliadis <vas@uchicago.edu>'
 
 import os
 import json
+import time
+import threading
 import pymysql
 import boto3
 from botocore.exceptions import ClientError
 
-"""Get connection to reference database
+# Seconds the RDS secret is reused before it is fetched again
+SECRET_TTL = 300
+
+# Idle connections kept open by each process
+POOL_SIZE = 8
+
+# Seconds a pooled connection may sit idle before it is pinged on reuse
+POOL_CHECK_INTERVAL = 30
+
+_secret = None
+_secret_time = 0
+_secret_lock = threading.Lock()
+
+
+"""Get the reference database secret from AWS Secrets Manager
+The secret is cached for SECRET_TTL seconds, or refetched if refresh is set.
 """
-def db_connect():
-    AWS_REGION_NAME = os.environ['AWS_REGION_NAME'] if \
-        ('AWS_REGION_NAME' in  os.environ) else "us-east-1"
+def get_rds_secret(refresh=False):
+    global _secret, _secret_time
+
+    with _secret_lock:
+        if refresh or (_secret is None) or \
+            (time.monotonic() - _secret_time > SECRET_TTL):
+            AWS_REGION_NAME = os.environ['AWS_REGION_NAME'] if \
+                ('AWS_REGION_NAME' in  os.environ) else "us-east-1"
+
+            asm = boto3.client('secretsmanager', region_name=AWS_REGION_NAME)
+            try:
+                asm_response = asm.get_secret_value(SecretId='rds/anntools_database')
+                _secret = json.loads(asm_response['SecretString'])
+                _secret_time = time.monotonic()
+            except ClientError as e:
+                print(f"Unable to retrieve RDS credentials from AWS Secrets Manager: {e}")
+                raise e
+
+        return _secret
+
+
+"""Open a new connection to the reference database
+If the cached secret is rejected (e.g. after a rotation), it is refetched
+and the connection retried once.
+"""
+def new_connection():
+    for refresh in [False, True]:
+        rds_secret = get_rds_secret(refresh=refresh)
+
+        # Extract database connection parameters
+        rds_host = rds_secret['host']
+        mysql_port = rds_secret['port']
+        username = rds_secret['username']
+        password = rds_secret['password']
+        database_name = 'annotator'
+
+        try:
+            return pymysql.connect(
+                host=rds_host,
+                port=mysql_port,
+                user=username,
+                passwd=password,
+                db=database_name)
+        except pymysql.err.OperationalError as e:
+            if refresh:
+                raise e
+
+
+"""Connection handed out by ConnectionPool; close() returns it to the pool
+"""
+class PooledConnection(object):
+
+    def __init__(self, pool, conn):
+        self.pool = pool
+        self.conn = conn
+
+    def cursor(self, *args, **kwargs):
+        return self.conn.cursor(*args, **kwargs)
+
+    def close(self):
+        if self.conn is not None:
+            self.pool.release(self.conn)
+            self.conn = None
+
+    def __getattr__(self, name):
+        return getattr(self.conn, name)
+
+
+"""Small pool of connections to the reference database
+
+Idle connections are pinged before reuse once they have been idle for
+POOL_CHECK_INTERVAL seconds, and replaced if they no longer answer. The
+pool is thread-safe and lives as long as the process, so it is shared by
+all stages of a run and by consecutive runs in the same process.
+"""
+class ConnectionPool(object):
 
-    # Get RDS secret from AWS Secrets Manager
-    asm = boto3.client('secretsmanager', region_name=AWS_REGION_NAME)
+    def __init__(self, size=POOL_SIZE):
+        self.size = size
+        self.idle = []
+        self.lock = threading.Lock()
+
+    def acquire(self):
+        while True:
+            with self.lock:
+                if (len(self.idle) == 0):
+                    break
+                conn, idle_since = self.idle.pop()
+
+            if (time.monotonic() - idle_since <= POOL_CHECK_INTERVAL):
+                return PooledConnection(self, conn)
+            try:
+                conn.ping(reconnect=True)
+                return PooledConnection(self, conn)
+            except pymysql.err.Error:
+                discard(conn)
+
+        return PooledConnection(self, new_connection())
+
+    def release(self, conn):
+        # End the read transaction so the next user sees current data
+        try:
+            conn.rollback()
+        except pymysql.err.Error:
+            discard(conn)
+            return
+
+        with self.lock:
+            if (len(self.idle) < self.size):
+                self.idle.append((conn, time.monotonic()))
+                return
+        discard(conn)
+
+    def clear(self):
+        with self.lock:
+            idle = self.idle
+            self.idle = []
+        for conn, idle_since in idle:
+            discard(conn)
+
+
+"""Close a connection, ignoring errors from one that is already broken
+"""
+def discard(conn):
     try:
-        asm_response = asm.get_secret_value(SecretId='rds/anntools_database')
-        rds_secret = json.loads(asm_response['SecretString'])
-    except ClientError as e:
-        print(f"Unable to retrieve RDS credentials from AWS Secrets Manager: {e}")
-        raise e
-
-    # Extract database connection parameters
-    rds_host = rds_secret['host']
-    mysql_port = rds_secret['port']
-    username = rds_secret['username']
-    password = rds_secret['password']
-    database_name = 'annotator'
-
-    # Return a connection to the database
-    return pymysql.connect(
-        host=rds_host,
-        port=mysql_port,
-        user=username,
-        passwd=password,
-        db=database_name)
+        conn.close()
+    except pymysql.err.Error:
+        pass
+
+
+_pool = ConnectionPool()
+
+# Callable making the connections db_connect() returns instead of the pool's
+_connector = None
+
+
+"""Makes db_connect() return connections made by connect() instead of
+pooled connections to the RDS database, e.g. to a local fixture (see
+benchmark.py); None goes back to the pool
+"""
+def set_connector(connect):
+    global _connector
+    _connector = connect
+
+
+"""Forgets the idle connections a forked child inherits from its parent;
+their sockets belong to the parent and must not be used or closed here
+"""
+def _reset_after_fork():
+    global _secret_lock
+    _secret_lock = threading.Lock()
+    _pool.lock = threading.Lock()
+    _pool.idle = []
+
+
+os.register_at_fork(after_in_child=_reset_after_fork)
+
+
+"""Get connection to reference database
+Connections come from the process-wide pool; close() returns them to it.
+"""
+def db_connect():
+    if _connector is not None:
+        return _connector()
+    return _pool.acquire()
 
 
 """Column inices for pileup and VCF
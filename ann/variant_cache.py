@@ -0,0 +1,165 @@
+# variant_cache.py
+#
+# Cross-job cache of stage lookup results
+#
+# The same common variants come back in almost every job. The cache keeps
+# what each stage's lookup returned for a key, tagged with the version of
+# the reference data, in a SQLite file on the annotator host with an
+# in-memory LRU in front of it. Stages consult it before the database or
+# their indexes; apply() still runs for every record, so the output and
+# the counters are the same whether a lookup was served from the cache or
+# not.
+#
+##
+
+import os
+import pickle
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+
+# Entries kept in memory by each process
+MEMORY_SIZE = 100000
+
+# Entries kept in the SQLite file; the least recently used are evicted
+DISK_SIZE = 5000000
+
+# Entries written between two checks of the file size
+EVICT_INTERVAL = 10000
+
+# Keys probed by a single query
+PROBE_SIZE = 500
+
+# Caches already opened by this process, keyed by path and version
+_caches = {}
+
+# Caches inherited from the parent process, kept but never used: closing
+# their connections here could disturb the parent's
+_inherited = []
+
+
+"""Stage lookup results for one version of the reference data
+"""
+class VariantCache(object):
+
+    def __init__(self, path, version, memory_size=MEMORY_SIZE,
+        disk_size=DISK_SIZE):
+        self.path = path
+        self.version = str(version)
+        self.memory_size = memory_size
+        self.disk_size = disk_size
+        self.memory = OrderedDict()
+        self.written = 0
+        self.lock = threading.Lock()
+
+        self.db = sqlite3.connect(path, timeout=60, check_same_thread=False)
+        self.db.execute('pragma journal_mode=wal')
+        self.db.execute('create table if not exists entries ' + \
+            '(key text primary key, value blob not null, used real not null)')
+        self.db.execute('create index if not exists entries_used ' + \
+            'on entries (used)')
+        self.db.commit()
+
+    def entry(self, stage, key):
+        return repr((self.version, stage, key))
+
+    def remember(self, entry, result):
+        self.memory[entry] = result
+        self.memory.move_to_end(entry)
+        while (len(self.memory) > self.memory_size):
+            self.memory.popitem(last=False)
+
+    """Cached results of the keys of one stage, as a dict from key to result
+    Keys that are not cached are left out.
+    """
+    def get_many(self, stage, keys):
+        found = {}
+        probe = {}
+        with self.lock:
+            for key in keys:
+                entry = self.entry(stage, key)
+                if entry in self.memory:
+                    self.memory.move_to_end(entry)
+                    found[key] = self.memory[entry]
+                else:
+                    probe[entry] = key
+
+            entries = list(probe.keys())
+            try:
+                used = []
+                for i in range(0, len(entries), PROBE_SIZE):
+                    chunk = entries[i:i + PROBE_SIZE]
+                    rows = self.db.execute('select key, value from entries ' + \
+                        'where key in (' + ', '.join(['?'] * len(chunk)) + ')',
+                        chunk).fetchall()
+                    for entry, value in rows:
+                        result = pickle.loads(value)
+                        self.remember(entry, result)
+                        found[probe[entry]] = result
+                        used.append(entry)
+
+                if (len(used) > 0):
+                    now = time.time()
+                    self.db.executemany('update entries set used = ? ' + \
+                        'where key = ?', [(now, entry) for entry in used])
+                    self.db.commit()
+            except sqlite3.Error as e:
+                print(f"Variant cache {self.path} unavailable: {e}")
+
+        return found
+
+    """Stores the results of one stage, given as a dict from key to result
+    """
+    def put_many(self, stage, results):
+        with self.lock:
+            now = time.time()
+            rows = []
+            for key, result in results.items():
+                entry = self.entry(stage, key)
+                self.remember(entry, result)
+                rows.append((entry, pickle.dumps(result), now))
+
+            try:
+                self.db.executemany('insert or replace into entries ' + \
+                    '(key, value, used) values (?, ?, ?)', rows)
+                self.db.commit()
+                self.written = self.written + len(rows)
+                if (self.written >= EVICT_INTERVAL):
+                    self.evict()
+                    self.written = 0
+            except sqlite3.Error as e:
+                print(f"Variant cache {self.path} unavailable: {e}")
+
+    """Drops the least recently used entries beyond disk_size
+    """
+    def evict(self):
+        count = self.db.execute('select count(*) from entries').fetchone()[0]
+        if (count > self.disk_size):
+            self.db.execute('delete from entries where key in ' + \
+                '(select key from entries order by used limit ?)',
+                (count - self.disk_size,))
+            self.db.commit()
+
+
+"""Opens the cache file for a reference version, once per process
+"""
+def open_cache(path, version):
+    key = (path, str(version))
+    if key not in _caches:
+        _caches[key] = VariantCache(path, version)
+    return _caches[key]
+
+
+"""Sets aside the caches a forked child inherits; SQLite connections must
+not be used across a fork
+"""
+def _reset_after_fork():
+    global _caches
+    _inherited.extend(_caches.values())
+    _caches = {}
+
+
+os.register_at_fork(after_in_child=_reset_after_fork)
+
+### EOF
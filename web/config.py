@@ -120,6 +120,21 @@ class Config(object):
 
   AWS_GLACIER_VAULT = "ucmpcs"
 
+  # Annotation tracks users can choose from on the annotate form (names
+  # as in ann/driver.py TRACKS); jobs run all of them unless told otherwise
+  ANNOTATION_TRACKS = [
+    ("dbsnp", "dbSNP identifiers and allele frequencies"),
+    ("transcripts", "Transcript effects (BigRefGene)"),
+    ("genes", "Genes and promoter regions (refGene)"),
+    ("cytoband", "Cytogenetic bands"),
+    ("disease", "Genetic association database (gadAll)"),
+    ("gwas", "GWAS catalog"),
+    ("mirna", "microRNA target sites (TargetScan)"),
+    ("hugo", "HUGO gene nomenclature"),
+    ("cnv", "Copy number variants (DGV, McCarroll, Conrad, IG/TCR)"),
+    ("superdups", "Segmental duplications"),
+    ("tfbs", "Conserved transcription factor binding sites")]
+
   # AWS SNS topics
   AWS_SNS_JOB_REQUEST_TOPIC = "arn:aws:sns:us-east-1:127134666975:dramaswamy_a17_job_requests"
   AWS_SNS_THAW_TOPIC = "arn:aws:sns:us-east-1:127134666975:dramaswamy_a17_thaw"
@@ -77,8 +77,9 @@ def annotate():
             Fields={"acl": acl, 
             "success_action_redirect": f"{request.base_url}/job",
             "x-amz-server-side-encryption": encryption},
+            # The form adds the selected tracks to the redirect URL
             Conditions=[{"acl": acl}, 
-            ["eq", "$success_action_redirect", f"{request.base_url}/job"],
+            ["starts-with", "$success_action_redirect", f"{request.base_url}/job"],
             {"x-amz-server-side-encryption": encryption}],
             ExpiresIn=app.config['AWS_SIGNED_REQUEST_EXPIRATION'] 
         )
@@ -90,7 +91,8 @@ def annotate():
         return abort(500)
 
     # Render the upload form template
-    return render_template("annotate.html", s3_post=response, role=session['role'])
+    return render_template("annotate.html", s3_post=response, role=session['role'],
+        tracks=app.config['ANNOTATION_TRACKS'])
 """Fires off an annotation job
 Accepts the S3 redirect GET request, parses it to extract 
 required info, saves a job item to the database, and then
@@ -113,6 +115,12 @@ def create_annotation_job_request():
     key_lst = key.split("~")
     input_file_name = key_lst[1]
     job_id = key_lst[0].split("/")[-1]
+
+    # Annotation tracks selected on the form (none selected = all of them)
+    tracks = [t for t in request.args.get('tracks', '').split(",") if t]
+    known = [name for name, label in app.config['ANNOTATION_TRACKS']]
+    if any([t not in known for t in tracks]):
+        return abort(400)
     
     # Time stamp: https://www.geeksforgeeks.org/get-current-timestamp-using-python/ 
     ts = int(time.time())
@@ -126,6 +134,8 @@ def create_annotation_job_request():
               "submit_time": ts,
               "job_status": "PENDING"
             }
+    if tracks and (set(tracks) != set(known)):
+        db_data["tracks"] = tracks
     
     # Create table resource: https://binaryguy.tech/aws/dynamodb/update-items-in-dynamodb-using-python/
     table_name = app.config["AWS_DYNAMODB_ANNOTATIONS_TABLE"]